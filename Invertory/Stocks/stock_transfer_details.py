@@ -1,11 +1,15 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
 from utils.fks_mapper import get_stock_transfers, get_items
 from utils.custom_err import IncrementalDependencyError
 
@@ -13,37 +17,31 @@ warnings.filterwarnings('ignore')
 load_dotenv()
 log = get_logger('StockTransferDetails')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['stock_transfers', 'items']
+
+# V1 columns this module never uses; the extract query selects everything else
+SOURCE_EXCLUDE = ['CreatedBy', 'LastUpdatedBy', 'Notes']
+
+# V1 columns the transform reads by name; the extract checks they still exist (SourceSchemaError)
+SOURCE_REQUIRED = ['StockIssueDetailID', 'StockIssueID', 'ItemID', 'StatusID', 'CreateOn', 'LastUpdatedDate']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.StockTransferDetails': {'OldStockIssueDetailID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.inv_StockIssueDetail', 'key': 'StockIssueDetailID',
+    'target': 'app.StockTransferDetails', 'target_key': 'OldStockIssueDetailID',
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.ETLcdc WHERE TableName=:table_name"),
-            {"table_name": 'dbo.inv_StockIssueDetail'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.inv_StockIssueDetail')
     log.info(f'Current CDC for dbo.inv_StockIssueDetail: {max_id}')
 
-    query = f"SELECT top 1000 * FROM dbo.inv_StockIssueDetail WHERE StockIssueDetailID > {max_id} ORDER BY StockIssueDetailID"
+    query = f"SELECT top 1000 {get_projection(source_db, 'dbo.inv_StockIssueDetail', exclude=SOURCE_EXCLUDE, required=SOURCE_REQUIRED)} FROM dbo.inv_StockIssueDetail WHERE StockIssueDetailID > {max_id} ORDER BY StockIssueDetailID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.inv_StockIssueDetail')
     return df
@@ -65,8 +63,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
         }, inplace=True)
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
+    clean_strings(df, NULL_BLANK)
         
     df['StatusID'] = df['StatusID'].fillna(1)
     df['UpdatedAt'] = df['UpdatedAt'].fillna(datetime.now())
@@ -87,7 +84,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
 
 
     df.drop(columns=[
-        'OldItemID', 'OldStockIssueID', 'CreatedBy', 'LastUpdatedBy', 'Notes'
+        'OldItemID', 'OldStockIssueID'
     ], inplace=True)
 
     log.info('Transformation complete')
@@ -102,34 +99,13 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldStockIssueDetailID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.StockTransferDetails', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldStockIssueDetailID'
-                    AND Object_ID = Object_ID('app.StockTransferDetails')
-                )
-                BEGIN
-                    ALTER TABLE app.StockTransferDetails
-                    ADD OldStockIssueDetailID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldStockIssueDetailID column.")
-
-            df.to_sql('StockTransferDetails', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'StockTransferDetails', dtype=dtype_mapping)
             log.info(f'dbo.inv_StockIssueDetail loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[ETLcdc] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.inv_StockIssueDetail', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.inv_StockIssueDetail', max_id)
             log.info(f'dbo.inv_StockIssueDetail loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.inv_StockIssueDetail: {e}')
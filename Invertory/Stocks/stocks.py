@@ -1,11 +1,14 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
 from utils.fks_mapper import get_warehouses, get_items
 from utils.custom_err import IncrementalDependencyError
 
@@ -13,34 +16,24 @@ warnings.filterwarnings('ignore')
 load_dotenv()
 log = get_logger('Stocks')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Stocks': {'OldStockID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile, and the aggregates utils.reconcile
+# compares per chunk as (label, source aggregate, target aggregate)
+VERIFY = {
+    'source': 'dbo.inv_Stock', 'key': 'StockID',
+    'target': 'app.Stocks', 'target_key': 'OldStockID',
+    'totals': [
+        ('CurrentStock', 'SUM(CurrentStock)', 'SUM(CurrentStock)'),
+        ('CurrentStock set', 'COUNT(CurrentStock)', 'COUNT(CurrentStock)'),
+    ],
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.ETLcdc WHERE TableName=:table_name"),
-            {"table_name": 'dbo.inv_Stock'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.inv_Stock')
     log.info(f'Current CDC for dbo.inv_Stock: {max_id}')
 
     query = f"SELECT top 1000 StockID, StoreID, ItemID, CurrentStock, CreatedOn, LastUpdatedDate, StutusID FROM dbo.inv_Stock WHERE StockID > {max_id} ORDER BY StockID"
@@ -62,8 +55,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
         }, inplace=True)
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None) 
+    clean_strings(df, NULL_BLANK)
 
     df['StatusID'] = df['StatusID'].fillna(1)
     df['UpdatedAt'] = df['UpdatedAt'].fillna(datetime.now())
@@ -97,34 +89,13 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldStockID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Stocks', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldStockID'
-                    AND Object_ID = Object_ID('app.Stocks')
-                )
-                BEGIN
-                    ALTER TABLE app.Stocks
-                    ADD OldStockID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldStockID column.")
-
-            df.to_sql('Stocks', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Stocks', dtype=dtype_mapping)
             log.info(f'dbo.inv_Stock loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[ETLcdc] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.inv_Stock', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.inv_Stock', max_id)
             log.info(f'dbo.inv_Stock loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.inv_Stock: {e}')
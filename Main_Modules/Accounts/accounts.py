@@ -1,47 +1,48 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
-from utils.tools import get_logger, clean_contact
+from utils.tools import get_logger
+from utils.contacts import clean_contacts
+from utils.cleaning import clean_strings, STRIP, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
+from utils.change_sync import sync_changes
+from utils.fks_mapper import ACCOUNTS
 
 warnings.filterwarnings('ignore')
 load_dotenv()
 log = get_logger('Accounts')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = []
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['UserID', 'FirstName', 'LastName', 'ImagePath', 'Company', 'BusinessType', 'Email', 'ContactNo', 'LastUpdatedDate', 'StatusID', 'CompanyCode', 'CreatedDate', 'VATNO', 'BrandThumbnailImage']
 
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Accounts': {'OldUserID': 'BIGINT NULL'}}
+
+# Columns that keep their V1 value, compared by utils.hash_diff as (source expression, target expression, SQL type)
+VERIFY = {
+    'source': 'dbo.Users', 'key': 'UserID',
+    'target': 'app.Accounts', 'target_key': 'OldUserID',
+    'columns': [
+        ('StatusID', 'StatusID', 'INT'),
+    ],
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.ETLcdc WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Users'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.Users')
     log.info(f'Current CDC for dbo.Users: {max_id}')
 
-    query = f"SELECT top 100 * FROM dbo.Users WHERE UserID > {max_id} ORDER BY UserID"
+    query = f"SELECT top 100 {get_projection(source_db, 'dbo.Users', SOURCE_COLUMNS)} FROM dbo.Users WHERE UserID > {max_id} ORDER BY UserID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Users')
     return df
@@ -51,7 +52,7 @@ def transform(df: pd.DataFrame) -> pd.DataFrame:
     """Clean and transform Users data."""
     # Keep only necessary columns and rename
 
-    df = df[["UserID","FirstName","LastName","ImagePath","Company","BusinessType","Email","ContactNo","LastUpdatedDate","StatusID","CompanyCode","CreatedDate","VATNO","BrandThumbnailImage"]]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         "UserID":'OldUserID',
@@ -69,13 +70,9 @@ def transform(df: pd.DataFrame) -> pd.DataFrame:
         }, inplace=True)
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-        if col != 'CompanyName':
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
-        else:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
+    clean_strings(df, NULL_BLANK, {'CompanyName': STRIP})
 
-    df['RepresentativeContactNo'] = df['RepresentativeContactNo'].apply(clean_contact)
+    df['RepresentativeContactNo'] = clean_contacts(df['RepresentativeContactNo'])
     df['CompanyName'] = df['CompanyName'].fillna('')
     df['UpdatedAt'] = df['UpdatedAt'].fillna(datetime.now())
     df.loc[df['CreatedAt'].isna(), 'CreatedAt'] = df['UpdatedAt']
@@ -110,39 +107,29 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldUserID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Accounts', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldUserID'
-                    AND Object_ID = Object_ID('app.Accounts')
-                )
-                BEGIN
-                    ALTER TABLE app.Accounts
-                    ADD OldUserID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldUserID column.")
-
-            df.to_sql('Accounts', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Accounts', dtype=dtype_mapping)
+            inserted = ACCOUNTS.fetch_inserted(conn)
             log.info(f'dbo.Users loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[ETLcdc] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Users', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Users', max_id)
             log.info(f'dbo.Users loaded successfully, CDC updated to {max_id}')
+        ACCOUNTS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Users: {e}')
         raise
 
+# -------------------- Changes --------------------
+def sync(source_db: Engine, target_db: Engine) -> int:
+    """Re-applies dbo.Users rows edited in V1 since the last run (utils.change_sync)."""
+    ensure_schema(target_db, TARGET_COLUMNS)
+    return sync_changes(
+        source_db, target_db, 'dbo.Users', 'UserID', transform, 'Accounts', 'OldUserID',
+        columns=get_projection(source_db, 'dbo.Users', SOURCE_COLUMNS), cache=ACCOUNTS,
+    )
+
 # -------------------- Main --------------------
 def main():
     source = source_db_conn()
@@ -152,7 +139,7 @@ def main():
         df = extract(source, target)
         if df.empty:
             log.info('No new data to load.')
-            return
+            break
         
         # return
         df = transform(df)
@@ -160,5 +147,7 @@ def main():
         # return
         load(df, target)
 
+    sync(source, target)
+
 if __name__ == '__main__':
     main()
@@ -1,12 +1,15 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
-from utils.fks_mapper import get_locations, get_customers
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
+from utils.fks_mapper import LOCATIONS, CUSTOMERS
 from utils.custom_err import IncrementalDependencyError
 
 
@@ -15,39 +18,30 @@ load_dotenv()
 log = get_logger('CustomerLocations')
 
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['locations', 'customers']
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['CustomerLocationID', 'CustomerID', 'LocationId', 'StatusID', 'CreatedOn', 'LastUpdatedDate']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.CustomerLocations': {'OldCustomerLocationID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.CustomerLocation_Junc', 'key': 'CustomerLocationID',
+    'target': 'app.CustomerLocations', 'target_key': 'OldCustomerLocationID',
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.CustomerLocation_Junc'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.CustomerLocation_Junc')
     log.info(f'Current CDC for dbo.CustomerLocation_Junc: {max_id}')
 
     max_id = 0 if max_id is None else max_id
 
-    query = f"SELECT TOP 5000 * FROM dbo.CustomerLocation_Junc WHERE CustomerLocationID > {max_id} ORDER BY CustomerLocationID"
+    query = f"SELECT TOP 5000 {get_projection(source_db, 'dbo.CustomerLocation_Junc', SOURCE_COLUMNS)} FROM dbo.CustomerLocation_Junc WHERE CustomerLocationID > {max_id} ORDER BY CustomerLocationID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.CustomerLocation_Junc')
     return df
@@ -57,7 +51,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     """Clean and transform Customers data."""
 
     # Keep only necessary columns and rename
-    df = df[['CustomerLocationID','CustomerID', 'LocationId', 'StatusID','CreatedOn', 'LastUpdatedDate']]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         "CustomerLocationID":'OldCustomerLocationID',
@@ -71,13 +65,13 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     df['OldLocationID'] = df['OldLocationID'].map(lambda x: x if x!=0 else 16)
 
 
-    df = pd.merge(df, get_locations(engine), on='OldLocationID', how='left')
-    missing_loc = df['LocationID'].isna().sum()
+    df['LocationID'], missing = LOCATIONS.translate(engine, df['OldLocationID'])
+    missing_loc = missing.sum()
     if missing_loc:
         raise IncrementalDependencyError(f'Missing LocationIDs: {missing_loc}. Update Locations Table.')
     
-    df = pd.merge(df, get_customers(engine, df['OldID']), on='OldID', how='left')
-    missing_cust = df['CustomerID'].isna().sum()
+    df['CustomerID'], missing = CUSTOMERS.translate(engine, df['OldID'])
+    missing_cust = missing.sum()
     if missing_cust:
         raise IncrementalDependencyError(f'Missing CustomerIDs: {missing_cust}. Update Customers in AspNetUsers Table.')
 
@@ -100,34 +94,13 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldCustomerLocationID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.CustomerLocations', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldCustomerLocationID'
-                    AND Object_ID = Object_ID('app.CustomerLocations')
-                )
-                BEGIN
-                    ALTER TABLE app.CustomerLocations
-                    ADD OldCustomerLocationID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldCustomerLocationID column.")
-
-            df.to_sql('CustomerLocations', con=conn, schema='app', if_exists='append', index=False) # type: ignore
+            load_frame(df, conn, 'CustomerLocations')
             log.info(f'dbo.CustomerLocation_Junc loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.CustomerLocation_Junc', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.CustomerLocation_Junc', max_id)
             log.info(f'dbo.CustomerLocation_Junc loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.CustomerLocation_Junc: {e}')
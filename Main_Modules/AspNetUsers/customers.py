@@ -1,48 +1,45 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
-from utils.tools import get_logger, clean_contact
-from utils.fks_mapper import get_cities, get_custom
+from utils.tools import get_logger
+from utils.contacts import clean_contacts
+from utils.cleaning import clean_strings, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
+from utils.fks_mapper import get_cities, get_custom, CUSTOMERS
 
 warnings.filterwarnings('ignore')
 load_dotenv()
 log = get_logger('Customers')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['locations']
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['CustomerID', 'FullName', 'ImagePath', 'Password', 'Email', 'Mobile', 'LocationID', 'StatusID', 'CreatedOn', 'LastUpdatedDate']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.AspNetUsers': {'OldID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.Customers', 'key': 'CustomerID',
+    'target': 'app.AspNetUsers', 'target_key': 'OldID',
+    'target_where': "UserType='Customer'",
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Customers'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.Customers')
     log.info(f'Current CDC for dbo.Customers: {max_id}')
 
-    query = f"SELECT TOP 5000 * FROM dbo.Customers WHERE CustomerID > {max_id} ORDER BY CustomerID"
+    query = f"SELECT TOP 5000 {get_projection(source_db, 'dbo.Customers', SOURCE_COLUMNS)} FROM dbo.Customers WHERE CustomerID > {max_id} ORDER BY CustomerID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Customers')
     return df
@@ -52,7 +49,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     """Clean and transform Customers data."""
 
     # Keep only necessary columns and rename
-    df = df[['CustomerID', 'FullName', 'ImagePath', 'Password', 'Email', 'Mobile', 'LocationID', 'StatusID','CreatedOn', 'LastUpdatedDate']]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         "CustomerID":'OldID',
@@ -65,11 +62,10 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
         }, inplace=True)
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
+    clean_strings(df, NULL_BLANK)
             
 
-    df['ContactNo'] = df['ContactNo'].apply(clean_contact)
+    df['ContactNo'] = clean_contacts(df['ContactNo'])
 
     df['UpdatedAt'] = df['UpdatedAt'].fillna(datetime.now())
     df.loc[df['CreatedAt'].isna(), 'CreatedAt'] = df['UpdatedAt']
@@ -107,35 +103,16 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.AspNetUsers', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldID'
-                    AND Object_ID = Object_ID('app.AspNetUsers')
-                )
-                BEGIN
-                    ALTER TABLE app.AspNetUsers
-                    ADD OldID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldID column.")
-
-            df.to_sql('AspNetUsers', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'AspNetUsers', dtype=dtype_mapping)
+            inserted = CUSTOMERS.fetch_inserted(conn)
             log.info(f'dbo.Customers loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Customers', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Customers', max_id)
             log.info(f'dbo.Customers loaded successfully, CDC updated to {max_id}')
+        CUSTOMERS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Customers: {e}')
         raise
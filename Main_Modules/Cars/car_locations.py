@@ -1,12 +1,17 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from typing import Iterator
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
-from utils.fks_mapper import get_locations, get_custom
+from utils.connections import source_db_conn, target_db_conn
+from utils.schema_guard import ensure_schema, check_columns
+from utils.parallel_loader import load_partitioned
+from utils.extractor import stream_table, get_projection
+from utils.pipeline import run_pipeline
+from utils.batch_sizer import BatchSizer
+from utils.fks_mapper import LOCATIONS, CARS
 from utils.custom_err import IncrementalDependencyError
 
 warnings.filterwarnings('ignore')
@@ -14,47 +19,36 @@ load_dotenv()
 
 log = get_logger('CarLocations')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['cars', 'locations']
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['CarLocationID', 'CarID', 'LocationID', 'StatusID', 'CreatedOn', 'LastUpdatedDate']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.CarLocations': {'OldCarLocationID': 'BIGINT NULL'}}
 
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.CarsLocation_Junc', 'key': 'CarLocationID',
+    'target': 'app.CarLocations', 'target_key': 'OldCarLocationID',
+}
 
 # -------------------- Extract --------------------
-def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
-    """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.CarsLocation_Junc'}
-        ).scalar()
-    max_id = 0 if max_id is None else max_id
-    log.info(f'Current CDC for dbo.CarsLocation_Junc: {max_id}')
-
-    query = f"SELECT TOP 10000 * FROM dbo.CarsLocation_Junc WHERE CarLocationID > {max_id} ORDER BY CarLocationID"
-    df = pd.read_sql_query(query, source_db)
-    log.info(f'Extracted {len(df)} rows from dbo.CarsLocation_Junc')
-    return df
+def extract(source_db: Engine, target_db: Engine, batch_size: int | BatchSizer = 10000) -> Iterator[pd.DataFrame]:
+    """Stream batches after the CDC watermark over one server-side cursor."""
+    yield from stream_table(
+        source_db, target_db, 'dbo.CarsLocation_Junc', 'CarLocationID',
+        columns=get_projection(source_db, 'dbo.CarsLocation_Junc', SOURCE_COLUMNS),
+        batch_size=batch_size,
+    )
 
 # -------------------- Transform --------------------
 def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     """Clean and transform Customers data."""
 
     # Keep only necessary columns and rename
-    df = df[['CarLocationID','CarID', 'LocationID', 'StatusID','CreatedOn', 'LastUpdatedDate']]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         "CarLocationID":'OldCarLocationID',
@@ -65,14 +59,14 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
         ,inplace=True)
     
     
-    df = pd.merge(df, get_locations(engine), on='OldLocationID', how='left')
-    missing_locs = df['LocationID'].isna().sum()
+    df['LocationID'], missing = LOCATIONS.translate(engine, df['OldLocationID'])
+    missing_locs = missing.sum()
     if missing_locs:
         raise IncrementalDependencyError(f'Missing LocationIDs: {missing_locs}. Update Locations Table.')
         
 
-    df = pd.merge(df, get_custom(engine, ['CarID', 'OldCarID'], 'app.Cars'), on='OldCarID', how='left')
-    missing_cars = df['CarID'].isna().sum()
+    df['CarID'], missing = CARS.translate(engine, df['OldCarID'])
+    missing_cars = missing.sum()
     if missing_cars:
         raise IncrementalDependencyError(f'Missing CarIDs: {missing_cars}. Update Cars Table.')
         
@@ -96,35 +90,11 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldCarLocationID'].max()
 
     try:
-        with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldCarLocationID'
-                    AND Object_ID = Object_ID('app.CarLocations')
-                )
-                BEGIN
-                    ALTER TABLE app.CarLocations
-                    ADD OldCarLocationID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldCarLocationID column.")
-
-            df.to_sql('CarLocations', con=conn, schema='app', if_exists='append', index=False) # type: ignore
-            log.info(f'dbo.CarsLocation_Junc loaded successfully')
-
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.CarsLocation_Junc', "max_index": int(max_id)}
-            )
-            log.info(f'dbo.CarsLocation_Junc loaded successfully, CDC updated to {max_id}')
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.CarLocations', df.columns)
+        # Partitions load on separate connections; CDC moves only once all of them committed
+        load_partitioned(df, engine, 'CarLocations', 'OldCarLocationID', 'dbo.CarsLocation_Junc')
+        log.info(f'dbo.CarsLocation_Junc loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.CarsLocation_Junc: {e}')
         raise
@@ -134,15 +104,11 @@ def main():
     source = source_db_conn()
     target = target_db_conn()
 
-    while True:
-        df = extract(source, target)
-        if df.empty:
-            log.info('No new data to load.')
-            break
-        df = transform(df, target)
-        # print(df.head(20))
-        # return
-        load(df, target)
+    sizer = BatchSizer('dbo.CarsLocation_Junc', initial=10000)
+
+    # Fetch the next batch and transform the current one while the previous one loads
+    run_pipeline(extract(source, target, sizer), lambda df: transform(df, target), lambda df: load(df, target), sizer=sizer)
+    log.info('No new data to load.')
 
 if __name__ == '__main__':
     main()
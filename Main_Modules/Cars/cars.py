@@ -1,12 +1,19 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
-from utils.fks_mapper import get_customers, get_custom
-from utils.tools import get_logger, parse_date
+from utils.fks_mapper import get_custom, CARS, CUSTOMERS
+from utils.tools import get_logger
+from utils.dates import parse_dates
+from utils.cleaning import clean_strings, NULL_TEXT
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
+from utils.change_sync import sync_changes
+from utils.key_lookup import read_by_keys
 from utils.custom_err import IncrementalDependencyError
 
 log = get_logger('Cars')
@@ -14,39 +21,34 @@ warnings.filterwarnings('ignore')
 load_dotenv()
 
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['customers', 'models']
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['CarID', 'CustomerID', 'MakeID', 'ModelID', 'Year', 'Color', 'VinNo', 'Description', 'RegistrationNo', 'ImagePath', 'CarType', 'StatusID', 'CreatedOn', 'LastUpdatedDate']
 
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Cars': {'OldCarID': 'BIGINT NULL'}}
+
+# Columns that keep their V1 value, compared by utils.hash_diff as (source expression, target expression, SQL type)
+VERIFY = {
+    'source': 'dbo.Cars', 'key': 'CarID',
+    'target': 'app.Cars', 'target_key': 'OldCarID',
+    'columns': [
+        ('COALESCE(StatusID, 1)', 'StatusID', 'INT'),
+        ('COALESCE(CarType, 0)', 'CarType', 'INT'),
+    ],
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Cars'}
-        ).scalar()
+    max_id = get_watermark(target_db, 'dbo.Cars')
     
-    max_id = max_id if not max_id is None else 0
     log.info(f'Current CDC for dbo.Cars: {max_id}')
 
     # query = f"SELECT * FROM dbo.Cars WHERE CarID BETWEEN 1556 AND 23454 ORDER BY CarID"
-    query = f"SELECT TOP 1000 * FROM dbo.Cars WHERE CarID > {max_id} ORDER BY CarID"
+    query = f"SELECT TOP 1000 {get_projection(source_db, 'dbo.Cars', SOURCE_COLUMNS)} FROM dbo.Cars WHERE CarID > {max_id} ORDER BY CarID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Cars')
     return df
@@ -55,7 +57,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Clean and transform Cars data."""
     # Keep only necessary columns and rename
-    df = df[['CarID', 'CustomerID' , 'MakeID', 'ModelID', 'Year', 'Color', 'VinNo', 'Description', 'RegistrationNo', 'ImagePath', 'CarType', 'StatusID','CreatedOn', 'LastUpdatedDate']]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         "CarID":'OldCarID',
@@ -67,9 +69,7 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
         }, inplace=True)
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
-            df[col] = df[col].apply(lambda x: x if isinstance(x,str) and x != 'NULL' else None)
+    clean_strings(df, NULL_TEXT)
 
     # Filling Null Values in StatusID, CarType and CarPlateType
     df['StatusID'] = df['StatusID'].fillna(1)
@@ -79,8 +79,8 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
 
 
     # Sync CustomerID and ModelID
-    df = pd.merge(df, get_customers(target_db, df['OldID']), on='OldID', how='left')
-    missing_cust = df['CustomerID'].isna().sum()
+    df['CustomerID'], missing = CUSTOMERS.translate(target_db, df['OldID'])
+    missing_cust = missing.sum()
     if missing_cust:
         log.warning(f'Missing CustomerIDs: {missing_cust}.')
         raise IncrementalDependencyError('Update Customers in AspNetUsers Table')
@@ -97,9 +97,8 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
 
     df['CreatedAt'] = df['UpdatedAt']
     if int(missing_update.sum()) > 0:
-        car_ids = tuple(df[df['UpdatedAt'].isna()]['OldCarID'].values.tolist()) + (0,0)
-        ids = str(car_ids)
-        dates = pd.read_sql(f"SELECT CarID, LastUpdatedDate, CreatedOn FROM dbo.CarsLocation_Junc WHERE CarID IN {ids} ORDER BY CarID, CreatedOn", source_db)
+        car_ids = df[df['UpdatedAt'].isna()]['OldCarID']
+        dates = read_by_keys(source_db, "SELECT CarID, LastUpdatedDate, CreatedOn FROM dbo.CarsLocation_Junc WHERE CarID IN {keys} ORDER BY CarID, CreatedOn", car_ids)
 
         if len(dates):
             dates.set_index('CarID', drop=False, inplace=True)
@@ -113,7 +112,8 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
 
 
     for col in ['CreatedAt', 'UpdatedAt']:
-        df[col] = df[col].apply(parse_date) # type: ignore
+        df[col], hits = parse_dates(df[col])
+        log.info(f'Parsed {col}: {hits}')
 
     # print(df[['CreatedAt', 'UpdatedAt']].head(20))
     missing_date = df[(df['CreatedAt'].isna()) | (df['UpdatedAt'].isna())]
@@ -134,39 +134,29 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldCarID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Cars', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldCarID'
-                    AND Object_ID = Object_ID('app.Cars')
-                )
-                BEGIN
-                    ALTER TABLE app.Cars
-                    ADD OldCarID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldCarID column.")
-
-            df.to_sql('Cars', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Cars', dtype=dtype_mapping)
+            inserted = CARS.fetch_inserted(conn)
             log.info(f'dbo.Cars loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Cars', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Cars', max_id)
             log.info(f'dbo.Cars loaded successfully, CDC updated to {max_id}')
+        CARS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Cars: {e}')
         raise
 
+# -------------------- Changes --------------------
+def sync(source_db: Engine, target_db: Engine) -> int:
+    """Re-applies dbo.Cars rows edited in V1 since the last run (utils.change_sync)."""
+    ensure_schema(target_db, TARGET_COLUMNS)
+    return sync_changes(
+        source_db, target_db, 'dbo.Cars', 'CarID', lambda df: transform(df, source_db, target_db), 'Cars', 'OldCarID',
+        columns=get_projection(source_db, 'dbo.Cars', SOURCE_COLUMNS), cache=CARS,
+    )
+
 # -------------------- Main --------------------
 def main():
     source = source_db_conn()
@@ -181,5 +171,7 @@ def main():
         load(df, target)
         # return
 
+    sync(source, target)
+
 if __name__ == '__main__':
     main()
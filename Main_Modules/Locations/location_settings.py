@@ -1,11 +1,15 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, EMPTY
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
 from utils.fks_mapper import get_locations
 from utils.custom_err import IncrementalDependencyError
 
@@ -17,39 +21,24 @@ load_dotenv()
 log = get_logger('LocationSettings')
 
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
+# V1 columns this module never uses; the extract query selects everything else
+SOURCE_EXCLUDE = ['IsActive', 'RowID', 'CreatedBy', 'LastUpdatedBy']
+
+# V1 columns the transform reads by name; the extract checks they still exist (SourceSchemaError)
+SOURCE_REQUIRED = ['ReceiptID', 'LocationID', 'StatusID', 'LastUpdatedDate']
 
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.LocationSettings': {'OldReceiptID': 'BIGINT NULL'}}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Receipt'}
-        ).scalar()
+    max_id = get_watermark(target_db, 'dbo.Receipt')
     
-    max_id = max_id if not max_id is None else 0
     # max_id = 0
     log.info(f'Current CDC for dbo.Receipt: {max_id}')
 
-    query = f"SELECT TOP 100 * FROM dbo.Receipt WHERE ReceiptID > {max_id} ORDER BY ReceiptID"
+    query = f"SELECT TOP 100 {get_projection(source_db, 'dbo.Receipt', exclude=SOURCE_EXCLUDE, required=SOURCE_REQUIRED)} FROM dbo.Receipt WHERE ReceiptID > {max_id} ORDER BY ReceiptID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Receipt')
     return df
@@ -66,8 +55,7 @@ def transform(df: pd.DataFrame, target_db: Engine) -> pd.DataFrame:
     
 
     # Clean strings
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else '')
+    clean_strings(df, EMPTY)
 
 
     # Filling Null Values in StatusID
@@ -83,7 +71,7 @@ def transform(df: pd.DataFrame, target_db: Engine) -> pd.DataFrame:
         log.error(f"Missing LocationIDs: {missing_locs.sum()}")
         raise IncrementalDependencyError("Update Locations Table.")
 
-    df.drop(columns=['IsActive', 'RowID', 'OldLocationID', 'CreatedBy', 'LastUpdatedBy'], inplace=True)
+    df.drop(columns=['OldLocationID'], inplace=True)
 
 
     df = df.melt(
@@ -105,34 +93,13 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldReceiptID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.LocationSettings', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldReceiptID'
-                    AND Object_ID = Object_ID('app.LocationSettings')
-                )
-                BEGIN
-                    ALTER TABLE app.LocationSettings
-                    ADD OldReceiptID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldReceiptID column.")
-
-            df.to_sql('LocationSettings', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'LocationSettings', dtype=dtype_mapping)
             log.info(f'dbo.Receipt loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Receipt', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Receipt', max_id)
             log.info(f'dbo.Receipt loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.Receipt: {e}')
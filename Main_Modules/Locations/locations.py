@@ -1,14 +1,20 @@
-import os
 import warnings
-import json
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
-from utils.tools import get_logger, clean_contact
+from utils.tools import get_logger
+from utils.contacts import clean_contacts
+from utils.cleaning import clean_strings, STRIP, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
+from utils.key_lookup import read_many_by_keys
+from utils.json_agg import group_json
 from utils.custom_err import IncrementalDependencyError
-from utils.fks_mapper import get_accounts, get_cities, get_custom
+from utils.fks_mapper import get_accounts, get_cities, get_custom, LOCATIONS
 
 warnings.filterwarnings('ignore')
 log = get_logger('Locations')
@@ -16,39 +22,39 @@ load_dotenv()
 
 
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['accounts', 'cities', 'amenities', 'services']
 
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['LocationID', 'UserID', 'CountryID', 'Name', 'Descripiton', 'ArabicDescription', 'Email', 'ContactNo', 'Address', 'ArabicAddress', 'District', 'BuildingNumber', 'PostalCode', 'StreetName', 'ArabicName', 'CityID', 'LandmarkID', 'LastUpdatedDate', 'Gmaplink', 'Longitude', 'Latitude', 'IsFeatured', 'StatusID']
+
+# Per-location side tables the transform turns into JSON columns; {keys} is the batch's LocationIDs
+SIDE_QUERIES = {
+    'amenities': "SELECT LocationID, AmenitiesID FROM dbo.LocationAmenitiesJunc WHERE LocationID IN {keys}",
+    'services': "SELECT LocationID, ServiceID FROM dbo.LocationServiceJunc WHERE LocationID IN {keys}",
+    'social_media': "SELECT LocationID, Facebook, Twitter, Instagram, TikTok, Snapchat FROM dbo.Receipt WHERE LocationID IN {keys}",
+    'working_hours': "SELECT LocationID, Name, ArabicName, Time, ArabicTime FROM dbo.LocationWorkingHours WHERE LocationID IN {keys}",
+    'images': "SELECT LocationID, Image FROM dbo.LocationImages WHERE LocationID IN {keys}",
+}
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Locations': {'OldLocationID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.Locations', 'key': 'LocationID',
+    'target': 'app.Locations', 'target_key': 'OldLocationID',
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract new rows based on CDC."""
-    with target_db.connect() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Locations'}
-        ).scalar()
+    max_id = get_watermark(target_db, 'dbo.Locations')
     
-    max_id = max_id if not max_id is None else 0
     # max_id=0
     log.info(f'Current CDC for dbo.Locations: {max_id}')
 
-    query = f"SELECT top 100 * FROM dbo.Locations WHERE LocationID > {max_id} ORDER BY LocationID"
+    query = f"SELECT top 100 {get_projection(source_db, 'dbo.Locations', SOURCE_COLUMNS)} FROM dbo.Locations WHERE LocationID > {max_id} ORDER BY LocationID"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Locations')
     return df
@@ -57,7 +63,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Clean and transform locations data."""
     # Keep only necessary columns and rename
-    df = df[['LocationID','UserID', 'CountryID', 'Name','Descripiton', 'ArabicDescription','Email', 'ContactNo', 'Address','ArabicAddress', 'District', 'BuildingNumber','PostalCode', 'StreetName', 'ArabicName' , 'CityID', 'LandmarkID', 'LastUpdatedDate', 'Gmaplink', 'Longitude','Latitude','IsFeatured','StatusID']]
+    df = df[SOURCE_COLUMNS]
     df = df.rename(columns={
         'LocationID':'OldLocationID',
         'CityID':'OldCityID',
@@ -95,10 +101,8 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
     df['CreatedAt'] = df['UpdatedAt']
 
     # Clean strings: strip 
-    for col in df.select_dtypes(include='object').columns:
-        if col != 'Name': df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
-        else: df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
-    df['ContactNo'] = df['ContactNo'].apply(clean_contact)
+    clean_strings(df, NULL_BLANK, {'Name': STRIP})
+    df['ContactNo'] = clean_contacts(df['ContactNo'])
 
 
     # IDs adjustments
@@ -112,43 +116,41 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
 
 
 
+    # Side tables, read for this batch's locations only and concurrently
+    side = read_many_by_keys(source_db, SIDE_QUERIES, df['OldLocationID'])
+    for frame in side.values():
+        frame.rename(columns={'LocationID':'OldLocationID'}, inplace=True)
+
     # Amenities Adjustments
-    amenities_junc = get_custom(source_db, ['LocationID', 'AmenitiesID'], 'dbo.LocationAmenitiesJunc')
-    amenities_junc.drop_duplicates(subset=['LocationID', 'AmenitiesID'], inplace=True)
-    amenities_junc.rename(columns={'AmenitiesID':'OldAmenitiesID', 'LocationID':'OldLocationID'}, inplace=True)
+    amenities_junc = side['amenities'].drop_duplicates(subset=['OldLocationID', 'AmenitiesID'])
+    amenities_junc = amenities_junc.rename(columns={'AmenitiesID':'OldAmenitiesID'})
     amenities = get_custom(target_db, ['Name', 'NameAr', 'AmenitiesID'], 'app.Amenities')
     amenities = pd.merge(amenities, get_custom(target_db, '*', 'app.SyncAmenities'), how='inner', on='AmenitiesID')
     amenities = pd.merge(amenities, amenities_junc, how='right', on='OldAmenitiesID')
     amenities.drop(columns='OldAmenitiesID', inplace=True)
-    amenities = amenities.groupby('OldLocationID').apply(lambda x: x.drop(columns="OldLocationID").to_dict(orient="records")).reset_index(name="AmenitiesJson")
+    amenities = group_json(amenities, 'OldLocationID', 'AmenitiesJson')
 
 
     # Services Adjustements
-    services_junc = get_custom(source_db, ['LocationID', 'ServiceID'], 'dbo.LocationServiceJunc')
-    services_junc.drop_duplicates(subset=['LocationID', 'ServiceID'], inplace=True)
-    services_junc.rename(columns={'ServiceID':'OldServiceID', 'LocationID':'OldLocationID'}, inplace=True)
+    services_junc = side['services'].drop_duplicates(subset=['OldLocationID', 'ServiceID'])
+    services_junc = services_junc.rename(columns={'ServiceID':'OldServiceID'})
     services = get_custom(target_db, ['Name', 'NameAr', 'ServiceID'], 'app.Services')
     services = pd.merge(services, get_custom(target_db, '*', 'app.SyncServices'), how='inner', on='ServiceID')
     services = pd.merge(services, services_junc, how='right', on='OldServiceID')
     services.drop(columns='OldServiceID', inplace=True)
-    services = services.groupby('OldLocationID').apply(lambda x: x.drop(columns="OldLocationID").to_dict(orient="records")).reset_index(name="ServicesJson")
+    services = group_json(services, 'OldLocationID', 'ServicesJson')
 
     # SocialMedia Adjustements
-    social_media = get_custom(source_db, ['LocationID', 'Facebook', 'Twitter', 'Instagram', 'TikTok', 'Snapchat'], 'dbo.Receipt')
-    social_media.dropna(subset=['Facebook', 'Twitter', 'Instagram', 'TikTok', 'Snapchat'], how='all', inplace=True)
-    social_media.drop_duplicates(subset=['LocationID', 'Facebook', 'Twitter', 'Instagram', 'TikTok', 'Snapchat'], inplace=True)
-    social_media.rename(columns={'LocationID':'OldLocationID'}, inplace=True)
-    social_media = social_media.groupby('OldLocationID').apply(lambda x: x.drop(columns="OldLocationID").to_dict(orient="records")).reset_index(name="SocialMediaJson")
+    social_media = side['social_media']
+    social_media = social_media.dropna(subset=['Facebook', 'Twitter', 'Instagram', 'TikTok', 'Snapchat'], how='all')
+    social_media = social_media.drop_duplicates(subset=['OldLocationID', 'Facebook', 'Twitter', 'Instagram', 'TikTok', 'Snapchat'])
+    social_media = group_json(social_media, 'OldLocationID', 'SocialMediaJson')
 
     # WorkingHours Adjustements
-    workinghours = get_custom(source_db, ['LocationID', 'Name', 'ArabicName', 'Time', 'ArabicTime'], 'dbo.LocationWorkingHours')
-    workinghours.rename(columns={'LocationID':'OldLocationID'}, inplace=True)
-    workinghours = workinghours.groupby('OldLocationID').apply(lambda x: x.drop(columns="OldLocationID").to_dict(orient="records")).reset_index(name="WorkingHours")
+    workinghours = group_json(side['working_hours'], 'OldLocationID', 'WorkingHours')
 
     # Images Adjustements
-    images = get_custom(source_db, ['LocationID', 'Image'], 'dbo.LocationImages')
-    images.rename(columns={'LocationID':'OldLocationID'}, inplace=True)
-    images = images.groupby('OldLocationID').apply(lambda x: x.drop(columns="OldLocationID").to_dict(orient="records")).reset_index(name="LocationImagesJson")
+    images = group_json(side['images'], 'OldLocationID', 'LocationImagesJson')
 
 
     df = pd.merge(df, amenities, on='OldLocationID', how='left')
@@ -157,13 +159,7 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
     df = pd.merge(df, workinghours, on='OldLocationID', how='left')
     df = pd.merge(df, images, on='OldLocationID', how='left')
 
-    log.info(f'Null values in WorkingHours: {df['WorkingHours'].map(lambda x: False if isinstance(x,list) else True).sum()}')
-
-    df['WorkingHours'] = df['WorkingHours'].apply(lambda x: json.dumps(x, ensure_ascii=False) if isinstance(x, list) else pd.NA) 
-    df['LocationImagesJson'] = df['LocationImagesJson'].apply(lambda x: json.dumps(x, ensure_ascii=False) if isinstance(x, list) else pd.NA) 
-    df['SocialMediaJson'] = df['SocialMediaJson'].apply(lambda x: json.dumps(x, ensure_ascii=False) if isinstance(x, list) else pd.NA) 
-    df['ServicesJson'] = df['ServicesJson'].apply(lambda x: json.dumps(x, ensure_ascii=False) if isinstance(x, list) else pd.NA) 
-    df['AmenitiesJson'] = df['AmenitiesJson'].apply(lambda x: json.dumps(x, ensure_ascii=False) if isinstance(x, list) else pd.NA) 
+    log.info(f'Null values in WorkingHours: {df['WorkingHours'].isna().sum()}')
 
     df[['WorkingHours', "LocationImagesJson", "SocialMediaJson", "ServicesJson", "AmenitiesJson"]] = df[['WorkingHours', "LocationImagesJson", "SocialMediaJson", "ServicesJson", "AmenitiesJson"]].astype("string")
 
@@ -190,34 +186,16 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldLocationID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Locations', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldLocationID'
-                    AND Object_ID = Object_ID('app.Locations')
-                )
-                BEGIN
-                    ALTER TABLE app.Locations
-                    ADD OldLocationID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldLocationID column.")
-
-            df.to_sql('Locations', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) #type: ignore
+            load_frame(df, conn, 'Locations', dtype=dtype_mapping)
+            inserted = LOCATIONS.fetch_inserted(conn)
 
             # Update CDC only after successful insert
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Locations', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Locations', max_id)
         log.info(f'dbo.Locations loaded successfully, CDC updated to {max_id}')
+        LOCATIONS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Locations: {e}')
         raise
@@ -1,45 +1,25 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.bulk_loader import load_frame
 
 log = get_logger('LocationPackages')
 warnings.filterwarnings('ignore')
 load_dotenv()
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['packages', 'locations']
 
 # -------------------- Extract --------------------
 def extract(engine: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with engine.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'app.LocationPackages'}
-        ).scalar()
+    max_id = get_watermark(engine, 'app.LocationPackages')
     
-    max_id = max_id if not max_id is None else 0
     log.info(f'Current CDC for app.LocationPackages: {max_id}')
     query = f"SELECT TOP 500 PackageID, CategoryID, Price, CreatedAt, UpdatedAt, StatusID FROM app.Packages WHERE PackageID > {max_id} ORDER BY PackageID "
     df = pd.read_sql_query(query, engine)
@@ -81,19 +61,10 @@ def load(df: pd.DataFrame, engine: Engine):
     try:
         with engine.begin() as conn:  # Transaction-safe
 
-            df.to_sql('LocationPackages', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'LocationPackages', dtype=dtype_mapping)
             log.info(f'app.LocationPackages loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'app.LocationPackages', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'app.LocationPackages', max_id)
             log.info(f'app.LocationPackages loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load app.LocationPackages: {e}')
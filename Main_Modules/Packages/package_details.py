@@ -1,11 +1,13 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
 from utils.fks_mapper import get_items, get_custom
 from utils.custom_err import IncrementalDependencyError
 
@@ -13,35 +15,23 @@ log = get_logger('PackageDetails')
 warnings.filterwarnings('ignore')
 load_dotenv()
  
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['packages', 'items']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.PackageDetails': {'OldPackageDetailID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.PackageDetails', 'key': 'PackageDetailID',
+    'target': 'app.PackageDetails', 'target_key': 'OldPackageDetailID',
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.PackageDetails'}
-        ).scalar()
+    max_id = get_watermark(target_db, 'dbo.PackageDetails')
     
-    max_id = max_id if not max_id is None else 0
     log.info(f'Current CDC for dbo.PackageDetails: {max_id}')
 
     query = f"SELECT TOP 5000 * FROM dbo.PackageDetails WHERE PackageDetailID > {max_id} ORDER BY PackageDetailID "
@@ -90,34 +80,13 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldPackageDetailID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.PackageDetails', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldPackageDetailID'
-                    AND Object_ID = Object_ID('app.PackageDetails')
-                )
-                BEGIN
-                    ALTER TABLE app.PackageDetails
-                    ADD OldPackageDetailID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldPackageDetailID column.")
-
-            df.to_sql('PackageDetails', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'PackageDetails', dtype=dtype_mapping)
             log.info(f'dbo.PackageDetails loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.PackageDetails', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.PackageDetails', max_id)
             log.info(f'dbo.PackageDetails loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.PackageDetails: {e}')
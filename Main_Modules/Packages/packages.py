@@ -1,50 +1,45 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
-from utils.fks_mapper import get_categories, get_custom, get_accounts
+from utils.cleaning import clean_strings, NULL_TEXT
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
+from utils.fks_mapper import get_categories, get_custom, get_accounts, PACKAGES
 from utils.custom_err import IncrementalDependencyError
 
 log = get_logger('Packages')
 warnings.filterwarnings('ignore')
 load_dotenv() 
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['accounts', 'categories']
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['PackageID', 'SubCategoryID', 'Name', 'ArabicName', 'Description', 'Price', 'Cost', 'SKU', 'Barcode', 'Image', 'UserID', 'StatusID', 'LastUpdatedDate']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Packages': {'OldPackageID': 'BIGINT NULL'}}
+
+# Old*ID coverage checked by utils.hash_diff and utils.reconcile; no columns keep their V1 value as-is
+VERIFY = {
+    'source': 'dbo.Packages', 'key': 'PackageID',
+    'target': 'app.Packages', 'target_key': 'OldPackageID',
+}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Packages'}
-        ).scalar()
+    max_id = get_watermark(target_db, 'dbo.Packages')
     
-    max_id = max_id if not max_id is None else 0
     log.info(f'Current CDC for dbo.Packages: {max_id}')
 
-    query = f"SELECT TOP 1000 * FROM dbo.Packages WHERE PackageID > {max_id} ORDER BY PackageID "
+    query = f"SELECT TOP 1000 {get_projection(source_db, 'dbo.Packages', SOURCE_COLUMNS)} FROM dbo.Packages WHERE PackageID > {max_id} ORDER BY PackageID "
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Packages')
     return df
@@ -53,7 +48,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Clean and transform Packages data."""
     # Keep only necessary columns and rename
-    df = df[['PackageID', 'SubCategoryID' , 'Name', 'ArabicName', 'Description', 'Price', 'Cost', 'SKU','Barcode', 'Image', 'UserID', 'StatusID', 'LastUpdatedDate']]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         "PackageID":'OldPackageID',
@@ -65,9 +60,7 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> pd.Data
     
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
-            df[col] = df[col].apply(lambda x: x if isinstance(x,str) and x != 'NULL' else None)
+    clean_strings(df, NULL_TEXT)
 
 
     # Sync AccountID and CategoryID
@@ -104,35 +97,16 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldPackageID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Packages', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldPackageID'
-                    AND Object_ID = Object_ID('app.Packages')
-                )
-                BEGIN
-                    ALTER TABLE app.Packages
-                    ADD OldPackageID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldPackageID column.")
-
-            df.to_sql('Packages', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Packages', dtype=dtype_mapping)
+            inserted = PACKAGES.fetch_inserted(conn)
             log.info(f'dbo.Packages loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Packages', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Packages', max_id)
             log.info(f'dbo.Packages loaded successfully, CDC updated to {max_id}')
+        PACKAGES.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Packages: {e}')
         raise
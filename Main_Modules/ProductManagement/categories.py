@@ -1,45 +1,27 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, STRIP, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.bulk_loader import load_frame
+from utils.dedup_index import CATEGORY_KEYS
 from utils.custom_err import IncrementalDependencyError
 
 warnings.filterwarnings('ignore')
 load_dotenv()
 log = get_logger('Categories')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['locations']
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Category'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.Category')
     log.info(f'Current CDC for dbo.Category: {max_id}')
     
     query = f"SELECT top 1000 * FROM dbo.Category WHERE CategoryID > {max_id} and CategoryID <> 2400 ORDER BY CategoryID"
@@ -66,11 +48,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> tuple[pd.DataFrame, pd.DataFr
     df['UpdatedAt'] = df['UpdatedAt'].fillna(datetime.now())
     df['CreatedAt'] = df['UpdatedAt']
 
-    for col in df.select_dtypes(include='object').columns:
-        if col != 'Name':
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip() != '' else None)
-        else:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
+    clean_strings(df, NULL_BLANK, {'Name': STRIP})
 
 
     df['StatusID'] = df['StatusID'].fillna(1)
@@ -92,13 +70,8 @@ def transform(df: pd.DataFrame, engine: Engine) -> tuple[pd.DataFrame, pd.DataFr
     # print(df[df['Name']=='Big Car'])
 
 
-    existing_records = pd.read_sql(f"SELECT AccountID, Name FROM app.Categories", engine)
-    existing_records['Duplicated'] = 1
-
-    df = pd.merge(df, existing_records, how='left', on=['AccountID','Name'])
-
-    df = df[df['Duplicated'].isna()]
-    df.drop(columns='Duplicated', inplace=True)
+    # (AccountID, Name) pairs already in app.Categories, from the key index (read once per process)
+    df = df[~CATEGORY_KEYS.contains(engine, df)]
 
 
     missing_acc = df['AccountID'].isna()
@@ -122,24 +95,17 @@ def load(df: pd.DataFrame, sync_table: pd.DataFrame, engine: Engine):
         with engine.begin() as conn: 
 
             # Inserting the Data
-            df.to_sql('Categories', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Categories', dtype=dtype_mapping)
+            inserted = CATEGORY_KEYS.fetch_inserted(conn)
             log.info(f'dbo.Category loaded successfully')
 
-            sync_table.to_sql('SyncCategories', con=conn, schema='app', if_exists='append', index=False, dtype={'Name':NVARCHAR(None)}) # type: ignore
+            load_frame(sync_table, conn, 'SyncCategories', dtype={'Name':NVARCHAR(None)})
             log.info(f'app.SyncCategories updated successfully')
 
             # # Updating the CDC
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Category', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Category', max_id)
             log.info(f'dbo.Category loaded successfully, CDC updated to {max_id}')
+        CATEGORY_KEYS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Category: {e}')
         raise
@@ -1,11 +1,15 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, EMPTY, NULL_BLANK, NULL_TEXT
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.bulk_loader import load_frame
+from utils.dedup_index import ITEM_KEYS
+from utils.extractor import get_projection
 from utils.custom_err import IncrementalDependencyError
 from utils.fks_mapper import get_custom
 
@@ -13,38 +17,20 @@ warnings.filterwarnings('ignore')
 load_dotenv()
 log = get_logger('Items')
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['categories', 'units']
+
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['ItemID', 'SubCatID', 'Name', 'NameOnReceipt', 'Description', 'ItemImage', 'Barcode', 'SKU', 'DisplayOrder', 'Price', 'Cost', 'ItemType', 'IsInventoryItem', 'IsOpenItem', 'MinOpenPrice', 'LastUpdatedDate', 'StatusID', 'UnitID']
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Items'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.Items')
     # max_id=0
     log.info(f'Current CDC for dbo.Items: {max_id}')
 
-    query = f"SELECT TOP 10000 * FROM dbo.Items WHERE ItemID > {max_id} ORDER BY ItemID"
+    query = f"SELECT TOP 10000 {get_projection(source_db, 'dbo.Items', SOURCE_COLUMNS)} FROM dbo.Items WHERE ItemID > {max_id} ORDER BY ItemID"
     # query = f"SELECT * FROM dbo.Items WHERE SubCatID in (10764, 10765, 10763, 10762, 10761, 10658, 10657, 10656, 10655, 10654, 10653, 10652)"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Items')
@@ -54,7 +40,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> tuple[pd.DataFrame, pd.DataFrame]:
     """Clean and transform Items data."""
     # Keep only necessary columns and rename
-    df = df[['ItemID','SubCatID','Name','NameOnReceipt','Description','ItemImage','Barcode','SKU','DisplayOrder','Price', 'Cost','ItemType','IsInventoryItem','IsOpenItem','MinOpenPrice','LastUpdatedDate','StatusID','UnitID']]
+    df = df[SOURCE_COLUMNS]
 
     df = df.rename(columns={
         'NameOnReceipt':'NameAr',
@@ -71,9 +57,7 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> tuple[p
     df['IsInclusiveVAT'] = 0
     df['StatusID'] = df['StatusID'].fillna(1)
 
-    for col in df.select_dtypes(include='object').columns:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
-            df[col] = df[col].apply(lambda x: x if isinstance(x,str) and x != 'NULL' else None)
+    clean_strings(df, NULL_TEXT)
 
 
     log.info(f'{len(df[df['IsInventoryItem'].isna()])} rows with missing InventoryItem')
@@ -96,11 +80,7 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> tuple[p
 
 
     # Fix String columns
-    for col in df.select_dtypes(include='object').columns:
-        if col != 'Name':
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip() != '' else None)
-        else: 
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else '')
+    clean_strings(df, NULL_BLANK, {'Name': EMPTY})
     
     
     # ItemTypeID HardCoded
@@ -137,19 +117,13 @@ def transform(df: pd.DataFrame, source_db: Engine, target_db: Engine) -> tuple[p
     # Handling Duplicates
     sync_table = df[['OldItemID', 'CategoryID','Name']].copy()
     
-    existing_records = pd.read_sql(f"SELECT CategoryID, Name FROM app.Items", target_db)
-    existing_records['Duplicated'] = 1
-
-    df = pd.merge(df, existing_records, how='left', on=['CategoryID','Name'])
-    
-
-
-    df = df[df['Duplicated'].isna()]
+    # (CategoryID, Name) pairs already in app.Items, from the key index (read once per process)
+    df = df[~ITEM_KEYS.contains(target_db, df)]
 
     df.sort_values(by=['CategoryID', 'StatusID', 'Price'], ascending=[True, True, False], inplace=True)
 
 
-    df.drop(columns=['SubCategoryID', 'OldCategoryID', 'OldUnitID', 'ItemType', 'Duplicated', 'OldItemID'], inplace=True)
+    df.drop(columns=['SubCategoryID', 'OldCategoryID', 'OldUnitID', 'ItemType', 'OldItemID'], inplace=True)
 
 
     df.drop_duplicates(subset=['CategoryID','Name'], inplace=True)
@@ -169,23 +143,16 @@ def load(df: pd.DataFrame, sync_t: pd.DataFrame, engine: Engine):
     try:
         with engine.begin() as conn:  # Transaction-safe
 
-            df.to_sql('Items', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Items', dtype=dtype_mapping)
+            inserted = ITEM_KEYS.fetch_inserted(conn)
             log.info(f'dbo.Items loaded successfully')
 
-            sync_t.to_sql('SyncItems', con=conn, schema='app', if_exists='append', index=False, dtype={'Name':NVARCHAR(None)}) # type: ignore
+            load_frame(sync_t, conn, 'SyncItems', dtype={'Name':NVARCHAR(None)})
             log.info(f'app.SyncItems updated successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Items', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Items', max_id)
             log.info(f'dbo.Items loaded successfully, CDC updated to {max_id}')
+        ITEM_KEYS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Items: {e}')
         raise
@@ -1,11 +1,13 @@
-import os
 import warnings
 from dotenv import load_dotenv
 import logging
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
 
 warnings.filterwarnings('ignore')
 load_dotenv()
@@ -16,37 +18,16 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    logging.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['SubCategoryID', 'CategoryID']
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.SubCategory'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.SubCategory')
     logging.info(f'Current CDC for dbo.SubCategory: {max_id}')
     
-    query = f"SELECT * FROM dbo.SubCategory WHERE CategoryID > {max_id}"
+    query = f"SELECT {get_projection(source_db, 'dbo.SubCategory', SOURCE_COLUMNS)} FROM dbo.SubCategory WHERE CategoryID > {max_id}"
     df = pd.read_sql_query(query, source_db)
     logging.info(f'Extracted {len(df)} rows from dbo.SubCategory')
     return df
@@ -55,7 +36,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     """Clean and transform Category data."""
     # Keep only necessary columns and rename
-    df = df[['SubCategoryID', 'CategoryID']]
+    df = df[SOURCE_COLUMNS]
 
     df.rename(columns={
         'CategoryID': 'OldCategoryID'
@@ -104,7 +85,7 @@ def load(df: pd.DataFrame, engine: Engine):
             # df.to_sql('Categories', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
             # logging.info(f'dbo.SubCategory loaded successfully')
 
-            sync_table.to_sql('SyncCategories', con=conn, schema='app', if_exists='append', index=False, dtype={'Name':NVARCHAR(None)}) # type: ignore
+            load_frame(sync_table, conn, 'SyncCategories', dtype={'Name':NVARCHAR(None)})
             logging.info(f'app.SyncCategories updated successfully')
 
             # # Updating the CDC
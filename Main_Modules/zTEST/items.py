@@ -1,12 +1,11 @@
-import os
 import sys
 import warnings
 from dotenv import load_dotenv
 import logging
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR
 import pandas as pd
+from utils.connections import source_db_conn, target_db_conn
 
 warnings.filterwarnings('ignore')
 load_dotenv()
@@ -17,25 +16,6 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    logging.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
-
 # -------------------- Extract --------------------
 def extract(account_id: int, v1: Engine, v2: Engine) -> tuple[pd.DataFrame, pd.DataFrame]:
 
@@ -1,12 +1,20 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from typing import Iterator
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
-from utils.fks_mapper import get_items, get_packages, get_custom
+from utils.cleaning import clean_strings, STRIP
+from utils.tax import apply_line_tax
+from utils.connections import source_db_conn, target_db_conn
+from utils.schema_guard import ensure_schema, check_columns
+from utils.parallel_loader import load_partitioned
+from utils.extractor import stream_table
+from utils.key_lookup import read_by_keys
+from utils.pipeline import run_pipeline
+from utils.batch_sizer import BatchSizer
+from utils.fks_mapper import get_items, get_order_headers, PACKAGES
 from utils.custom_err import IncrementalDependencyError
 
 
@@ -15,44 +23,60 @@ load_dotenv()
 
 log = get_logger("OrderLineItems")
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['orders', 'packages', 'items']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.OrderLineItems': {'OldOrderDetailID': 'BIGINT NULL'}}
+
+# Columns that keep their V1 value, compared by utils.hash_diff as (source expression, target expression, SQL type)
+VERIFY = {
+    'source': 'dbo.OrderDetail', 'key': 'OrderDetailID', 'where': "CreatedOn > '2025-01-01'",
+    'target': 'app.OrderLineItems', 'target_key': 'OldOrderDetailID',
+    'columns': [
+        ('Quantity', 'Quantity', 'DECIMAL(19, 4)'),
+        ('COALESCE(DiscountAmount, 0)', 'DiscountAmount', 'DECIMAL(19, 4)'),
+        ('COALESCE(RefundQty, 0)', 'RefundedQuantity', 'DECIMAL(19, 4)'),
+        ('COALESCE(StatusID, 1)', 'LineItemStatus', 'INT'),
+    ],
+    # Aggregates utils.reconcile compares per Old*ID chunk as (label, source aggregate, target aggregate)
+    'totals': [
+        ('Quantity', 'SUM(Quantity)', 'SUM(Quantity)'),
+        ('Subtotal', 'SUM(CASE WHEN Quantity <> 0 THEN Price ELSE 0 END)', 'SUM(Subtotal)'),
+        ('DiscountAmount', 'SUM(COALESCE(DiscountAmount, 0))', 'SUM(DiscountAmount)'),
+    ],
+}
+
+# SELECT list of dbo.OrderDetail
+SOURCE_QUERY_COLUMNS = 'OrderDetailID, OrderID, ItemID, PackageID, Description, Quantity, Price, Cost, DiscountAmount, RefundAmount, RefundQty, StatusID, CreatedOn, CreatedBy, LastUpdateDT, LastUpdateBy'
+# Lines before this date are not migrated
+SOURCE_FILTER = "CreatedOn > '2025-01-01'"
 
 # -------------------- Extract --------------------
-def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
-    """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.OrderDetail'}
-        ).scalar()
-    
-    max_id = max_id if not max_id is None else 0
-    log.info(f'Current CDC for dbo.OrderDetail: {max_id}')
-
-    query = f"SELECT TOP 100 OrderDetailID, OrderID, ItemID, PackageID, Description, Quantity, Price, Cost, DiscountAmount, RefundAmount, RefundQty, StatusID, CreatedOn, CreatedBy, LastUpdateDT, LastUpdateBy  FROM dbo.OrderDetail WHERE OrderDetailID > {max_id} and CreatedOn > '2025-01-01' ORDER BY OrderDetailID"
-
-
-    df = pd.read_sql_query(query, source_db)
-    log.info(f'Extracted {len(df)} rows from dbo.OrderDetail')
-
-    return df
+def attach_order_taxable(source_db: Engine, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds OrderTaxable, the sum of Subtotal - DiscountAmount over all migrated lines of each line's
+    order (also those in other batches), which the header tax is spread by.
+    """
+    order_taxable = read_by_keys(source_db, f"""
+        SELECT OrderID, SUM(CASE WHEN Quantity <> 0 THEN COALESCE(Price, 0) ELSE 0 END - COALESCE(DiscountAmount, 0)) AS OrderTaxable
+        FROM dbo.OrderDetail
+        WHERE OrderID IN {{keys}} AND {SOURCE_FILTER}
+        GROUP BY OrderID
+    """, df['OrderID'])
+    return pd.merge(df, order_taxable, on='OrderID', how='left')
+
+
+def extract(source_db: Engine, target_db: Engine, batch_size: int | BatchSizer = 100) -> Iterator[pd.DataFrame]:
+    """Stream batches after the CDC watermark over one server-side cursor."""
+    batches = stream_table(
+        source_db, target_db, 'dbo.OrderDetail', 'OrderDetailID',
+        columns=SOURCE_QUERY_COLUMNS,
+        where=SOURCE_FILTER,
+        batch_size=batch_size,
+    )
+    for df in batches:
+        yield attach_order_taxable(source_db, df)
 
 # -------------------- Transform --------------------
 def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
@@ -77,15 +101,12 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
 
     # Clean strings: strip & lowercase
     df['Notes'] = df['Notes'].map(lambda x: x.strip() if isinstance(x,str) and x.strip() != 'NULL' else None)
-    for col in df.select_dtypes(include='object').columns:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
+    clean_strings(df, STRIP)
             
 
     # Clean nulls
     df['UpdatedAt'] = df['UpdatedAt'].fillna(datetime.now())
     df['LineItemStatus'] = df['LineItemStatus'].fillna(1)
-    df['TaxAmount'] = 0
-    df['TaxPercent'] = 0
     df['IsInclusiveVAT'] = 0
     df['RefundedTaxAmount'] = 0
     df['UnitCost'] = df['UnitCost'].fillna(0)
@@ -100,9 +121,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     df['UnitCost'] = df['UnitCost'] / df['Quantity']
 
     df['Subtotal'] = df['UnitPrice'] * df['Quantity']
-    df['GrandTotal'] = df['Subtotal'] - df['DiscountAmount'] + df['TaxAmount']
     df['Subtotal'] = df['Subtotal'].fillna(0) 
-    df['GrandTotal'] = df['GrandTotal'].fillna(0) 
 
     df['DiscountPercent'] = (df['DiscountAmount'] / df['Subtotal']) * 100
 
@@ -112,18 +131,20 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     df['IsFreeItem'] = df['DiscountPercent'] == 100
 
 
-    df = pd.merge(df, get_custom(engine, ['OrderID', 'OldOrderID', 'OrderDiscountTotal'], 'app.Orders'), on='OldOrderID', how='left')
+    df = pd.merge(df, get_order_headers(engine, df['OldOrderID']), on='OldOrderID', how='left')
     missing_orders = df['OrderID'].isna().sum()
     if missing_orders:
         log.warning(f'Missing OrderIDs: {missing_orders}')
         raise IncrementalDependencyError('Update Orders Table.')
-    
+
+    # The order's tax spread over its lines, so they add up to the header's ItemTaxTotal
+    apply_line_tax(df)
 
     df['OrderDiscountAllocation'] = df.apply(lambda row: 0 if row['OrderDiscountTotal'] == 0 else (row['DiscountAmount']/row['OrderDiscountTotal'])*100, axis=1)
 
 
-    df = pd.merge(df, get_packages(engine), on='OldPackageID', how='left')
-    missing_packs = df['PackageID'].isna().sum()
+    df['PackageID'], missing = PACKAGES.translate(engine, df['OldPackageID'])
+    missing_packs = missing.sum()
     if missing_packs:
         log.warning(f'Missing PackageIDs: {missing_packs}')
         raise IncrementalDependencyError('Update Packages Table.')
@@ -134,7 +155,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
         log.warning(f'Missing ItemIDs: {missing_items}')
         raise IncrementalDependencyError('Update Items Table.')
 
-    df.drop(columns={'OldItemID', 'OldPackageID', 'OldOrderID', 'OrderDiscountTotal'}, inplace=True)
+    df.drop(columns={'OldItemID', 'OldPackageID', 'OldOrderID', 'OrderDiscountTotal', 'ItemTaxTotal', 'OrderTaxable'}, inplace=True)
 
 
     log.info(f'Transformation complete, df\'s Length is {len(df)}')
@@ -148,35 +169,11 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldOrderDetailID'].max()
 
     try:
-        with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldOrderDetailID'
-                    AND Object_ID = Object_ID('app.OrderLineItems')
-                )
-                BEGIN
-                    ALTER TABLE app.OrderLineItems
-                    ADD OldOrderDetailID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldOrderDetailID column.")
-
-            df.to_sql('OrderLineItems', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
-            log.info(f'dbo.OrderDetail loaded successfully')
-
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.OrderDetail', "max_index": int(max_id)}
-            )
-            log.info(f'dbo.OrderDetail loaded successfully, CDC updated to {max_id}')
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.OrderLineItems', df.columns)
+        # Partitions load on separate connections; CDC moves only once all of them committed
+        load_partitioned(df, engine, 'OrderLineItems', 'OldOrderDetailID', 'dbo.OrderDetail', dtype=dtype_mapping)
+        log.info(f'dbo.OrderDetail loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.OrderDetail: {e}')
         raise
@@ -186,15 +183,11 @@ def main():
     source = source_db_conn()
     target = target_db_conn()
 
-    while True:
-        df = extract(source, target)
-        if df.empty:
-            log.info('No new data to load.')
-            break
-        df = transform(df, target)
-        # print(df.head(20))
-        # return
-        load(df, target)
+    sizer = BatchSizer('dbo.OrderDetail', initial=100)
+
+    # Fetch the next batch and transform the current one while the previous one loads
+    run_pipeline(extract(source, target, sizer), lambda df: transform(df, target), lambda df: load(df, target), sizer=sizer)
+    log.info('No new data to load.')
 
 if __name__ == '__main__':
     main()
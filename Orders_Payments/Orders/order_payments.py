@@ -1,12 +1,15 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 import pandas as pd
 from utils.tools import get_logger
-from utils.fks_mapper import get_orders, get_custom
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.key_lookup import read_by_keys
+from utils.fks_mapper import get_custom, ORDERS
 from utils.custom_err import IncrementalDependencyError
 
 
@@ -15,45 +18,26 @@ load_dotenv()
 
 log = get_logger("OrderPayments")
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['orders', 'app_sources']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.OrderPayments': {'OldPaymentID': 'BIGINT NULL'}}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.OrderCheckout'}
-        ).scalar()
+    max_id = get_watermark(target_db, 'dbo.OrderCheckout')
     
-    max_id = max_id if not max_id is None else 0
     # max_id = 14948
     log.info(f'Current CDC for dbo.OrderCheckout: {max_id}')
 
     order_ids = pd.read_sql(f"SELECT TOP 3000 OrderID, OldOrderID FROM app.Orders WHERE OrderID > {max_id}", target_db)
     print(order_ids)
-    order_ids = tuple(order_ids['OldOrderID'].values.tolist()) + (0,0)
 
     # query = f"SELECT TOP 5000 OrderCheckOutID, OrderID, PaymentMode, Remarks, OrderStatus, CreatedOn, CreatedBy, AppSourceID, AmountPaid FROM dbo.OrderCheckout WHERE OrderCheckOutID > {max_id} ORDER BY OrderCheckOutID"
-    query = f"SELECT OrderCheckOutID, OrderID, PaymentMode, Remarks, OrderStatus, CreatedOn, CreatedBy, AppSourceID, AmountPaid FROM dbo.OrderCheckout WHERE OrderID IN {order_ids} ORDER BY OrderCheckOutID"
-    df = pd.read_sql_query(query, source_db)
+    query = "SELECT OrderCheckOutID, OrderID, PaymentMode, Remarks, OrderStatus, CreatedOn, CreatedBy, AppSourceID, AmountPaid FROM dbo.OrderCheckout WHERE OrderID IN {keys} ORDER BY OrderCheckOutID"
+    df = read_by_keys(source_db, query, order_ids['OldOrderID'])
     log.info(f'Extracted {len(df)} rows from dbo.OrderCheckout')
     return df
 
@@ -76,8 +60,8 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     df['PaymentModeID'] = df['PaymentModeID'].fillna(1)
     df['OldAppSourceID'] = pd.to_numeric(df['OldAppSourceID'], errors='coerce')
 
-    df = pd.merge(df, get_orders(engine, df['OldOrderID']), on='OldOrderID', how='left')
-    missing_orders = df['OrderID'].isna().sum()
+    df['OrderID'], missing = ORDERS.translate(engine, df['OldOrderID'])
+    missing_orders = missing.sum()
     if missing_orders:
         log.warning(f'Missing OrderIDs: {missing_orders}')
         raise IncrementalDependencyError('Update Orders Table.')
@@ -97,34 +81,13 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OrderID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.OrderPayments', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldPaymentID'
-                    AND Object_ID = Object_ID('app.OrderPayments')
-                )
-                BEGIN
-                    ALTER TABLE app.OrderPayments
-                    ADD OldPaymentID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldPaymentID column.")
-
-            df.to_sql('OrderPayments', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'OrderPayments', dtype=dtype_mapping)
             log.info(f'dbo.OrderCheckout loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.OrderCheckout', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.OrderCheckout', max_id)
             log.info(f'dbo.OrderCheckout loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.OrderCheckout: {e}')
@@ -1,14 +1,25 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR, DECIMAL
+from typing import Iterator
+from sqlalchemy import text, Engine, NVARCHAR, DECIMAL
 from sqlalchemy.exc import OperationalError
-from urllib.parse import quote_plus
 import pandas as pd
 import numpy as np
-from utils.tools import get_logger, fix_order_checkout
-from utils.fks_mapper import get_custom, get_users, get_locations, get_cars, get_customers
+from utils.tools import get_logger
+from utils.order_totals import reconcile_order_totals
+from utils.tax import apply_order_tax
+from utils.cleaning import clean_strings, STRIP
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import stream_table
+from utils.change_sync import sync_changes
+from utils.key_lookup import read_by_keys
+from utils.pipeline import run_pipeline
+from utils.batch_sizer import BatchSizer
+from utils.fks_mapper import LOCATIONS, CARS, USERS, CUSTOMERS, BAYS, ORDERS
 from utils.custom_err import IncrementalDependencyError
 
 
@@ -17,54 +28,69 @@ load_dotenv()
 
 log = get_logger("Orders")
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Upstream tasks (main.py names) that must be migrated first
+DEPENDS_ON = ['locations', 'cars', 'users', 'customers', 'bays']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Orders': {'OldOrderID': 'BIGINT NULL'}}
+
+# Columns that keep their V1 value, compared by utils.hash_diff as (source expression, target expression, SQL type)
+VERIFY = {
+    'source': 'dbo.Orders', 'key': 'OrderID', 'where': "CreatedOn > '2025-01-01'",
+    'target': 'app.Orders', 'target_key': 'OldOrderID',
+    'columns': [
+        ('COALESCE(StatusID, 1)', 'LastServiceStatusID', 'INT'),
+        ('CreatedOn', 'CreatedAt', 'DATETIME'),
+    ],
+    # Aggregates utils.reconcile compares per Old*ID chunk as (label, source aggregate, target aggregate);
+    # the source side reads the orders with their checkout totals, one row per order
+    'totals_source': """(
+        SELECT o.OrderID, o.CreatedOn, o.OrderTakerID, c.AmountTotal, c.GrandTotal, c.AmountPaid
+        FROM dbo.Orders o
+        LEFT JOIN (
+            SELECT OrderID, SUM(AmountTotal) AS AmountTotal, SUM(GrandTotal) AS GrandTotal, SUM(AmountPaid) AS AmountPaid
+            FROM dbo.OrderCheckout GROUP BY OrderID
+        ) c ON c.OrderID = o.OrderID
+    ) AS o""",
+    'totals': [
+        ('Subtotal', 'SUM(COALESCE(AmountTotal, 0))', 'SUM(Subtotal)'),
+        ('GrandTotal', 'SUM(COALESCE(GrandTotal, 0))', 'SUM(GrandTotal)'),
+        ('AmountPaidTotal', 'SUM(COALESCE(AmountPaid, 0))', 'SUM(AmountPaidTotal)'),
+        ('OrderTakerID set', 'COUNT(OrderTakerID)', 'COUNT(OrderTakerID)'),
+    ],
+}
+
+# SELECT list of dbo.Orders; the insert extract and the change sync read the same columns
+SOURCE_QUERY_COLUMNS = 'OrderID, LocationID, TransactionNo, OrderNo, CarID, CustomerID, BayID, OrderType, OrderMode, OrderTakerID, StatusID, CreatedOn, LastUpdateDT'
+# Orders before this date are not migrated
+SOURCE_FILTER = "CreatedOn > '2025-01-01'"
 
 # -------------------- Extract --------------------
-def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
-    """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Orders'}
-        ).scalar()
-    
-    max_id = max_id if not max_id is None else 0
-    log.info(f'Current CDC for dbo.Orders: {max_id}')
-
-    query = f"SELECT TOP 2000 OrderID, LocationID, TransactionNo, OrderNo, CarID, CustomerID, BayID, OrderType, OrderMode, OrderTakerID, StatusID, CreatedOn, LastUpdateDT FROM dbo.Orders WHERE OrderID > {max_id} AND CreatedOn > '2025-01-01' ORDER BY OrderID"
-    df = pd.read_sql_query(query, source_db)
-
-    order_ids = tuple(df['OrderID'].values.tolist()) + (0,0)
-    order_checkout = pd.read_sql(f'SELECT OrderID, AmountTotal, AmountDiscount, Tax, GrandTotal, AmountPaid, DiscountPercent, RefundedAmount FROM dbo.OrderCheckout WHERE OrderID IN {order_ids}', source_db)
+def attach_totals(source_db: Engine, df: pd.DataFrame) -> pd.DataFrame:
+    """Adds each order's checkout totals and its detail discount total."""
+    order_checkout = read_by_keys(source_db, 'SELECT OrderID, AmountTotal, AmountDiscount, Tax, GrandTotal, AmountPaid, DiscountPercent, RefundedAmount FROM dbo.OrderCheckout WHERE OrderID IN {keys}', df['OrderID'])
     order_checkout = order_checkout.groupby('OrderID', as_index=False).agg({k:('sum' if k!='DiscountPercent' else 'max') for k in order_checkout.columns})
 
-    order_details = pd.read_sql(f'SELECT OrderID, DiscountAmount AS ItemDiscountTotal FROM dbo.OrderDetail WHERE OrderID IN {order_ids}', source_db)
+    order_details = read_by_keys(source_db, 'SELECT OrderID, DiscountAmount AS ItemDiscountTotal FROM dbo.OrderDetail WHERE OrderID IN {keys}', df['OrderID'])
     order_details = order_details.groupby('OrderID', as_index=False).sum()
 
     df = pd.merge(df, order_checkout, on='OrderID', how='left')
     df = pd.merge(df, order_details, on='OrderID', how='left')
+    return df
 
-    print(df)
 
-    log.info(f'Extracted {len(df)} rows from dbo.Orders')
-    return df
+def extract(source_db: Engine, target_db: Engine, batch_size: int | BatchSizer = 2000) -> Iterator[pd.DataFrame]:
+    """Stream Orders after the CDC watermark and attach their checkout and detail totals."""
+    batches = stream_table(
+        source_db, target_db, 'dbo.Orders', 'OrderID',
+        columns=SOURCE_QUERY_COLUMNS,
+        where=SOURCE_FILTER,
+        batch_size=batch_size,
+    )
+    for df in batches:
+        df = attach_totals(source_db, df)
+        log.info(f'Extracted {len(df)} rows from dbo.Orders')
+        yield df
 
 # -------------------- Transform --------------------
 def transform(df: pd.DataFrame, target: Engine) -> pd.DataFrame:
@@ -91,8 +117,7 @@ def transform(df: pd.DataFrame, target: Engine) -> pd.DataFrame:
 
 
     # Clean strings: strip & lowercase
-    for col in df.select_dtypes(include='object').columns:
-            df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
+    clean_strings(df, STRIP)
             
 
     # Clean nulls
@@ -110,34 +135,30 @@ def transform(df: pd.DataFrame, target: Engine) -> pd.DataFrame:
     df['OldBayID'] = pd.to_numeric(df['OldBayID'], errors='coerce')
     df['OrderType'] = df['OrderType'].map({'New': 0})
 
-    # Fixing OrderCheckOuts
-    df = df.apply(fix_order_checkout, axis=1) # type: ignore
-    df['AmountDueTotal'] = df['GrandTotal'] - df['AmountPaidTotal']
-    df.loc[df['OrderDiscountTotal']== 0, 'OrderDiscountTotal'] = df[['OrderDiscountPercent','Subtotal']].apply(lambda row: (row['OrderDiscountPercent'] * row['Subtotal'])/100, axis=1) 
-    df.loc[df['OrderDiscountPercent']== 0, 'OrderDiscountPercent'] = df[['OrderDiscountTotal','Subtotal']].apply(lambda row: 0 if row['Subtotal']==0 else row['OrderDiscountTotal'] / row['Subtotal'], axis=1) 
-
-    # Foreign Keys Mapping
-    df = pd.merge(df, get_locations(target), on='OldLocationID', how='left')
-    missing_locs = df['LocationID'].isna().sum()
+    # Foreign Keys Mapping (in place, without merging the whole frame per key)
+    df['LocationID'], missing = LOCATIONS.translate(target, df['OldLocationID'])
+    missing_locs = missing.sum()
     if missing_locs:
         raise IncrementalDependencyError(f'Missing LocationIDs: {missing_locs}. Update Locations Table.')
+
+    # Header tax from the location's country, on V1's totals (ETL_ORDER_TAX_MODE decides which orders)
+    apply_order_tax(df, target)
+
+    # Fixing OrderCheckOuts, AmountDueTotal and the discount total/percent pair
+    reconcile_order_totals(df)
     
-    
-    df = pd.merge(df, get_cars(target, df['OldCarID']), on='OldCarID', how='left')
+    df['CarID'], _ = CARS.translate(target, df['OldCarID'])
    
-    df = pd.merge(df, get_users(target, df['OldID']), on='OldID', how='left')
-    df.rename(columns={'Id':'OrderTakerID'}, inplace=True)
-    df.drop(columns='OldID', inplace=True)
-    missing_ot = df['OrderTakerID'].isna().sum()
+    df['OrderTakerID'], missing = USERS.translate(target, df['OldID'])
+    missing_ot = missing.sum()
     if missing_ot:
         raise IncrementalDependencyError(f'Missing OrderTakerIDs: {missing_ot}. Update AspNetUsers Table.')
     
     
-    df.rename(columns={'CustomerID':'OldID'}, inplace=True)
-    df = pd.merge(df, get_customers(target, df['OldID']), on='OldID', how='left')
+    df['CustomerID'], _ = CUSTOMERS.translate(target, df['CustomerID'])
 
 
-    df = pd.merge(df, get_custom(target, ['BayID', 'OldBayID'], 'app.Bays', 'OldBayID'), on='OldBayID', how='left')
+    df['BayID'], _ = BAYS.translate(target, df['OldBayID'])
 
 
     df.drop(columns={'OldLocationID', 'OldCarID', 'OldBayID', 'OldID', 'OrderMode'}, inplace=True)
@@ -156,53 +177,45 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldOrderID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Orders', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldOrderID'
-                    AND Object_ID = Object_ID('app.Orders')
-                )
-                BEGIN
-                    ALTER TABLE app.Orders
-                    ADD OldOrderID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldOrderID column.")
-
-            df.to_sql('Orders', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Orders', dtype=dtype_mapping)
+            inserted = ORDERS.fetch_inserted(conn)
             log.info(f'dbo.Orders loaded successfully')
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Orders', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Orders', max_id)
             log.info(f'dbo.Orders loaded successfully, CDC updated to {max_id}')
+        ORDERS.absorb(inserted)
     except Exception as e:
         log.error(f'Failed to load dbo.Orders: {e}')
         raise
 
+# -------------------- Changes --------------------
+def sync(source_db: Engine, target_db: Engine) -> int:
+    """
+    Re-applies orders edited in V1 since the last run (utils.change_sync): edits of the dbo.Orders row
+    itself, and of the checkout and detail rows attach_totals sums (payments, refunds, discounts).
+    """
+    ensure_schema(target_db, TARGET_COLUMNS)
+    return sync_changes(
+        source_db, target_db, 'dbo.Orders', 'OrderID', lambda df: transform(attach_totals(source_db, df), target_db), 'Orders', 'OldOrderID',
+        columns=SOURCE_QUERY_COLUMNS, where=SOURCE_FILTER, cache=ORDERS, batch_size=2000,
+        related=(('dbo.OrderCheckout', 'OrderID'), ('dbo.OrderDetail', 'OrderID')),
+    )
+
 # -------------------- Main --------------------
 def main():
     source = source_db_conn()
     target = target_db_conn()
 
-    while True:
-        df = extract(source, target)
-        if df.empty:
-            log.info('No new data to load.')
-            break
-        df = transform(df, target)
-        # return
-        load(df, target)
-        
+    sizer = BatchSizer('dbo.Orders', initial=2000)
+
+    # Fetch the next batch and transform the current one while the previous one loads
+    run_pipeline(extract(source, target, sizer), lambda df: transform(df, target), lambda df: load(df, target), sizer=sizer)
+    log.info('No new data to load.')
+
+    sync(source, target)
 
 if __name__ == '__main__':
     main()
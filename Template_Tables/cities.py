@@ -1,41 +1,31 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, STRIP
+from utils.connections import source_db_conn, target_db_conn
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
 
 log = get_logger('Cities')
 
 warnings.filterwarnings('ignore')
 load_dotenv() 
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['ID', 'Name', 'District', 'CountryCode']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Cities': {'OldCityID': 'BIGINT NULL'}}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
 
-    query = f"SELECT * FROM dbo.City"
+    query = f"SELECT {get_projection(source_db, 'dbo.City', SOURCE_COLUMNS)} FROM dbo.City"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.City')
     return df
@@ -44,7 +34,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     """Clean and transform Cities data."""
     # Keep only necessary columns and rename
-    df = df[['ID', 'Name', 'District', 'CountryCode']]
+    df = df[SOURCE_COLUMNS]
     df = df.rename(columns={
         'ID':'OldCityID',
         'Name':'CityName',
@@ -55,8 +45,7 @@ def transform(df: pd.DataFrame, engine: Engine) -> pd.DataFrame:
     df['District'] = df['District'].fillna('')
     df['Code'] = df['Code'].map(lambda x: 'SAU' if x == 'SA' else x)
 
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
+    clean_strings(df, STRIP)
 
     countries = pd.read_sql(f"SELECT CountryID, Code FROM app.Countries", engine)
     df = pd.merge(df, countries, on='Code', how='left')
@@ -81,22 +70,10 @@ def load(df: pd.DataFrame, engine: Engine):
     # max_id = df['OldCountryID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Cities', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldCityID'
-                    AND Object_ID = Object_ID('app.Cities')
-                )
-                BEGIN
-                    ALTER TABLE app.Cities
-                    ADD OldCityID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldCityID column.")
-
-            df.to_sql('Cities', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Cities', dtype=dtype_mapping)
             log.info(f'dbo.City loaded successfully')
 
     except Exception as e:
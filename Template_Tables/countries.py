@@ -1,40 +1,30 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, STRIP
+from utils.connections import source_db_conn, target_db_conn
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
 
 log = get_logger('Countries')
 warnings.filterwarnings('ignore')
 load_dotenv()
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['Code', 'Name', 'Curr_Code']
 
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Countries': {'Code': 'VARCHAR(3) NULL'}}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
 
-    query = f"SELECT * FROM dbo.Country"
+    query = f"SELECT {get_projection(source_db, 'dbo.Country', SOURCE_COLUMNS)} FROM dbo.Country"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Country')
     return df
@@ -43,7 +33,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame) -> pd.DataFrame:
     """Clean and transform Countries data."""
     # Keep only necessary columns and rename
-    df = df[['Code', 'Name', 'Curr_Code']]
+    df = df[SOURCE_COLUMNS]
     df = df.rename(columns={
         'Name':'CountryName',
         'Curr_Code':'Currency',
@@ -54,8 +44,7 @@ def transform(df: pd.DataFrame) -> pd.DataFrame:
     df['ConversionRate'] = 1
     df['Currency'] = df['Currency'].fillna('')
 
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) else x)
+    clean_strings(df, STRIP)
 
     alpha2_to_alpha3 = {
     "AD": "AND",
@@ -320,22 +309,10 @@ def load(df: pd.DataFrame, engine: Engine):
     # max_id = df['OldCountryID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Countries', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'Code'
-                    AND Object_ID = Object_ID('app.Countries')
-                )
-                BEGIN
-                    ALTER TABLE app.Countries
-                    ADD Code VARCHAR(3) NULL;
-                END
-            """))
-            log.info("Verified/Added Code column.")
-
-            df.to_sql('Countries', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Countries', dtype=dtype_mapping)
             log.info(f'dbo.Country loaded successfully')
 
     except Exception as e:
@@ -1,47 +1,33 @@
-import os
 import warnings
 from dotenv import load_dotenv
 from datetime import datetime
-from sqlalchemy import create_engine, text, Engine, NVARCHAR
-from urllib.parse import quote_plus
+from sqlalchemy import text, Engine, NVARCHAR
 import pandas as pd
 from utils.tools import get_logger
+from utils.cleaning import clean_strings, NULL_BLANK
+from utils.connections import source_db_conn, target_db_conn
+from utils.cdc import get_watermark, write_watermark
+from utils.schema_guard import ensure_schema, check_columns
+from utils.bulk_loader import load_frame
+from utils.extractor import get_projection
 
 log = get_logger('Units')
 warnings.filterwarnings('ignore')
 load_dotenv()
 
-# -------------------- Connections --------------------
-def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
-    conn_string = (
-        f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
-        f"SERVER={os.getenv(server_env)};"
-        f"DATABASE={os.getenv(db_env)};"
-        f"UID={os.getenv(user_env)};"
-        f"PWD={os.getenv(pw_env)};"
-        f"Encrypt=yes;"
-        f"TrustServerCertificate=yes;"
-    )
-    quoted = quote_plus(conn_string)
-    engine = create_engine(f'mssql+pyodbc:///?odbc_connect={quoted}')
-    log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)}')
-    return engine
-
-def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
-def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+# V1 columns this module reads; the extract query selects only these
+SOURCE_COLUMNS = ['UnitID', 'Unit', 'Description', 'StatusID']
+
+# Target columns the load needs; added once per run when missing (utils.schema_guard)
+TARGET_COLUMNS = {'app.Units': {'OldUnitID': 'BIGINT NULL'}}
 
 # -------------------- Extract --------------------
 def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
     """Extract data based on CDC."""
-    with target_db.begin() as conn:
-        max_id = conn.execute(
-            text("SELECT ISNULL(MaxIndex,0) FROM app.EtlCDC WHERE TableName=:table_name"),
-            {"table_name": 'dbo.Units'}
-        ).scalar()
-    max_id = max_id if not max_id is None else 0
+    max_id = get_watermark(target_db, 'dbo.Units')
     log.info(f'Current CDC for dbo.Units: {max_id}')
 
-    query = f"SELECT * FROM dbo.Units WHERE UnitID > {max_id}"
+    query = f"SELECT {get_projection(source_db, 'dbo.Units', SOURCE_COLUMNS)} FROM dbo.Units WHERE UnitID > {max_id}"
     df = pd.read_sql_query(query, source_db)
     log.info(f'Extracted {len(df)} rows from dbo.Units')
     return df
@@ -50,7 +36,7 @@ def extract(source_db: Engine, target_db: Engine) -> pd.DataFrame:
 def transform(df: pd.DataFrame) -> pd.DataFrame:
     """Clean and transform Units data."""
     # Keep only necessary columns and rename
-    df = df[['UnitID', 'Unit', 'Description', 'StatusID']]
+    df = df[SOURCE_COLUMNS]
 
     df = df.rename(columns={
         'Unit':'Name',
@@ -62,8 +48,7 @@ def transform(df: pd.DataFrame) -> pd.DataFrame:
     df['StatusID'] = df['StatusID'].fillna(1)
 
 
-    for col in df.select_dtypes(include='object').columns:
-        df[col] = df[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip() != '' else None)
+    clean_strings(df, NULL_BLANK)
 
     log.info('Transformation complete')
     return df
@@ -75,35 +60,14 @@ def load(df: pd.DataFrame, engine: Engine):
     max_id = df['OldUnitID'].max()
 
     try:
+        ensure_schema(engine, TARGET_COLUMNS)
+        check_columns(engine, 'app.Units', df.columns)
         with engine.begin() as conn:  # Transaction-safe
-
-            conn.execute(text("""
-                IF NOT EXISTS (
-                    SELECT 1 FROM sys.columns
-                    WHERE Name = 'OldUnitID'
-                    AND Object_ID = Object_ID('app.Units')
-                )
-                BEGIN
-                    ALTER TABLE app.Units
-                    ADD OldUnitID BIGINT NULL;
-                END
-            """))
-            log.info("Verified/Added OldUnitID column.")
-
-            df.to_sql('Units', con=conn, schema='app', if_exists='append', index=False, dtype=dtype_mapping) # type: ignore
+            load_frame(df, conn, 'Units', dtype=dtype_mapping)
             log.info(f'dbo.Units loaded successfully')
 
 
-            conn.execute(
-                text("""
-                    MERGE app.[EtlCDC] AS target
-                    USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
-                    ON target.[TableName] = source.[TableName]
-                    WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
-                    WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
-                """),
-                {"table_name": f'dbo.Units', "max_index": int(max_id)}
-            )
+            write_watermark(conn, 'dbo.Units', max_id)
             log.info(f'dbo.Units loaded successfully, CDC updated to {max_id}')
     except Exception as e:
         log.error(f'Failed to load dbo.Units: {e}')
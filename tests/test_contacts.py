@@ -0,0 +1,70 @@
+import unittest
+import numpy as np
+import pandas as pd
+from utils import contacts
+from utils.contacts import clean_contacts, normalize_contacts
+from utils.tools import clean_contact
+
+
+def expected(s: pd.Series) -> pd.Series:
+    return s.map(clean_contact).astype(object)
+
+
+class CleanContactsTest(unittest.TestCase):
+    """clean_contacts must give exactly what clean_contact gives row by row."""
+
+    def setUp(self):
+        contacts._cache.clear()
+
+    def assertMatchesRowByRow(self, values: list):
+        s = pd.Series(values, dtype=object)
+        actual = clean_contacts(s)
+        self.assertTrue(actual.equals(expected(s)), f'\n{pd.DataFrame({"input": s, "clean_contact": expected(s), "clean_contacts": actual})}')
+
+    def test_saudi_prefixes(self):
+        self.assertMatchesRowByRow([
+            '+966501234567', '966501234567', '00966501234567', '0966501234567',
+            '0501234567', '501234567', '000501234567', '0+966501234567', '+0501234567',
+        ])
+
+    def test_long_numbers_are_cut(self):
+        self.assertMatchesRowByRow([
+            '05012345678901234567', '9665012345678901234', '12345678901234567890',
+            '+12345678901234567890', '1234567890123456', '123456789012345',
+        ])
+
+    def test_nulls(self):
+        self.assertMatchesRowByRow([None, np.nan, pd.NA, '', '   ', '0', '000', '+', '++'])
+
+    def test_non_digit_characters(self):
+        self.assertMatchesRowByRow([
+            '+966 50 123 4567', '(050) 123-4567', '+1 (415) 555-0100', '0044 20 7946 0958',
+            'abc', 'tel: 0501234567', '050-123-4567 ext. 12', '٠٥٠١٢٣٤٥٦٧', '05x01y23',
+        ])
+
+    def test_single_leading_digit(self):
+        self.assertMatchesRowByRow(['5', '9', '1', '05', '09'])
+
+    def test_repeats_and_cached_batches(self):
+        values = ['0501234567', None, '0501234567', '+966 50 123 4567', np.nan, 'abc', '0501234567']
+        self.assertMatchesRowByRow(values)
+        # Second batch is answered from the cache
+        self.assertMatchesRowByRow(values[::-1])
+
+    def test_keeps_index_and_name(self):
+        s = pd.Series(['0501234567', None], index=[10, 20], name='ContactNo', dtype=object)
+        actual = clean_contacts(s)
+        self.assertEqual(list(actual.index), [10, 20])
+        self.assertEqual(actual.name, 'ContactNo')
+
+    def test_random_numbers(self):
+        rng = np.random.default_rng(0)
+        alphabet = np.array(list('0123456789+ -()x'))
+        values = [''.join(rng.choice(alphabet, rng.integers(0, 22))) for _ in range(5000)]
+        self.assertMatchesRowByRow(values)
+        s = pd.Series(values, dtype=object)
+        self.assertTrue(normalize_contacts(s).equals(expected(s)))
+
+
+if __name__ == '__main__':
+    unittest.main()
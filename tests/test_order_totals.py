@@ -0,0 +1,61 @@
+import itertools
+import unittest
+import numpy as np
+import pandas as pd
+from utils.order_totals import reconcile_order_totals, _row_version
+
+COLUMNS = ['Subtotal', 'GrandTotal', 'ItemTaxTotal', 'AmountDueTotal', 'OrderDiscountTotal', 'OrderDiscountPercent']
+
+
+def orders(rows: list[tuple]) -> pd.DataFrame:
+    """Rows of (Subtotal, GrandTotal, ItemTaxTotal, OrderDiscountTotal, OrderDiscountPercent, AmountPaidTotal)."""
+    df = pd.DataFrame(rows, columns=['Subtotal', 'GrandTotal', 'ItemTaxTotal', 'OrderDiscountTotal', 'OrderDiscountPercent', 'AmountPaidTotal'], dtype=float)
+    df.insert(0, 'OldOrderID', np.arange(len(df)))
+    return df
+
+
+class ReconcileOrderTotalsTest(unittest.TestCase):
+    """reconcile_order_totals must give exactly what the row-wise fix_order_checkout apply gave."""
+
+    def assertMatchesRowByRow(self, df: pd.DataFrame):
+        expected = _row_version(df.copy())
+        actual = reconcile_order_totals(df.copy())
+        for col in COLUMNS:
+            e, a = expected[col].astype(float).to_numpy(), actual[col].to_numpy(dtype=float)
+            same = (e == a) | (np.isnan(e) & np.isnan(a))
+            self.assertTrue(same.all(), f'{col} differs:\n{pd.DataFrame({"expected": e, "actual": a}).join(df)[~same]}')
+
+    def test_every_branch(self):
+        # Each of Subtotal/GrandTotal/ItemTaxTotal zero or not (none, one or two derivable, all three
+        # zero), with and without a discount total and percent, paid or not
+        rows = list(itertools.product((0, 100), (0, 115.5), (0, 15.5), (0, 10), (0, 12.5), (0, 50)))
+        self.assertMatchesRowByRow(orders(rows))
+
+    def test_derived_subtotal_feeds_the_discount_rules(self):
+        self.assertMatchesRowByRow(orders([
+            (0, 115, 15, 0, 10, 0),         # Subtotal derived, then the discount total from the percent
+            (0, 115, 15, 20, 0, 0),         # Subtotal derived, then the percent from the discount total
+            (0, 0, 0, 20, 0, 0),            # nothing to derive, percent of a 0 Subtotal is 0
+            (0, 20, 0, 0, 10, 0),           # two zeros: left as they are
+            (-5, 10, 0, 0, 0, 30),          # negative amounts and an overpaid order
+        ]))
+
+    def test_nan_counts_as_non_zero(self):
+        self.assertMatchesRowByRow(orders([
+            (np.nan, 115, 0, 0, 0, 0),
+            (100, np.nan, 0, 0, 0, 0),
+            (0, 115, np.nan, 0, 0, 0),
+            (100, 0, 0, np.nan, 0, 0),
+            (100, 0, 0, 0, np.nan, 0),
+        ]))
+
+    def test_random_orders(self):
+        rng = np.random.default_rng(0)
+        rows = 5000
+        amounts = lambda: np.where(rng.random(rows) < 0.3, 0, rng.integers(0, 5000, rows) / 4)
+        df = orders(list(zip(amounts(), amounts(), amounts(), amounts(), np.where(rng.random(rows) < 0.6, 0, rng.integers(0, 100, rows)), amounts())))
+        self.assertMatchesRowByRow(df)
+
+
+if __name__ == '__main__':
+    unittest.main()
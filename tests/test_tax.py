@@ -0,0 +1,95 @@
+import unittest
+import numpy as np
+import pandas as pd
+from utils import tax
+from utils.order_totals import reconcile_order_totals
+from utils.tax import apply_order_tax
+
+# LocationID 1 is in a 15% country, 2 in a tax-free one, 3 has no known country
+COUNTRIES = pd.Series({10: 15.0, 20: 0.0})
+LOCATIONS = pd.Series({1: 10, 2: 20, 3: 30})
+
+
+def orders(*rows) -> pd.DataFrame:
+    """Rows of (LocationID, Subtotal, OrderDiscountTotal, ItemTaxTotal, GrandTotal)."""
+    df = pd.DataFrame(rows, columns=['LocationID', 'Subtotal', 'OrderDiscountTotal', 'ItemTaxTotal', 'GrandTotal'], dtype=float)
+    df['OrderDiscountPercent'] = 0.0
+    df['AmountPaidTotal'] = 0.0
+    return df
+
+
+def transform(df: pd.DataFrame, mode: str) -> pd.DataFrame:
+    """The order orders.transform applies them in."""
+    return reconcile_order_totals(apply_order_tax(df, engine=None, mode=mode))
+
+
+class ApplyOrderTaxTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cached = tax.RATES._countries, tax.RATES._locations
+        tax.RATES._countries, tax.RATES._locations = COUNTRIES, LOCATIONS
+
+    def tearDown(self):
+        tax.RATES._countries, tax.RATES._locations = self._cached
+
+    def assertTotals(self, df: pd.DataFrame, subtotal, tax_total, grand):
+        np.testing.assert_allclose(df['Subtotal'], subtotal)
+        np.testing.assert_allclose(df['ItemTaxTotal'], tax_total)
+        np.testing.assert_allclose(df['GrandTotal'], grand)
+        np.testing.assert_allclose(df['AmountDueTotal'], grand)
+
+    def test_off_keeps_v1_totals(self):
+        df = transform(orders((1, 100, 0, 0, 0), (1, 100, 10, 0, 90)), 'off')
+        self.assertTotals(df, [100, 100], [0, 0], [0, 90])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            apply_order_tax(orders((1, 100, 0, 0, 0)), engine=None, mode='some')
+
+    def test_backfill_taxes_orders_without_recorded_tax(self):
+        df = transform(orders(
+            (1, 100, 0, 0, 0),          # no tax and no GrandTotal
+            (1, 100, 20, 0, 95),        # no tax, GrandTotal shows some was charged
+            (2, 100, 0, 0, 0),          # tax-free country
+        ), 'backfill')
+        self.assertTotals(df, [100, 100, 100], [15, 12, 0], [115, 92, 100])
+
+    def test_backfill_keeps_orders_that_add_up(self):
+        df = transform(orders(
+            (1, 100, 0, 0, 100),        # tax-free in V1
+            (1, 100, 0, 15, 115),
+            (1, 100, 10, 5, 95),        # recorded tax at another rate
+        ), 'backfill')
+        self.assertTotals(df, [100, 100, 100], [0, 15, 5], [100, 115, 95])
+
+    def test_backfill_leaves_recorded_tax_and_missing_subtotal(self):
+        df = transform(orders(
+            (1, 100, 0, 7, 120),        # recorded tax, totals off: only all recomputes
+            (1, 0, 0, 15, 115),         # Subtotal missing: reconcile derives it
+            (1, 0, 0, 0, 115),
+        ), 'backfill')
+        self.assertTotals(df, [100, 100, 0], [7, 15, 0], [120, 115, 115])
+
+    def test_backfill_skips_unknown_rate(self):
+        df = transform(orders((3, 100, 0, 0, 0), (np.nan, 100, 0, 0, 0)), 'backfill')
+        self.assertTotals(df, [100, 100], [0, 0], [0, 0])
+
+    def test_all_recomputes_totals_that_do_not_add_up(self):
+        df = transform(orders(
+            (1, 100, 0, 7, 120),
+            (1, 100, 0, 0, 0),
+            (1, 100, 0, 15, 115),
+        ), 'all')
+        self.assertTotals(df, [100, 100, 100], [15, 15, 15], [115, 115, 115])
+
+    def test_all_leaves_what_reconcile_derives(self):
+        df = transform(orders(
+            (1, 0, 0, 15, 115),         # Subtotal missing
+            (1, 100, 0, 15, 0),         # GrandTotal missing
+            (1, 200, 0, 0, 0),          # two missing: taxed
+        ), 'all')
+        self.assertTotals(df, [100, 100, 200], [15, 15, 30], [115, 115, 230])
+
+
+if __name__ == '__main__':
+    unittest.main()
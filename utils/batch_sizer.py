@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+from utils.tools import get_logger, get_state_dir
+
+log = get_logger('BatchSizer')
+
+# Defaults, overridable from .env
+MIN_SIZE = int(os.getenv('ETL_BATCH_MIN', 100))
+MAX_SIZE = int(os.getenv('ETL_BATCH_MAX', 50000))
+TARGET_SECONDS = float(os.getenv('ETL_BATCH_TARGET_SECONDS', 5))    # wall time of the slowest stage per batch
+MAX_MEMORY_MB = float(os.getenv('ETL_BATCH_MAX_MEMORY_MB', 512))    # transformed frame size per batch
+
+
+
+class BatchSizer:
+    """
+    Adapts a table's batch size to measured per-row costs. The slowest of extract, transform and
+    load should take about target_seconds per batch (that stage bounds the pipeline's throughput),
+    and the transformed frame must stay under max_memory_mb. The size moves at most 2x per batch,
+    stays within [min_size, max_size], and it is saved per table after every successful load so
+    the next run starts from the last good size.
+    """
+
+    def __init__(self, table: str, initial: int, min_size: int = MIN_SIZE, max_size: int = MAX_SIZE,
+                 target_seconds: float = TARGET_SECONDS, max_memory_mb: float = MAX_MEMORY_MB, smoothing: float = 0.5):
+        self.table = table
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.smoothing = smoothing
+        self.costs: dict[str, float] = {}        # seconds per row, per stage
+        self.bytes_per_row = 0.0
+        self._lock = threading.Lock()
+        self.path = get_state_dir('batch_sizes') / f'{table}.json'
+        self.size = self._clamp(self._saved() or initial)
+        log.info(f'Batch size for {table}: {self.size}')
+
+    def _saved(self) -> int | None:
+        try:
+            return int(json.loads(self.path.read_text())['size'])
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _clamp(self, size: float) -> int:
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def _observe(self, stage: str, rows: int, seconds: float):
+        if rows <= 0:
+            return
+        cost = seconds / rows
+        previous = self.costs.get(stage)
+        self.costs[stage] = cost if previous is None else self.smoothing * cost + (1 - self.smoothing) * previous
+
+    def _resize(self):
+        ideal = self.target_seconds / max(self.costs.values()) if self.costs and max(self.costs.values()) > 0 else self.max_size
+        if self.bytes_per_row:
+            ideal = min(ideal, self.max_memory / self.bytes_per_row)
+        size = self._clamp(max(self.size / 2, min(self.size * 2, ideal)))
+        if size != self.size:
+            log.info(f'Batch size for {self.table}: {self.size} -> {size}')
+        self.size = size
+
+    def record_extract(self, rows: int, seconds: float):
+        with self._lock:
+            self._observe('extract', rows, seconds)
+            self._resize()
+
+    def record(self, rows: int, transform_seconds: float, load_seconds: float, memory_bytes: int = 0):
+        """Called after a batch has loaded successfully."""
+        with self._lock:
+            self._observe('transform', rows, transform_seconds)
+            self._observe('load', rows, load_seconds)
+            if rows and memory_bytes:
+                self.bytes_per_row = memory_bytes / rows
+            self._resize()
+            self.path.write_text(json.dumps({'size': self.size, 'costs': self.costs, 'bytes_per_row': self.bytes_per_row}))
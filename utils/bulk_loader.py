@@ -0,0 +1,275 @@
+import os
+import time
+import uuid
+import datetime as dt
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text, Connection
+from utils.tools import get_logger, get_state_dir
+
+log = get_logger('BulkLoader')
+
+# Load modes
+DEFAULT = 'default'             # DataFrame.to_sql as is
+EXECUTEMANY = 'executemany'     # one DBAPI executemany per frame, with pyodbc's fast_executemany (parameter arrays)
+MULTIROW = 'multirow'           # INSERT ... VALUES (...), (...) with as many rows per statement as the parameter limit allows
+BULK = 'bulk'                   # CSV file -> BULK INSERT into a #staging table -> INSERT ... SELECT (SQL Server only)
+
+MODES = (DEFAULT, EXECUTEMANY, MULTIROW, BULK)
+
+# Mode for every table, overridable per table with ETL_LOAD_MODE_<TABLE>, e.g. ETL_LOAD_MODE_ORDERLINEITEMS=bulk;
+# to_sql as before unless a faster mode is opted into (not yet checked against SQL Server)
+LOAD_MODE = os.getenv('ETL_LOAD_MODE', DEFAULT)
+
+# Where bulk mode writes its CSV files, and the same folder as SQL Server sees it (a share, or a path
+# inside ETL_BULK_DATA_SOURCE, the external data source Azure SQL reads blobs through)
+BULK_DIR = os.getenv('ETL_BULK_DIR')
+BULK_SERVER_DIR = os.getenv('ETL_BULK_SERVER_DIR')
+BULK_DATA_SOURCE = os.getenv('ETL_BULK_DATA_SOURCE')
+
+# Bind parameters per statement (SQL Server 2100, SQLite 999 on older builds); a VALUES list takes at most 1000 rows
+MAX_PARAMS = {'mssql': 2100, 'sqlite': 999}
+MAX_VALUES_ROWS = 1000
+
+
+
+def load_mode(table: str) -> str:
+    mode = os.getenv(f'ETL_LOAD_MODE_{table.upper()}', LOAD_MODE)
+    if mode not in MODES:
+        raise ValueError(f'Unknown load mode {mode!r} for {table}, expected one of {MODES}')
+    return mode
+
+
+def rows_per_statement(dialect: str, columns: int) -> int:
+    """Rows per multi-row INSERT that keep it under the dialect's bind parameter limit."""
+    return max(1, min(MAX_VALUES_ROWS, (MAX_PARAMS.get(dialect, 999) - 1) // max(columns, 1)))
+
+
+def _full_name(conn: Connection, schema: str | None, table: str) -> str:
+    quote = conn.dialect.identifier_preparer.quote
+    return f'{quote(schema)}.{quote(table)}' if schema else quote(table)
+
+
+def _insert_prefix(pd_table, conn: Connection, keys: list[str]) -> str:
+    quote = conn.dialect.identifier_preparer.quote
+    return f"INSERT INTO {_full_name(conn, pd_table.schema, pd_table.name)} ({', '.join(quote(k) for k in keys)}) VALUES "
+
+
+# pandas' to_sql method hooks: both run on the raw DBAPI cursor (qmark parameters, as pyodbc and
+# sqlite3 take them), which stays inside the caller's transaction
+def _executemany(pd_table, conn: Connection, keys: list[str], data_iter) -> int:
+    rows = list(data_iter)
+    cursor = conn.connection.dbapi_connection.cursor() # type: ignore
+    try:
+        if conn.dialect.name == 'mssql':
+            cursor.fast_executemany = True
+        cursor.executemany(_insert_prefix(pd_table, conn, keys) + f"({', '.join('?' * len(keys))})", rows)
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+def _multirow(pd_table, conn: Connection, keys: list[str], data_iter) -> int:
+    rows = list(data_iter)
+    per_statement = rows_per_statement(conn.dialect.name, len(keys))
+    prefix = _insert_prefix(pd_table, conn, keys)
+    row = f"({', '.join('?' * len(keys))})"
+    cursor = conn.connection.dbapi_connection.cursor() # type: ignore
+    try:
+        for i in range(0, len(rows), per_statement):
+            chunk = rows[i:i + per_statement]
+            cursor.execute(prefix + ', '.join([row] * len(chunk)), [value for r in chunk for value in r])
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+# -------------------- Bulk (CSV) --------------------
+def _csv_number(x) -> str:
+    text = repr(float(x)) if isinstance(x, (float, np.floating)) else str(x)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def _csv_value(x) -> str:
+    # FORMAT='CSV' reads an unquoted empty field as NULL and "" as an empty string
+    if x is None or x is pd.NA or x is pd.NaT or (isinstance(x, float) and np.isnan(x)):
+        return ''
+    if isinstance(x, str):
+        return '"' + x.replace('"', '""') + '"'
+    if isinstance(x, (bool, np.bool_)):
+        return '1' if x else '0'
+    if isinstance(x, dt.datetime):
+        return x.isoformat(sep=' ', timespec='milliseconds')
+    if isinstance(x, dt.date):
+        return x.isoformat()
+    if isinstance(x, (int, float, np.integer, np.floating)):
+        return _csv_number(x)
+    return '"' + str(x).replace('"', '""') + '"'
+
+
+def _csv_column(s: pd.Series) -> np.ndarray:
+    if pd.api.types.is_datetime64_any_dtype(s):
+        text = s.dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:-3]
+        return text.astype(object).where(s.notna(), '').to_numpy()
+    if pd.api.types.is_bool_dtype(s):
+        return np.where(s.isna(), '', np.where(s.fillna(False).astype(bool), '1', '0')).astype(object)
+    if pd.api.types.is_integer_dtype(s):
+        return np.array(['' if x is pd.NA else str(x) for x in s.astype(object)], dtype=object)
+    if pd.api.types.is_float_dtype(s):
+        return np.array(['' if x != x else _csv_number(x) for x in s.to_numpy(dtype=float)], dtype=object)
+    return np.array([_csv_value(x) for x in s.to_numpy(dtype=object)], dtype=object)
+
+
+def to_csv_text(df: pd.DataFrame) -> str:
+    """df as CSV for BULK INSERT ... WITH (FORMAT='CSV'): no header, nulls as empty fields, text always quoted."""
+    if df.empty:
+        return ''
+    rows = _csv_column(df.iloc[:, 0])
+    for i in range(1, len(df.columns)):
+        rows = rows + ',' + _csv_column(df.iloc[:, i])
+    return '\n'.join(rows) + '\n'
+
+
+def _create_stage(conn: Connection, stage: str, target: str, columns: str):
+    # Staging table with the target's column types in df's column order, which BULK INSERT maps by position
+    conn.execute(text(f"IF OBJECT_ID('tempdb..{stage}') IS NOT NULL DROP TABLE {stage}"))
+    conn.execute(text(f"SELECT TOP 0 {columns} INTO {stage} FROM {target}"))
+
+
+def _bulk_copy(df: pd.DataFrame, conn: Connection, stage: str, name: str):
+    directory = Path(BULK_DIR) if BULK_DIR else get_state_dir('bulk')
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{name}-{uuid.uuid4().hex}.csv'
+    server_path = f'{BULK_SERVER_DIR.rstrip('/\\')}/{path.name}' if BULK_SERVER_DIR else str(path.resolve())
+    options = "FORMAT = 'CSV', CODEPAGE = '65001', ROWTERMINATOR = '0x0a', KEEPNULLS, TABLOCK"
+    if BULK_DATA_SOURCE:
+        options += f", DATA_SOURCE = '{BULK_DATA_SOURCE}'"
+
+    try:
+        path.write_text(to_csv_text(df), encoding='utf-8', newline='\n')
+        conn.execute(text(f"BULK INSERT {stage} FROM '{server_path}' WITH ({options})"))
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def _bulk_insert(df: pd.DataFrame, conn: Connection, table: str, schema: str | None):
+    quote = conn.dialect.identifier_preparer.quote
+    target = _full_name(conn, schema, table)
+    stage = f'#etl_stage_{table}'
+    columns = ', '.join(quote(c) for c in df.columns)
+
+    _create_stage(conn, stage, target, columns)
+    _bulk_copy(df, conn, stage, f'{schema}.{table}')
+    conn.execute(text(f"INSERT INTO {target} ({columns}) SELECT {columns} FROM {stage}"))
+    conn.execute(text(f"DROP TABLE {stage}"))
+
+
+# -------------------- Staging --------------------
+def _records(df: pd.DataFrame) -> list[tuple]:
+    # Plain Python values with None for nulls, as to_sql hands them to the method hooks
+    values = df.astype(object).where(df.notna(), None)
+    for col in df.columns[[pd.api.types.is_datetime64_any_dtype(t) for t in df.dtypes]]:
+        values[col] = pd.Series(df[col].dt.to_pydatetime(), index=df.index, dtype=object).where(df[col].notna(), None)
+    return list(values.itertuples(index=False, name=None))
+
+
+def stage_frame(df: pd.DataFrame, conn: Connection, table: str, schema: str = 'app') -> str:
+    """
+    Copies df into a session temp table shaped like schema.table (SQL Server), with BULK INSERT in
+    bulk mode and one executemany otherwise, for set-based statements (MERGE, UPDATE ... FROM) that
+    read from it. Returns the temp table's name; the caller drops it.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    stage = f'#etl_stage_{table}'
+    columns = ', '.join(quote(c) for c in df.columns)
+    _create_stage(conn, stage, _full_name(conn, schema, table), columns)
+    if load_mode(table) == BULK:
+        _bulk_copy(df, conn, stage, f'{schema}.{table}')
+    elif not df.empty:
+        cursor = conn.connection.dbapi_connection.cursor() # type: ignore
+        try:
+            cursor.fast_executemany = True
+            cursor.executemany(f"INSERT INTO {stage} ({columns}) VALUES ({', '.join('?' * len(df.columns))})", _records(df))
+        finally:
+            cursor.close()
+    return stage
+
+
+# -------------------- Entry point --------------------
+def load_frame(df: pd.DataFrame, conn: Connection, table: str, schema: str | None = 'app', dtype: dict | None = None, mode: str | None = None) -> int:
+    """
+    Appends df to schema.table inside the caller's transaction, with the table's load mode (see
+    load_mode) unless mode is given. Bulk mode needs SQL Server; elsewhere it falls back to multirow.
+    dtype only matters for the modes that go through to_sql, when the table does not exist yet.
+    """
+    mode = mode or load_mode(table)
+    dialect = conn.dialect.name
+    if mode == BULK and dialect != 'mssql':
+        log.warning(f'Bulk load needs SQL Server, loading {table} with {MULTIROW} on {dialect}')
+        mode = MULTIROW
+
+    start = time.perf_counter()
+    if mode == BULK:
+        _bulk_insert(df, conn, table, schema)
+    elif mode == EXECUTEMANY:
+        df.to_sql(table, con=conn, schema=schema, if_exists='append', index=False, dtype=dtype, method=_executemany, chunksize=100_000) # type: ignore
+    elif mode == MULTIROW:
+        df.to_sql(table, con=conn, schema=schema, if_exists='append', index=False, dtype=dtype, method=_multirow, chunksize=100_000) # type: ignore
+    else:
+        df.to_sql(table, con=conn, schema=schema, if_exists='append', index=False, dtype=dtype) # type: ignore
+    log.info(f'Loaded {len(df)} rows into {schema}.{table} ({mode}) in {time.perf_counter() - start:.2f}s')
+    return len(df)
+
+
+# -------------------- Benchmark --------------------
+def _sample(rows: int) -> pd.DataFrame:
+    """OrderLineItems-shaped frame."""
+    rng = np.random.default_rng(0)
+    notes = np.array(['', None, 'extra "wax"', 'تغيير زيت', 'a,b'], dtype=object)
+    return pd.DataFrame({
+        'OrderID': rng.integers(1, rows // 3, rows),
+        'ItemID': rng.integers(1, 5000, rows),
+        'PackageID': pd.array(np.where(rng.random(rows) < 0.2, None, rng.integers(1, 300, rows)), dtype='Int64'),
+        'Quantity': rng.integers(1, 5, rows).astype(float),
+        'UnitPrice': rng.integers(100, 100_000, rows) / 100,
+        'DiscountAmount': np.where(rng.random(rows) < 0.7, 0, rng.integers(0, 5000, rows) / 100),
+        'TaxAmount': rng.integers(0, 2000, rows) / 100,
+        'GrandTotal': rng.integers(100, 100_000, rows) / 100,
+        'IsFreeItem': rng.random(rows) < 0.05,
+        'Notes': notes[rng.integers(0, len(notes), rows)],
+        'UpdatedAt': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 10**9, rows), unit='ms'),
+        'OldOrderDetailID': np.arange(rows),
+    })
+
+
+def bench(rows: int = 200_000):
+    """Times each mode into a local SQLite stand-in target and checks the loaded rows come back the same."""
+    import tempfile
+    import warnings
+    warnings.filterwarnings('ignore', category=DeprecationWarning)     # sqlite3's default datetime adapter
+    df = _sample(rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f'sqlite:///{tmp}/target.db')
+        for mode in (DEFAULT, EXECUTEMANY, MULTIROW):
+            table = f'OrderLineItems_{mode}'
+            with engine.begin() as conn:
+                df.head(0).to_sql(table, con=conn, index=False)
+            start = time.perf_counter()
+            with engine.begin() as conn:
+                load_frame(df, conn, table, schema=None, mode=mode)
+            elapsed = time.perf_counter() - start
+            back = pd.read_sql(f'SELECT * FROM "{table}" ORDER BY OldOrderDetailID', engine)
+            same = len(back) == rows and back['GrandTotal'].sum() == df['GrandTotal'].sum() and \
+                back['Notes'].tolist() == df['Notes'].tolist()
+            print(f'{mode:>12}: {rows:,} rows in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s), round trip ok: {same}')
+        engine.dispose()
+
+    start = time.perf_counter()
+    to_csv_text(df)
+    print(f'{BULK:>12}: CSV staging file built in {time.perf_counter() - start:.2f}s (BULK INSERT itself needs SQL Server)')
+
+
+if __name__ == '__main__':
+    import sys
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -0,0 +1,90 @@
+import os
+import threading
+from sqlalchemy import text, event, Engine, Connection
+from utils.tools import get_logger
+from utils.id_snapshot import target_tag
+
+log = get_logger('CDC')
+
+# Watermark table, one row (TableName, MaxIndex) per migrated source table. Modules spelled it both
+# app.EtlCDC and app.ETLcdc (the same table under SQL Server's default collation); this is the one name
+CDC_TABLE = os.getenv('ETL_CDC_TABLE', 'app.EtlCDC')
+
+_PENDING = 'etl_watermarks'
+
+
+class WatermarkStore:
+    """
+    Every table's watermark, read from CDC_TABLE in one query the first time a process needs one and
+    kept in memory from then on. Writes go into the caller's load transaction (one MERGE, no reads)
+    and reach the in-memory copy only after the database COMMIT returned, so a batch whose
+    transaction rolled back or failed to commit is extracted again.
+    """
+
+    def __init__(self):
+        self._marks: dict[str, dict[str, int]] = {}      # target tag -> TableName -> MaxIndex
+        self._lock = threading.Lock()
+
+    def _load(self, engine: Engine) -> dict[str, int]:
+        key = target_tag(engine.url)
+        with self._lock:
+            if key not in self._marks:
+                with engine.connect() as conn:
+                    rows = conn.execute(text(f"SELECT TableName, COALESCE(MaxIndex, 0) FROM {CDC_TABLE}")).all()
+                self._marks[key] = {name: int(mark) for name, mark in rows}
+                self._apply_after_commit(engine)
+                event.listen(engine, 'rollback', self._on_rollback)
+                log.info(f'Loaded {len(rows)} watermarks from {CDC_TABLE}')
+            return self._marks[key]
+
+    def get(self, engine: Engine, table_name: str, default: int | None = 0) -> int | None:
+        return self._load(engine).get(table_name, default)
+
+    def write(self, conn: Connection, table_name: str, max_index: int):
+        self._load(conn.engine)
+        conn.execute(
+            text(f"""
+                MERGE {CDC_TABLE} AS target
+                USING (SELECT :table_name AS [TableName], :max_index AS [MaxIndex]) AS source
+                ON target.[TableName] = source.[TableName]
+                WHEN MATCHED THEN UPDATE SET target.[MaxIndex] = source.[MaxIndex]
+                WHEN NOT MATCHED THEN INSERT ([TableName],[MaxIndex]) VALUES (source.[TableName],source.[MaxIndex]);
+            """),
+            {"table_name": table_name, "max_index": int(max_index)}
+        )
+        conn.info.setdefault(_PENDING, {})[table_name] = int(max_index)
+
+    def _apply_after_commit(self, engine: Engine):
+        # The 'commit' event fires before the DBAPI commit, so a COMMIT that fails would still move
+        # the marks; the engine's dialect.do_commit is wrapped instead, and the marks pending on the
+        # connection are applied once it returned (and dropped when it raised)
+        dialect = engine.dialect
+        if getattr(dialect, _PENDING, False):
+            return
+        key, do_commit = target_tag(engine.url), dialect.do_commit
+
+        def commit_then_apply(dbapi_connection):
+            pending = dbapi_connection.info.pop(_PENDING, None)
+            do_commit(dbapi_connection)
+            if pending:
+                with self._lock:
+                    self._marks[key].update(pending)
+
+        dialect.do_commit = commit_then_apply
+        setattr(dialect, _PENDING, True)
+
+    def _on_rollback(self, conn: Connection):
+        conn.info.pop(_PENDING, None)
+
+
+WATERMARKS = WatermarkStore()
+
+
+def get_watermark(engine: Engine, table_name: str, default: int | None = 0) -> int | None:
+    """Last loaded key of a source table (default if it was never loaded)."""
+    return WATERMARKS.get(engine, table_name, default)
+
+
+def write_watermark(conn: Connection, table_name: str, max_index: int):
+    """Moves a source table's watermark inside the caller's transaction."""
+    WATERMARKS.write(conn, table_name, max_index)
@@ -0,0 +1,228 @@
+"""
+Re-applies V1 edits of already migrated rows. Only the tasks that call sync_changes pick them up:
+accounts (dbo.Users), cars (dbo.Cars) and orders (dbo.Orders, with its OrderCheckout and
+OrderDetail rows). Every other task only loads new rows past its key watermark, so edits made in V1
+after a row was migrated do not reach V2 for those tables.
+"""
+import os
+import time
+from functools import lru_cache
+from typing import Callable
+import pandas as pd
+from sqlalchemy import text, Engine, Connection
+from utils.tools import get_logger
+from utils.cdc import get_watermark, write_watermark
+from utils.bulk_loader import stage_frame
+from utils.extractor import stream_batches
+from utils.fks_mapper import IdMapCache
+
+log = get_logger('ChangeSync')
+
+# Set to 0 to only migrate new rows (the ID > MaxIndex CDC) and skip re-applying edited ones
+SYNC_CHANGES = os.getenv('ETL_SYNC_CHANGES', '1') == '1'
+# Source rows per changed-rows batch
+CHANGE_BATCH_SIZE = int(os.getenv('ETL_CHANGE_BATCH_SIZE', 10000))
+# Last-edit dates are re-read this far back from the change watermark: a V1 transaction can stamp a
+# date, then commit after the sync read the max. Must exceed V1's longest write transaction
+CHANGE_OVERLAP_SECONDS = int(os.getenv('ETL_CHANGE_OVERLAP_SECONDS', 300))
+
+# V1 spells the last-edit column both ways; a rowversion column, where a table has one, is used instead
+CHANGE_COLUMNS = ['LastUpdatedDate', 'LastUpdateDT']
+# Last-edit columns stored as text cannot be compared in SQL and are not used
+DATE_TYPES = ('datetime', 'datetime2', 'smalldatetime', 'datetimeoffset', 'date')
+
+ROWVERSION = 'rowversion'
+DATETIME = 'datetime'
+
+# The change watermark is a second CDC row per table, named after the key watermark
+_SUFFIX = ':changes'
+
+
+
+@lru_cache(maxsize=None)
+def change_column(engine: Engine, table: str) -> tuple[str, str] | None:
+    """(column, kind) that tracks edits of a source table: its rowversion if it has one, else its last-edit date."""
+    schema, name = table.split('.')
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=:schema AND TABLE_NAME=:name"),
+            {"schema": schema, "name": name}
+        ).all()
+    types = {column.lower(): (column, data_type.lower()) for column, data_type in rows}
+    # INFORMATION_SCHEMA reports rowversion columns as timestamp
+    for column, data_type in types.values():
+        if data_type in ('timestamp', 'rowversion'):
+            return column, ROWVERSION
+    for candidate in CHANGE_COLUMNS:
+        if candidate.lower() in types and types[candidate.lower()][1] in DATE_TYPES:
+            return types[candidate.lower()][0], DATETIME
+    return None
+
+
+# Watermarks are BIGINT: a rowversion as its 8 bytes, a date as epoch milliseconds
+def _encode(value, kind: str) -> int:
+    if kind == ROWVERSION:
+        return int.from_bytes(value, 'big')
+    return int(pd.Timestamp(value).value // 1_000_000)
+
+
+def _literal(mark: int, kind: str) -> str:
+    if kind == ROWVERSION:
+        return f'0x{mark:016X}'
+    return "'" + pd.Timestamp(mark, unit='ms').strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + "'"
+
+
+def merge_sql(target: str, stage: str, key: str, columns: list[str], exclude: tuple[str, ...] = ()) -> str:
+    """MERGE of a staged frame into target on key: matched rows get every column but key and exclude, new keys are inserted."""
+    skip = {key.lower(), *(c.lower() for c in exclude)}
+    updates = ', '.join(f't.[{c}] = s.[{c}]' for c in columns if c.lower() not in skip)
+    names = ', '.join(f'[{c}]' for c in columns)
+    values = ', '.join(f's.[{c}]' for c in columns)
+    return f"""
+        MERGE {target} AS t
+        USING {stage} AS s
+        ON t.[{key}] = s.[{key}]
+        WHEN MATCHED THEN UPDATE SET {updates}
+        WHEN NOT MATCHED BY TARGET THEN INSERT ({names}) VALUES ({values})
+        OUTPUT $action;
+    """
+
+
+def merge_frame(df: pd.DataFrame, conn: Connection, table: str, key: str, schema: str = 'app', exclude: tuple[str, ...] = ()) -> tuple[int, int]:
+    """
+    Upserts df into schema.table inside the caller's transaction: the frame is staged in a temp table
+    and applied with one MERGE keyed on key (the Old*ID column). Returns (updated, inserted).
+    """
+    # MERGE rejects two source rows for one target row
+    df = df.drop_duplicates(subset=key, keep='last')
+    stage = stage_frame(df, conn, table, schema)
+    try:
+        actions = conn.execute(text(merge_sql(f'{schema}.{table}', stage, key, list(df.columns), exclude))).scalars().all()
+    finally:
+        conn.execute(text(f"DROP TABLE {stage}"))
+    return actions.count('UPDATE'), actions.count('INSERT')
+
+
+class _Window:
+    """One tracked table's edits since its change watermark: the rows to read and the mark to store after."""
+
+    def __init__(self, name: str, column: str, kind: str, since: int, until: int):
+        self.name, self.column, self.kind, self.since, self.until = name, column, kind, since, until
+
+    def condition(self) -> str:
+        # Only last-edit dates are re-read with an overlap (CHANGE_OVERLAP_SECONDS)
+        low = self.since - CHANGE_OVERLAP_SECONDS * 1000 if self.kind == DATETIME else self.since
+        return f"[{self.column}] > {_literal(low, self.kind)} AND [{self.column}] <= {_literal(self.until, self.kind)}"
+
+    def describe(self) -> str:
+        return f'{self.name} ({self.column}) at {_literal(self.until, self.kind)}'
+
+
+def _change_window(source_db: Engine, target_db: Engine, table: str, link: str, max_key: int, name: str) -> _Window | None:
+    """
+    Edits of table (rows whose link column is at or below max_key) since the change watermark name.
+    None when the table tracks no edits, nothing changed, or on the first run, which only records
+    the current max as the watermark.
+    """
+    tracked = change_column(source_db, table)
+    if tracked is None:
+        log.info(f'{table} has no rowversion or last-edit date column; its edits are not synced')
+        return None
+    column, kind = tracked
+
+    since = get_watermark(target_db, name, default=None)
+    with source_db.connect() as conn:
+        latest = conn.execute(text(f"SELECT MAX([{column}]) FROM {table} WHERE {link} <= :max_key"), {'max_key': max_key}).scalar()
+        # A rowversion is assigned at write time, not at commit: a transaction still open with a lower
+        # value than the max would commit behind the watermark, so the window ends below the oldest
+        # one still in flight
+        active = conn.execute(text("SELECT MIN_ACTIVE_ROWVERSION()")).scalar() if kind == ROWVERSION else None
+    if latest is None:
+        return None
+    until = _encode(latest, kind)
+    if active is not None:
+        until = min(until, _encode(active, kind) - 1)
+
+    if since is None:
+        with target_db.begin() as conn:
+            write_watermark(conn, name, until)
+        log.info(f'Change watermark {name} ({column}) started at {_literal(until, kind)}')
+        return None
+    if until <= since:
+        log.info(f'No edited rows in {table} since {_literal(since, kind)}')
+        return None
+    return _Window(name, column, kind, since, until)
+
+
+def sync_changes(
+    source_db: Engine,
+    target_db: Engine,
+    source_table: str,
+    source_key: str,
+    transform: Callable[[pd.DataFrame], pd.DataFrame],
+    table: str,
+    key: str,
+    columns: str = '*',
+    where: str | None = None,
+    exclude: tuple[str, ...] = ('CreatedAt',),
+    cache: IdMapCache | None = None,
+    batch_size: int = CHANGE_BATCH_SIZE,
+    related: tuple[tuple[str, str], ...] = (),
+) -> int:
+    """
+    Re-applies V1 rows edited since the last sync to app.table. Only rows at or below the key
+    watermark are read (newer ones belong to the insert CDC), with the table's rowversion or
+    last-edit column in (change watermark, max at start], in key-ordered batches; each batch goes
+    through the module's transform and one staged MERGE on key. For last-edit dates the window
+    starts CHANGE_OVERLAP_SECONDS before the watermark, so a row stamped before the previous sync
+    read the max but committed after it is still picked up (re-merging the others is harmless);
+    for rowversions it ends below MIN_ACTIVE_ROWVERSION(), so uncommitted writes wait for the next sync.
+    related lists (child table, column holding source_key) pairs whose edits also change the
+    migrated row, e.g. an order's checkout rows; each has its own change watermark, and a parent is
+    re-read when it or any of its children changed. The change watermarks move to the max only
+    after every batch committed, so an interrupted sync repeats (the MERGE is idempotent).
+    The first run only records the current max, as the insert path has just migrated those rows.
+    Returns the number of rows merged.
+    """
+    if not SYNC_CHANGES:
+        return 0
+
+    max_key = get_watermark(target_db, source_table)
+    windows, conditions = [], []
+    for tracked_table, link in ((source_table, source_key), *related):
+        name = source_table + _SUFFIX if tracked_table == source_table else f'{source_table}{_SUFFIX}:{tracked_table}'
+        window = _change_window(source_db, target_db, tracked_table, link, max_key, name)
+        if window is None:
+            continue
+        windows.append(window)
+        if tracked_table == source_table:
+            conditions.append(window.condition())
+        else:
+            conditions.append(f"{source_key} IN (SELECT {link} FROM {tracked_table} WHERE {window.condition()})")
+    if not windows:
+        return 0
+
+    condition = f"{source_key} <= {int(max_key)} AND ({' OR '.join(f'({c})' for c in conditions)})"
+    if where:
+        condition += f" AND {where}"
+
+    start = time.perf_counter()
+    updated = inserted = 0
+    for df in stream_batches(source_db, source_table, source_key, 0, columns, condition, batch_size):
+        df = transform(df)
+        if df.empty:
+            continue
+        with target_db.begin() as conn:
+            u, i = merge_frame(df, conn, table, key, exclude=exclude)
+            rows = cache.fetch_inserted(conn) if cache is not None and i else None
+        if cache is not None:
+            cache.absorb(rows)
+        updated += u
+        inserted += i
+
+    with target_db.begin() as conn:
+        for window in windows:
+            write_watermark(conn, window.name, window.until)
+    log.info(f'Synced edited {source_table} rows into app.{table} in {time.perf_counter() - start:.2f}s: '
+             f'{updated} updated, {inserted} inserted; change watermarks {", ".join(w.describe() for w in windows)}')
+    return updated + inserted
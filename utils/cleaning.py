@@ -0,0 +1,103 @@
+import time
+import numpy as np
+import pandas as pd
+
+# Per-column policies
+STRIP = 'strip'             # strip strings, keep everything else (None, '', non-strings) as is
+EMPTY = 'empty'             # strip strings, anything that is not a string becomes ''
+NULL_BLANK = 'null_blank'   # strip strings, blanks and non-strings become None
+NULL_TEXT = 'null_text'     # as NULL_BLANK, and the literal text 'NULL' becomes None too
+SKIP = 'skip'               # leave the column alone
+
+POLICIES = (STRIP, EMPTY, NULL_BLANK, NULL_TEXT, SKIP)
+TEXT_DTYPES = ['object', 'string']
+
+
+
+def _clean_objects(values: np.ndarray, policy: str) -> list:
+    # One fused pass per column; without Arrow, pandas' .str methods loop over the same Python
+    # strings anyway, so this is the fastest way to apply all the rules at once
+    if policy == STRIP:
+        return [x.strip() if isinstance(x, str) else x for x in values]
+    if policy == EMPTY:
+        return [x.strip() if isinstance(x, str) else '' for x in values]
+    if policy == NULL_BLANK:
+        return [(x.strip() or None) if isinstance(x, str) else None for x in values]
+    return [(y if (y := x.strip()) and y != 'NULL' else None) if isinstance(x, str) else None for x in values]
+
+
+def clean_series(s: pd.Series, policy: str = NULL_BLANK) -> pd.Series:
+    """
+    Applies one cleaning policy to a text column in a single pass. Arrow-backed string columns run on
+    Arrow compute kernels and keep their dtype (NA for nulls); object and Python-backed string columns
+    come back as object with None, like the per-element lambdas they replace.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown cleaning policy {policy!r} for {s.name}')
+    if policy == SKIP:
+        return s
+
+    if s.dtype == object or getattr(s.dtype, 'storage', None) == 'python':
+        return pd.Series(_clean_objects(s.to_numpy(), policy), index=s.index, name=s.name, dtype=object)
+
+    stripped = s.str.strip()
+    if policy == STRIP:
+        return stripped
+    if policy == EMPTY:
+        return stripped.fillna('')
+    drop = stripped.eq('')
+    if policy == NULL_TEXT:
+        drop |= stripped.eq('NULL')
+    return stripped.mask(drop.fillna(False))
+
+
+def clean_strings(df: pd.DataFrame, default: str = NULL_BLANK, policies: dict[str, str] | None = None) -> pd.DataFrame:
+    """
+    Cleans every text column of df in place (and returns it): the default policy for all of them,
+    overridden per column by policies, e.g. clean_strings(df, NULL_BLANK, {'Name': STRIP}).
+    """
+    policies = policies or {}
+    for col in df.select_dtypes(include=TEXT_DTYPES).columns:
+        df[col] = clean_series(df[col], policies.get(col, default))
+    return df
+
+
+# -------------------- Benchmark --------------------
+def _sample(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    values = np.array(['  Al Khobar ', 'Riyadh', '', '   ', 'NULL', None, ' NULL ', 'Toyota Camry  '], dtype=object)
+    low = {f'c{i}': values[rng.integers(0, len(values), rows)] for i in range(2)}
+    # plus one high-cardinality column (emails, phone numbers, plates)
+    unique = np.array([f' user{i}@example.com ' for i in range(rows)], dtype=object)
+    unique[rng.random(rows) < 0.2] = None
+    return pd.DataFrame({**low, 'email': unique})
+
+
+def _same(expected: pd.Series, actual: pd.Series) -> bool:
+    return expected.astype(object).where(expected.notna(), None).equals(actual.astype(object).where(actual.notna(), None))
+
+
+def bench(rows: int = 1_000_000):
+    """Times the per-element lambdas the transforms used against clean_strings, and checks they agree."""
+    for dtype in ('object', 'string'):
+        df = _sample(rows).astype(dtype)
+
+        start = time.perf_counter()
+        expected = df.copy()
+        for col in expected.columns:
+            expected[col] = expected[col].apply(lambda x: x.strip() if isinstance(x,str) and x.strip()!='' else None)
+            expected[col] = expected[col].apply(lambda x: x if isinstance(x,str) and x != 'NULL' else None)
+        lambdas = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = clean_strings(df.copy(), NULL_TEXT)
+        vectorized = time.perf_counter() - start
+
+        same = all(_same(expected[c], actual[c]) for c in df.columns)
+        print(f'{rows:,} rows x {len(df.columns)} {dtype} columns: lambdas {lambdas:.2f}s, clean_strings {vectorized:.2f}s '
+              f'({lambdas / vectorized:.1f}x), identical: {same}')
+
+
+if __name__ == '__main__':
+    import sys
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
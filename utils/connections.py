@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, Engine
+from sqlalchemy.pool import QueuePool
+from urllib.parse import quote_plus
+from utils.tools import get_logger
+
+load_dotenv()
+log = get_logger('Connections')
+
+# Pool tuning, overridable from .env
+POOL_SIZE = int(os.getenv('ETL_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.getenv('ETL_MAX_OVERFLOW', 5))
+POOL_TIMEOUT = int(os.getenv('ETL_POOL_TIMEOUT', 60))
+POOL_RECYCLE = int(os.getenv('ETL_POOL_RECYCLE', 1800))         # Azure SQL drops idle sessions after ~30 min
+POOL_PRE_PING = os.getenv('ETL_POOL_PRE_PING', '1') == '1'
+FAST_EXECUTEMANY = os.getenv('ETL_FAST_EXECUTEMANY', '1') == '1'
+
+_engines: dict[tuple, Engine] = {}
+_lock = threading.Lock()
+
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a free connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+
+def get_engine(server_env, db_env, user_env, pw_env) -> Engine:
+    """Returns the process-wide pooled engine for the given connection env vars, creating it once."""
+    key = (os.getpid(), server_env, db_env, user_env, pw_env)
+    with _lock:
+        if key in _engines:
+            return _engines[key]
+
+        conn_string = (
+            f"DRIVER={os.getenv('AZURE_ODBC_DRIVER', '{ODBC Driver 18 for SQL Server}')};"
+            f"SERVER={os.getenv(server_env)};"
+            f"DATABASE={os.getenv(db_env)};"
+            f"UID={os.getenv(user_env)};"
+            f"PWD={os.getenv(pw_env)};"
+            f"Encrypt=yes;"
+            f"TrustServerCertificate=yes;"
+        )
+        quoted = quote_plus(conn_string)
+        engine = create_engine(
+            f'mssql+pyodbc:///?odbc_connect={quoted}',
+            poolclass=TimedQueuePool,
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_recycle=POOL_RECYCLE,
+            pool_pre_ping=POOL_PRE_PING,
+            fast_executemany=FAST_EXECUTEMANY,
+        )
+        _engines[key] = engine
+        log.info(f'Connected to {os.getenv(db_env)} at {os.getenv(server_env)} (pool_size={POOL_SIZE}, max_overflow={MAX_OVERFLOW})')
+        return engine
+
+def source_db_conn(): return get_engine('AZURE_SERVER','AZURE_DATABASE','AZURE_USERNAME','AZURE_PASSWORD')
+def target_db_conn(): return get_engine('STAGE_SERVER','STAGE_DATABASE','STAGE_USERNAME','STAGE_PASSWORD')
+
+
+def pool_stats() -> dict[str, dict]:
+    """Checkout counts and wait times for every engine created in this process."""
+    stats = {}
+    for (pid, _, db_env, _, _), engine in _engines.items():
+        pool = engine.pool
+        if pid != os.getpid() or not isinstance(pool, TimedQueuePool):
+            continue
+        stats[str(os.getenv(db_env))] = {
+            'checkouts': pool.checkouts,
+            'wait_total': round(pool.wait_total, 3),
+            'wait_max': round(pool.wait_max, 3),
+            'wait_avg': round(pool.wait_total / pool.checkouts, 4) if pool.checkouts else 0.0,
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        }
+    return stats
+
+
+def log_pool_stats():
+    for db, s in pool_stats().items():
+        log.info(f"Pool {db}: {s['checkouts']} checkouts, wait total {s['wait_total']}s / max {s['wait_max']}s / avg {s['wait_avg']}s")
+
+
+def dispose_all():
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
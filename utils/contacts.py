@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from utils.tools import clean_contact
+
+# Normalized numbers kept between batches; V1 repeats the same few numbers across many rows
+CACHE_SIZE = int(os.getenv('ETL_CONTACT_CACHE_SIZE', 100_000))
+
+_cache: OrderedDict[str, str | None] = OrderedDict()
+_lock = threading.Lock()
+
+
+
+def normalize_contacts(s: pd.Series) -> pd.Series:
+    """
+    utils.tools.clean_contact for a whole Series, with regex replace and string slicing: keep digits
+    and '+', drop leading zeros, then '5...' -> '+966' + 12 chars, '9...' -> '+' + 14 chars, anything
+    else cut to 15 chars. Nulls and numbers without digits become None.
+    """
+    num = s.astype(object).where(s.notna(), None)
+    num = num.str.replace(r'[^+0-9]', '', regex=True)
+    empty = num.isna() | num.eq('')
+    num = num.str.lstrip('0')
+
+    first = num.str[:1]
+    out = num.str[:15]
+    out = out.mask(first.eq('5'), '+966' + num.str[:12])
+    out = out.mask(first.eq('9'), '+' + num.str[:14])
+    out = out.astype(object)
+    out[empty.to_numpy()] = None
+    return out
+
+
+def clean_contacts(s: pd.Series) -> pd.Series:
+    """
+    Normalizes a Series of phone numbers. Each distinct number is normalized once: repeats inside the
+    batch share one result, and numbers seen in earlier batches come from an LRU cache, so only new
+    numbers go through normalize_contacts.
+    """
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    keys = list(uniques)
+    values: list = [None] * len(keys)
+    misses = []
+
+    with _lock:
+        for i, key in enumerate(keys):
+            if key in _cache:
+                _cache.move_to_end(key)
+                values[i] = _cache[key]
+            else:
+                misses.append(i)
+
+    if misses:
+        normalized = normalize_contacts(pd.Series([keys[i] for i in misses], dtype=object)).tolist()
+        with _lock:
+            for i, value in zip(misses, normalized):
+                values[i] = value
+                _cache[keys[i]] = value
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+
+    # Null inputs (code -1) map to the trailing None
+    lookup = np.array(values + [None], dtype=object)
+    return pd.Series(lookup[codes], index=s.index, name=s.name, dtype=object)
+
+
+# -------------------- Equivalence check --------------------
+def _samples() -> list:
+    return [
+        None, np.nan, '', '   ', 'abc', '0', '000', '+', '++',
+        '0501234567', '501234567', '00966501234567', '966501234567', '+966501234567', '+966 50 123 4567',
+        '(050) 123-4567', '05012345678901234567', '9665012345678901234', '12345678901234567890',
+        '+1 (415) 555-0100', '0044 20 7946 0958', '٠٥٠١٢٣٤٥٦٧', '5', '9', '0+966501234567', '+0501234567',
+    ]
+
+
+def check_equivalence(rows: int = 200_000) -> bool:
+    """Compares clean_contacts with clean_contact on edge cases and random numbers, and times both."""
+    rng = np.random.default_rng(0)
+    alphabet = np.array(list('0123456789+ -()x'))
+    random = [''.join(rng.choice(alphabet, rng.integers(0, 22))) for _ in range(rows // 4)]
+    s = pd.Series((_samples() + random) * 4, dtype=object)
+
+    start = time.perf_counter()
+    expected = s.apply(clean_contact)
+    per_row = time.perf_counter() - start
+
+    _cache.clear()
+    start = time.perf_counter()
+    actual = clean_contacts(s)
+    vectorized = time.perf_counter() - start
+
+    expected = expected.astype(object).where(expected.notna(), None)
+    mismatches = (expected != actual) & ~(expected.isna() & actual.isna())
+    for i in np.flatnonzero(mismatches.to_numpy())[:10]:
+        print(f'Mismatch for {s[i]!r}: clean_contact {expected[i]!r}, clean_contacts {actual[i]!r}')
+    print(f'{len(s):,} numbers: clean_contact {per_row:.2f}s, clean_contacts {vectorized:.2f}s, '
+          f'mismatches: {int(mismatches.sum())}')
+    return not mismatches.any()
+
+
+if __name__ == '__main__':
+    check_equivalence()
@@ -4,4 +4,35 @@ class IncrementalDependencyError(Exception):
     """
     def __init__(self, message: str | None = None):
         super().__init__(message)
-        
\ No newline at end of file
+        
+
+class DependencyGraphError(Exception):
+    """
+    Raised when the migration task graph is invalid or a task in it fails.
+    """
+    def __init__(self, message: str | None = None):
+        super().__init__(message)
+
+
+class SourceSchemaError(Exception):
+    """
+    Raised when columns declared in a module's source manifest are missing from V1.
+    """
+    def __init__(self, message: str | None = None):
+        super().__init__(message)
+
+
+class TargetSchemaError(Exception):
+    """
+    Raised when the target database lacks a table or columns a module loads into.
+    """
+    def __init__(self, message: str | None = None):
+        super().__init__(message)
+
+
+class WatermarkError(Exception):
+    """
+    Raised when a table's CDC watermark is missing where a load needs it to stay idempotent.
+    """
+    def __init__(self, message: str | None = None):
+        super().__init__(message)
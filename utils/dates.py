@@ -0,0 +1,69 @@
+import time
+import numpy as np
+import pandas as pd
+from utils.tools import get_logger, parse_date
+
+log = get_logger('Dates')
+
+# Text formats V1 stores dates in, tried in this order
+V1_DATE_FORMATS = [
+    '%b %d %Y %I:%M%p',        # May 29 2020 8:39AM
+    '%m/%d/%Y %I:%M:%S %p',    # 3/3/2025 1:28:20 PM
+]
+
+
+
+def parse_dates(s: pd.Series, formats: list[str] = V1_DATE_FORMATS) -> tuple[pd.Series, dict[str, int]]:
+    """
+    utils.tools.parse_date for a whole column. Values that are already dates are kept as they are;
+    then each format is tried in one vectorized pass over the strings no earlier format matched.
+    Returns the datetime column (NaT where nothing matched) and how many values each step resolved.
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s, {'datetime': int(s.notna().sum())}
+
+    is_text = s.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+    out = pd.to_datetime(s.where(~is_text), errors='coerce')
+    hits = {'datetime': int(out.notna().sum())}
+
+    pending = is_text.copy()
+    for fmt in formats:
+        if not pending.any():
+            hits[fmt] = 0
+            continue
+        parsed = pd.to_datetime(s[pending], format=fmt, errors='coerce')
+        matched = parsed.notna()
+        out.loc[matched.index[matched]] = parsed[matched]
+        pending[pending] = ~matched.to_numpy()
+        hits[fmt] = int(matched.sum())
+
+    hits['unparsed'] = int(pending.sum())
+    return out, hits
+
+
+# -------------------- Equivalence check --------------------
+def check_equivalence(rows: int = 100_000) -> bool:
+    """Compares parse_dates with parse_date on a mixed column and times both."""
+    rng = np.random.default_rng(0)
+    stamps = pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 8 * 365 * 24 * 60, rows), unit='min')
+    text_a = stamps.strftime('%b %d %Y %I:%M%p')
+    text_b = stamps.strftime('%m/%d/%Y %I:%M:%S %p')
+    pick = rng.integers(0, 4, rows)
+    values = np.where(pick == 0, text_a, np.where(pick == 1, text_b, np.where(pick == 2, stamps.astype(object), 'not a date')))
+    s = pd.Series(values, dtype=object)
+
+    start = time.perf_counter()
+    expected = pd.to_datetime(s.apply(parse_date))
+    per_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual, hits = parse_dates(s)
+    vectorized = time.perf_counter() - start
+
+    same = expected.equals(actual)
+    print(f'{rows:,} values: parse_date {per_row:.2f}s, parse_dates {vectorized:.2f}s, identical: {same}, hits: {hits}')
+    return same
+
+
+if __name__ == '__main__':
+    check_equivalence()
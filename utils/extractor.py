@@ -0,0 +1,84 @@
+import time
+from functools import lru_cache
+from typing import Iterator
+import pandas as pd
+from sqlalchemy import text, Engine
+from utils.tools import get_logger
+from utils.batch_sizer import BatchSizer
+from utils.cdc import get_watermark
+from utils.custom_err import SourceSchemaError
+
+log = get_logger('Extractor')
+
+
+
+def get_cdc(engine: Engine, table_name: str) -> int:
+    return get_watermark(engine, table_name)
+
+
+@lru_cache(maxsize=None)
+def get_source_columns(engine: Engine, table: str) -> tuple[str, ...]:
+    """Column names of a table from the catalog, read once per process."""
+    schema, name = table.split('.')
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=:schema AND TABLE_NAME=:name ORDER BY ORDINAL_POSITION"),
+            {"schema": schema, "name": name}
+        ).scalars().all()
+    return tuple(rows)
+
+
+def get_projection(engine: Engine, table: str, columns: list[str] | None = None, exclude: list[str] | None = None, required: list[str] | None = None) -> str:
+    """
+    SELECT list for a table's column manifest: either the declared columns, or every catalog column
+    except the excluded ones, of which the required ones (those the transform reads by name) must
+    exist. Raises SourceSchemaError if a declared or required column no longer exists in V1.
+    """
+    available = {c.lower(): c for c in get_source_columns(engine, table)}
+    if not available:
+        raise SourceSchemaError(f'{table} not found in the source catalog')
+    if columns is not None:
+        missing = [c for c in columns if c.lower() not in available]
+        if missing:
+            raise SourceSchemaError(f'{table} is missing declared columns: {missing}')
+        return ', '.join(f'[{c}]' for c in columns)
+
+    skip = {c.lower() for c in exclude or []}
+    missing = [c for c in required or [] if c.lower() not in available or c.lower() in skip]
+    if missing:
+        raise SourceSchemaError(f'{table} is missing required columns: {missing}')
+    return ', '.join(f'[{c}]' for c in available.values() if c.lower() not in skip)
+
+
+def stream_batches(source_db: Engine, table: str, key: str, start: int, columns: str = '*', where: str | None = None, batch_size: int | BatchSizer = 10000) -> Iterator[pd.DataFrame]:
+    """
+    Yields DataFrames of up to batch_size rows with key > start, in key order, from a single streamed
+    query. The last yielded key is kept in memory, so no watermark read or new seek is needed per batch.
+    With a BatchSizer, each fetch uses its current size and reports the fetch time back to it.
+    """
+    condition = f"{key} > :start" + (f" AND {where}" if where else '')
+    query = text(f"SELECT {columns} FROM {table} WHERE {condition} ORDER BY {key}")
+    sizer = batch_size if isinstance(batch_size, BatchSizer) else None
+
+    with source_db.connect().execution_options(stream_results=True) as conn:
+        result = conn.execute(query, {'start': start})
+        cols = list(result.keys())
+        while True:
+            size = sizer.size if sizer else batch_size
+            fetch_start = time.perf_counter()
+            rows = result.fetchmany(size)
+            if not rows:
+                return
+            if sizer:
+                sizer.record_extract(len(rows), time.perf_counter() - fetch_start)
+            df = pd.DataFrame.from_records(rows, columns=cols, coerce_float=True)
+            start = df[key].max()
+            log.info(f'Extracted {len(df)} rows from {table} (up to {key} {start})')
+            yield df
+
+
+def stream_table(source_db: Engine, target_db: Engine, table: str, key: str, columns: str = '*', where: str | None = None, batch_size: int | BatchSizer = 10000) -> Iterator[pd.DataFrame]:
+    """Reads the CDC watermark for the table once, then streams everything after it."""
+    max_id = get_cdc(target_db, table)
+    log.info(f'Current CDC for {table}: {max_id}')
+    yield from stream_batches(source_db, table, key, max_id, columns, where, batch_size)
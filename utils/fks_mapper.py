@@ -1,8 +1,218 @@
+import threading
+import numpy as np
 import pandas as pd
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Engine, Connection
 from sqlalchemy import text
-
-
+from utils.tools import get_logger
+from utils.key_lookup import read_by_keys
+from utils.id_snapshot import load_snapshot, save_snapshot, target_tag
+
+log = get_logger('FksMapper')
+
+
+
+class IdTranslator:
+    """
+    Old->New ID lookup over two sorted int64 arrays. translate() maps a whole Series with one
+    searchsorted pass instead of merging the batch frame against the mapping. If an old ID maps to
+    several new IDs, the highest new ID wins (a left merge would have duplicated the row).
+    """
+
+    def __init__(self, old_ids: np.ndarray, new_ids: np.ndarray):
+        order = np.lexsort((new_ids, old_ids))
+        old_ids, new_ids = old_ids[order], new_ids[order]
+        last = np.append(old_ids[1:] != old_ids[:-1], True) if len(old_ids) else np.zeros(0, dtype=bool)
+        self.old = old_ids[last]
+        self.new = new_ids[last]
+
+    def translate(self, old_ids: pd.Series) -> tuple[pd.Series, np.ndarray]:
+        """New IDs (nullable Int64, aligned to old_ids) and the mask of keys that are null, not whole numbers or unmapped."""
+        keys = pd.to_numeric(old_ids, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        # A fractional or NaN key would truncate onto another row's ID; it is reported missing instead
+        present = np.isfinite(keys) & (keys == np.floor(keys))
+        values = np.where(present, keys, 0).astype(np.int64)
+
+        if len(self.old):
+            pos = np.minimum(np.searchsorted(self.old, values), len(self.old) - 1)
+            found = present & (self.old[pos] == values)
+            new_ids = np.where(found, self.new[pos], 0)
+        else:
+            found = np.zeros(len(values), dtype=bool)
+            new_ids = np.zeros(len(values), dtype=np.int64)
+
+        missing = ~found
+        return pd.Series(pd.arrays.IntegerArray(new_ids, missing), index=old_ids.index), missing
+
+
+class IdMapCache:
+    """
+    Process-wide Old->New ID map for one target table. The first lookup reads the whole mapping once;
+    later lookups only read rows whose new ID is above the highest one already held, so the table is
+    never re-read per batch. Mappings are assumed append-only, with an increasing IDENTITY new ID.
+    Loaders hand the rows they just inserted to absorb(), so downstream lookups in the same process
+    find them without another query.
+    Across runs, the map is kept as a memory-mapped snapshot under .etl_state/id_maps tagged with its
+    high-water mark; a warm start maps the snapshot and only reads the rows added since.
+    """
+
+    def __init__(self, table: str, new_col: str, old_col: str, where: str | None = None, alias: str | None = None):
+        self.table = table
+        self.new_col = new_col
+        self.old_col = old_col
+        self.where = where
+        self.alias = alias or new_col           # name of the new ID column in returned frames
+        self._frame: pd.DataFrame | None = None
+        self._max_new: int | None = None
+        self._url: str | None = None
+        self._target: str | None = None
+        self._translator: IdTranslator | None = None
+        self._dirty = False                     # rows added since the last snapshot
+        self._lock = threading.Lock()
+        self.name = f'{table}-{old_col}-{self.alias}'
+        _CACHES.append(self)
+
+    def _query(self, after: int | None) -> str:
+        conditions = [f'{self.old_col} IS NOT NULL'] + ([self.where] if self.where else [])
+        if after is not None:
+            conditions.append(f'{self.new_col} > {after}')
+        return f"SELECT {self.new_col} AS {self.alias}, {self.old_col} FROM {self.table} WHERE {' AND '.join(conditions)} ORDER BY {self.new_col}"
+
+    def _add(self, rows: pd.DataFrame):
+        if self._max_new is not None:
+            rows = rows[rows[self.alias] > self._max_new]
+        if rows.empty:
+            return
+        self._frame = rows if self._frame is None or self._frame.empty else pd.concat([self._frame, rows], ignore_index=True)
+        self._max_new = int(rows[self.alias].max())
+        self._translator = None
+        self._dirty = True
+
+    def _signature(self) -> dict:
+        return {'table': self.table, 'new_col': self.new_col, 'old_col': self.old_col, 'where': self.where, 'target': self._target}
+
+    def _warm_start(self, engine: Engine) -> bool:
+        """Maps the snapshot if its high-water row still has the same old ID in the target."""
+        snapshot = load_snapshot(self.name, self._signature())
+        if snapshot is None:
+            return False
+        old_ids, new_ids, max_new = snapshot
+        if not len(new_ids) or int(new_ids[-1]) != max_new:
+            return False
+        with engine.connect() as conn:
+            current = conn.execute(text(f"SELECT {self.old_col} FROM {self.table} WHERE {self.new_col} = :new_id"), {'new_id': max_new}).scalar()
+        if current is None or int(current) != int(old_ids[-1]):
+            log.warning(f'{self.table} ID map snapshot no longer matches the target, reloading it')
+            return False
+        self._frame = pd.DataFrame({self.alias: new_ids, self.old_col: old_ids}, copy=False)
+        self._max_new = max_new
+        self._dirty = False
+        return True
+
+    def refresh(self, engine: Engine):
+        """Loads the map on first use (from the snapshot if there is one), afterwards only the rows added since."""
+        url = str(engine.url)
+        if self._url != url:
+            self._frame, self._max_new, self._url, self._translator = None, None, url, None
+            self._target = target_tag(engine.url)
+        first = self._frame is None
+        warm = first and self._warm_start(engine)
+        rows = pd.read_sql(self._query(self._max_new), engine)
+        if first and not warm:
+            self._frame = rows.iloc[0:0]
+        self._add(rows)
+        log.info(f'{"Warm-started" if warm else "Loaded" if first else "Refreshed"} {self.table} ID map: +{len(rows)} rows, {len(self._frame)} cached')
+        if first:
+            self._save()
+
+    def _save(self):
+        if not self._dirty or self._frame is None or self._frame.empty:
+            return
+        try:
+            save_snapshot(self.name, self._signature(), self._frame[self.old_col].to_numpy(dtype=np.int64),
+                          self._frame[self.alias].to_numpy(dtype=np.int64), self._max_new)
+        except OSError as e:
+            # Only costs a cold start next run
+            log.warning(f'Could not save the {self.table} ID map snapshot: {e}')
+            return
+        self._dirty = False
+
+    def save(self):
+        """Persists the map if it grew since the last snapshot."""
+        with self._lock:
+            self._save()
+
+    def get(self, engine: Engine, old_ids: pd.Series | None = None) -> pd.DataFrame:
+        """Rows for old_ids (or the whole map); only refreshes if some requested IDs are not cached yet."""
+        with self._lock:
+            if old_ids is None:
+                self.refresh(engine)
+                return self._frame.copy()
+
+            wanted = pd.Series(old_ids).dropna()
+            if self._frame is None or self._url != str(engine.url) or not wanted.isin(self._frame[self.old_col]).all():
+                self.refresh(engine)
+            return self._frame[self._frame[self.old_col].isin(wanted)].reset_index(drop=True)
+
+    def _translate(self, old_ids: pd.Series) -> tuple[pd.Series, np.ndarray]:
+        if self._translator is None:
+            self._translator = IdTranslator(self._frame[self.old_col].to_numpy(dtype=np.int64), self._frame[self.alias].to_numpy(dtype=np.int64))
+        return self._translator.translate(old_ids)
+
+    def translate(self, engine: Engine, old_ids: pd.Series) -> tuple[pd.Series, np.ndarray]:
+        """
+        New IDs for old_ids plus a mask of the null/unmapped ones, without merging the batch frame.
+        Refreshes (incrementally) only when some non-null old ID is not cached yet.
+        """
+        with self._lock:
+            if self._frame is None or self._url != str(engine.url):
+                self.refresh(engine)
+            new_ids, missing = self._translate(old_ids)
+            if (missing & old_ids.notna().to_numpy()).any():
+                self.refresh(engine)
+                new_ids, missing = self._translate(old_ids)
+        return new_ids, missing
+
+    def fetch_inserted(self, conn: Connection) -> pd.DataFrame | None:
+        """
+        Inside a loader's transaction, after its insert: reads the rows above the cached high-water mark.
+        Returns None when this process has not loaded the map yet (its first lookup will read them anyway).
+        """
+        with self._lock:
+            if self._frame is None or self._url != str(conn.engine.url):
+                return None
+            after = self._max_new
+        return pd.read_sql(text(self._query(after)), conn)
+
+    def absorb(self, rows: pd.DataFrame | None):
+        """Adds the rows from fetch_inserted once the loader's transaction has committed."""
+        if rows is None:
+            return
+        with self._lock:
+            if self._frame is not None:
+                self._add(rows)
+
+
+_CACHES: list[IdMapCache] = []
+
+ACCOUNTS = IdMapCache('app.Accounts', 'AccountID', 'OldUserID')
+LOCATIONS = IdMapCache('app.Locations', 'LocationID', 'OldLocationID')
+USERS = IdMapCache('app.AspNetUsers', 'Id', 'OldID', where="UserType='User'")
+CUSTOMERS = IdMapCache('app.AspNetUsers', 'Id', 'OldID', where="UserType='Customer'", alias='CustomerID')
+MAKES = IdMapCache('app.Makes', 'MakeID', 'OldMakeID')
+ORDERS = IdMapCache('app.Orders', 'OrderID', 'OldOrderID')
+CARS = IdMapCache('app.Cars', 'CarID', 'OldCarID')
+ORDER_DETAILS = IdMapCache('app.OrderDetails', 'OrderDetailID', 'OldOrderDetailID')
+SUPPLIERS = IdMapCache('app.Suppliers', 'SupplierID', 'OldSupplierID')
+PACKAGES = IdMapCache('app.Packages', 'PackageID', 'OldPackageID')
+WAREHOUSES = IdMapCache('app.Warehouses', 'WarehouseID', 'OldStoreID')
+STOCK_TRANSFERS = IdMapCache('app.StockTransfers', 'TransferID', 'OldStockIssueID', alias='StockTransferID')
+BAYS = IdMapCache('app.Bays', 'BayID', 'OldBayID')
+
+
+def save_snapshots():
+    """Writes the snapshot of every ID map that grew in this process (e.g. at the end of a task)."""
+    for cache in _CACHES:
+        cache.save()
 
 
 def get_custom(engine: Engine, columns:str | list[str], table: str, col_not_null: str | None = None) -> pd.DataFrame:
@@ -14,100 +224,82 @@ def get_custom(engine: Engine, columns:str | list[str], table: str, col_not_null
 
 
 def get_accounts(engine: Engine, old_user_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_user_ids is not None:
-        acc_ids = (0,0) + tuple(old_user_ids.values.tolist())
-        return pd.read_sql(f"SELECT AccountID, OldUserID FROM app.Accounts WHERE OldUserID IN {acc_ids} AND OldUserID IS NOT NULL", engine)
-    return pd.read_sql("SELECT AccountID, OldUserID FROM app.Accounts WHERE OldUserID IS NOT NULL", engine)
+    return ACCOUNTS.get(engine, old_user_ids)
 
 
 
 def get_locations(engine: Engine, old_location_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_location_ids is not None:
-        loc_ids = (0,0) + tuple(old_location_ids.values.tolist())
-        return pd.read_sql(f"SELECT LocationID, OldLocationID FROM app.Locations WHERE OldLocationID IN {loc_ids} AND OldLocationID IS NOT NULL", engine)
-    return pd.read_sql("SELECT LocationID, OldLocationID FROM app.Locations WHERE OldLocationID IS NOT NULL", engine)
+    return LOCATIONS.get(engine, old_location_ids)
 
 
 def get_users(engine: Engine, old_subuser_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_subuser_ids is not None:
-        user_ids = (0,0) + tuple(old_subuser_ids.values.tolist())
-        return pd.read_sql(f"SELECT Id, OldID FROM app.AspNetUsers WHERE UserType='User' AND OldID IN {user_ids} AND OldID IS NOT NULL", engine)
-    return pd.read_sql("SELECT Id, OldID FROM app.AspNetUsers WHERE UserType='User' AND OldID IS NOT NULL", engine)
+    return USERS.get(engine, old_subuser_ids)
 
 
 
 def get_customers(engine: Engine, old_customer_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_customer_ids is not None:
-        cust_ids = (0,0) + tuple(old_customer_ids.dropna().values.tolist())
-        return pd.read_sql(f"SELECT Id AS CustomerID, OldID FROM app.AspNetUsers WHERE UserType='Customer' AND OldID IN {cust_ids} AND OldID IS NOT NULL", engine)
-    return pd.read_sql("SELECT Id AS CustomerID, OldID FROM app.AspNetUsers WHERE UserType='Customer' AND OldID IS NOT NULL", engine)
+    return CUSTOMERS.get(engine, old_customer_ids)
 
 
 
 def get_makes(engine: Engine, old_make_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_make_ids is not None:
-        make_ids = (0,0) + tuple(old_make_ids.dropna().values.tolist())
-        return pd.read_sql(f"SELECT MakeID, OldMakeID FROM app.Makes WHERE OldMakeID IN {make_ids} AND OldMakeID IS NOT NULL", engine)
-    return pd.read_sql("SELECT MakeID, OldMakeID FROM app.Makes WHERE OldMakeID IS NOT NULL", engine)
+    return MAKES.get(engine, old_make_ids)
 
 
 def get_orders(engine: Engine, old_order_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_order_ids is not None:
-        order_ids = (0,0) + tuple(old_order_ids.dropna().values.tolist())
-        return pd.read_sql(f"SELECT OrderID, OldOrderID FROM app.Orders WHERE OldOrderID IN {order_ids} AND OldOrderID IS NOT NULL", engine)
-    return pd.read_sql("SELECT OrderID, OldOrderID FROM app.Orders WHERE OldOrderID IS NOT NULL", engine)
+    return ORDERS.get(engine, old_order_ids)
+
+def get_order_headers(engine: Engine, old_order_ids: pd.Series) -> pd.DataFrame:
+    # Not an IdMapCache: the totals change after the order is migrated (utils.change_sync)
+    query = "SELECT OrderID, OldOrderID, OrderDiscountTotal, ItemTaxTotal FROM app.Orders WHERE OldOrderID IN {keys}"
+    return read_by_keys(engine, query, old_order_ids)
 
 def get_cars(engine: Engine, old_car_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_car_ids is not None:
-        car_ids = (0,0) + tuple(old_car_ids.dropna().values.tolist())
-        return pd.read_sql(f"SELECT CarID, OldCarID FROM app.Cars WHERE OldCarID IN {car_ids}", engine)
-    return pd.read_sql("SELECT CarID, OldCarID FROM app.Cars WHERE OldCarID IS NOT NULL", engine)
+    return CARS.get(engine, old_car_ids)
 
 def get_order_details(engine: Engine, old_order_detail_ids: pd.Series | None = None) -> pd.DataFrame:
-    if old_order_detail_ids is not None:
-        order_detail_ids = (0,0) + tuple(old_order_detail_ids.dropna().values.tolist())
-        return pd.read_sql(f"SELECT OrderDetailID, OldOrderDetailID FROM app.OrderDetails WHERE OldOrderDetailID IN {order_detail_ids}", engine)
-    return pd.read_sql("SELECT OrderDetailID, OldOrderDetailID FROM app.OrderDetails WHERE OldOrderDetailID IS NOT NULL", engine)
+    return ORDER_DETAILS.get(engine, old_order_detail_ids)
 
 def get_items(engine: Engine, old_item_ids : pd.Series) -> pd.DataFrame:
-    item_ids = tuple(old_item_ids.dropna().values.tolist()) + (0,0)
-    query = text(f"""
+    query = """
         SELECT ItemID, OldItemID
         FROM app.SyncItems s
         JOIN app.Items i
             ON s.CategoryID = i.CategoryID 
                  AND s.Name COLLATE Latin1_General_CS_AS = i.Name COLLATE Latin1_General_CS_AS
-        WHERE OldItemID IN {item_ids}
-    """)
-    return pd.read_sql(query, engine)
+        WHERE OldItemID IN {keys}
+    """
+    return read_by_keys(engine, query, old_item_ids)
 
 def get_categories(engine: Engine, old_cat_ids : pd.Series) -> pd.DataFrame:
-    cat_ids = tuple(old_cat_ids.dropna().values.tolist()) + (0,0)
-    query = text(f"""
+    query = """
             SELECT s.OldCategoryID, c.CategoryID
             FROM app.synccategories s
             JOIN app.categories c
                 ON s.accountid = c.AccountID
                     AND c.Name COLLATE Latin1_General_CS_AS = s.Name COLLATE Latin1_General_CS_AS
-            WHERE OldCategoryID IN {cat_ids}
+            WHERE OldCategoryID IN {keys}
             ORDER BY s.OldCategoryID
-    """)
-    return pd.read_sql(query, engine)
+    """
+    return read_by_keys(engine, query, old_cat_ids)
 
 def get_cities(engine: Engine) -> pd.DataFrame:
     return pd.read_sql("SELECT CountryID, CityID, OldCityID FROM app.SyncCities", engine)
 
 def get_suppliers(engine: Engine) -> pd.DataFrame:
-    return pd.read_sql("SELECT SupplierID, OldSupplierID FROM app.Suppliers WHERE OldSupplierID IS NOT NULL", engine)
+    return SUPPLIERS.get(engine)
 
 def get_packages(engine: Engine) -> pd.DataFrame:
-    return pd.read_sql("SELECT PackageID, OldPackageID FROM app.Packages WHERE OldPackageID IS NOT NULL", engine)
+    return PACKAGES.get(engine)
 
 def get_warehouses(engine: Engine) -> pd.DataFrame:
-    return pd.read_sql("SELECT WarehouseID, OldStoreID FROM app.Warehouses WHERE OldStoreID IS NOT NULL", engine)
+    return WAREHOUSES.get(engine)
 
 def get_stock_transfers(engine: Engine) -> pd.DataFrame:
-    return pd.read_sql(f"SELECT TransferID AS StockTransferID, OldStockIssueID FROM app.StockTransfers", engine)
+    return STOCK_TRANSFERS.get(engine)
+
+def get_bays(engine: Engine, old_bay_ids: pd.Series | None = None) -> pd.DataFrame:
+    return BAYS.get(engine, old_bay_ids)
 
 
 
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import datetime as dt
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from sqlalchemy import text, Engine
+from utils.tools import get_logger, get_state_dir
+from utils.cdc import get_watermark
+
+log = get_logger('HashDiff')
+
+# Sub-ranges a differing range is split into per level
+DIFF_FANOUT = int(os.getenv('ETL_DIFF_FANOUT', 16))
+# Ranges with at most this many rows on either side are compared row by row
+DIFF_LEAF_ROWS = int(os.getenv('ETL_DIFF_LEAF_ROWS', 2000))
+# Ranges compared at once (each runs its source and target query side by side)
+DIFF_WORKERS = int(os.getenv('ETL_DIFF_WORKERS', 4))
+
+_NULL = '\x00'
+
+
+
+# -------------------- Row hashes --------------------
+def _server_row_hash(key: str, columns: list[tuple[str, str]]) -> str:
+    # First 8 bytes of SHA-256 over the key and the normalized values, as a BIGINT
+    parts = [f"CONVERT(NVARCHAR(40), {key})"]
+    parts += [f"COALESCE(CONVERT(NVARCHAR(4000), CAST({expr} AS {sql_type}), 121), N'{_NULL}')" for expr, sql_type in columns]
+    return f"CAST(SUBSTRING(HASHBYTES('SHA2_256', CONCAT({", N'|', ".join(parts)})), 1, 8) AS BIGINT)"
+
+
+def _text(value) -> str:
+    # The values the server-side CONVERT would give for the common types, for non-SQL Server sides
+    if value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return _NULL
+    if isinstance(value, (bool, np.bool_)):
+        return '1' if value else '0'
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating, Decimal)):
+        return format(Decimal(str(value)).normalize(), 'f')
+    if isinstance(value, dt.datetime):
+        return value.isoformat(sep=' ', timespec='milliseconds')
+    return str(value)
+
+
+def _client_row_hash(df: pd.DataFrame) -> pd.Series:
+    values = pd.DataFrame({col: [_text(v) for v in df[col].tolist()] for col in df.columns}, index=df.index)
+    return pd.util.hash_pandas_object(values, index=False).astype('int64')
+
+
+class _Side:
+    """One side of a diff: a table, its key and the value expressions that should agree with the other side."""
+
+    def __init__(self, engine: Engine, table: str, key: str, columns: list[tuple[str, str]], where: str | None, server: bool):
+        self.engine, self.table, self.key, self.columns, self.server = engine, table, key, columns, server
+        self.where = f" AND ({where})" if where else ''
+        self.row_hash = _server_row_hash(key, columns)
+        self.rows_fetched = 0
+
+    def bounds(self) -> tuple[int | None, int | None]:
+        with self.engine.connect() as conn:
+            low, high = conn.execute(text(f"SELECT MIN({self.key}), MAX({self.key}) FROM {self.table} WHERE {self.key} IS NOT NULL{self.where}")).one()
+        return low, high
+
+    def _client_rows(self, low: int, high: int) -> pd.Series:
+        values = ', '.join(f"CAST({expr} AS {sql_type}) AS c{i}" for i, (expr, sql_type) in enumerate(self.columns))
+        query = f"SELECT {self.key} AS k{', ' + values if values else ''} FROM {self.table} WHERE {self.key} BETWEEN :low AND :high{self.where}"
+        df = pd.read_sql(text(query), self.engine, params={'low': low, 'high': high})
+        self.rows_fetched += len(df)
+        return pd.Series(_client_row_hash(df).to_numpy(), index=df['k'].astype('int64').to_numpy())
+
+    def buckets(self, low: int, high: int, width: int) -> pd.DataFrame:
+        """(n rows, h sum of row hashes) per bucket of width keys in [low, high], hashed on the server where it can be."""
+        if not self.server:
+            hashes = self._client_rows(low, high)
+            bucket = (hashes.index.to_numpy() - low) // width
+            grouped = pd.DataFrame({'bucket': bucket, 'h': hashes.to_numpy().astype(object)}).groupby('bucket')['h']
+            return pd.DataFrame({'n': grouped.size(), 'h': grouped.sum()})
+        query = f"""
+            SELECT ({self.key} - :low) / :width AS bucket, COUNT_BIG(*) AS n, SUM(CAST({self.row_hash} AS DECIMAL(38, 0))) AS h
+            FROM {self.table}
+            WHERE {self.key} BETWEEN :low AND :high{self.where}
+            GROUP BY ({self.key} - :low) / :width
+        """
+        df = pd.read_sql(text(query), self.engine, params={'low': low, 'high': high, 'width': width})
+        df['h'] = df['h'].map(int)
+        return df.set_index('bucket')[['n', 'h']]
+
+    def rows(self, low: int, high: int) -> pd.Series:
+        """Row hash per key in [low, high]."""
+        if not self.server:
+            return self._client_rows(low, high)
+        df = pd.read_sql(text(f"SELECT {self.key} AS k, {self.row_hash} AS h FROM {self.table} WHERE {self.key} BETWEEN :low AND :high{self.where}"),
+                         self.engine, params={'low': low, 'high': high})
+        self.rows_fetched += len(df)
+        return pd.Series(df['h'].to_numpy(), index=df['k'].astype('int64').to_numpy())
+
+
+# -------------------- Diff --------------------
+def _compare_rows(source: _Side, target: _Side, low: int, high: int, pool: ThreadPoolExecutor) -> dict[str, list[int]]:
+    src_future = pool.submit(source.rows, low, high)
+    tgt = target.rows(low, high)
+    src = src_future.result()
+
+    duplicates = tgt.index[tgt.index.duplicated()].unique()
+    src, tgt = src[~src.index.duplicated()], tgt[~tgt.index.duplicated()]
+    both = src.index.intersection(tgt.index)
+    return {
+        'inserts': src.index.difference(tgt.index).tolist(),
+        'deletes': tgt.index.difference(src.index).tolist(),
+        'updates': both[src.loc[both].to_numpy() != tgt.loc[both].to_numpy()].tolist(),
+        'duplicates': duplicates.tolist(),
+    }
+
+
+def _compare_range(source: _Side, target: _Side, low: int, high: int, pool: ThreadPoolExecutor) -> tuple[dict[str, list[int]], list[tuple[int, int]]]:
+    """Splits [low, high] into DIFF_FANOUT buckets; returns the row differences of small differing buckets and the large ones to split next."""
+    width = max(1, -(-(high - low + 1) // DIFF_FANOUT))
+    src_future = pool.submit(source.buckets, low, high, width)
+    tgt = target.buckets(low, high, width)
+    src = src_future.result()
+
+    both = src.join(tgt, how='outer', lsuffix='_s', rsuffix='_t')
+    both[['n_s', 'n_t']] = both[['n_s', 'n_t']].fillna(0)
+    differing = both[(both['n_s'] != both['n_t']) | (both['h_s'] != both['h_t'])]
+
+    found: dict[str, list[int]] = {'inserts': [], 'deletes': [], 'updates': [], 'duplicates': []}
+    deeper = []
+    for bucket, row in differing.iterrows():
+        b_low = low + int(bucket) * width
+        b_high = min(high, b_low + width - 1)
+        if max(row['n_s'], row['n_t']) <= DIFF_LEAF_ROWS or b_high - b_low < DIFF_FANOUT:
+            for kind, keys in _compare_rows(source, target, b_low, b_high, pool).items():
+                found[kind] += keys
+        else:
+            deeper.append((b_low, b_high))
+    return found, deeper
+
+
+def bounded_where(where: str | None, key: str, max_key: int | None) -> str | None:
+    """where AND key <= max_key, either part optional."""
+    conditions = [w for w in (where, f'{key} <= {int(max_key)}' if max_key is not None else None) if w]
+    return ' AND '.join(f'({c})' for c in conditions) or None
+
+
+def diff_table(source_db: Engine, target_db: Engine, spec: dict, max_key: int | None = None) -> dict:
+    """
+    Compares a source table with its migrated copy by Old*ID ranges, Merkle style: both sides give
+    (row count, sum of row hashes) per range, computed on the server when both are SQL Server, and
+    only ranges whose summaries differ are split again, down to ranges small enough to compare row
+    by row. Row hashes cover the key and spec['columns'], (source expression, target expression,
+    SQL type) triples that should hold the same value on both sides. Returns the keys to insert
+    (only in the source), update (hashes differ), delete (only in the target) and the keys the
+    target holds more than once, with the work it took. max_key bounds both sides, normally at the
+    CDC watermark, so rows not migrated yet do not count as missing.
+    """
+    start = time.perf_counter()
+    server = source_db.dialect.name == 'mssql' and target_db.dialect.name == 'mssql'
+    columns = spec.get('columns', [])
+    source = _Side(source_db, spec['source'], spec['key'], [(s, t) for s, _, t in columns], bounded_where(spec.get('where'), spec['key'], max_key), server)
+    target = _Side(target_db, spec['target'], spec['target_key'], [(e, t) for _, e, t in columns], bounded_where(spec.get('target_where'), spec['target_key'], max_key), server)
+
+    found: dict[str, list[int]] = {'inserts': [], 'deletes': [], 'updates': [], 'duplicates': []}
+    with ThreadPoolExecutor(max_workers=DIFF_WORKERS, thread_name_prefix='diff-source') as pool, \
+            ThreadPoolExecutor(max_workers=DIFF_WORKERS, thread_name_prefix='diff-range') as ranges_pool:
+        bounds = [b for b in (*source.bounds(), *target.bounds()) if b is not None]
+        ranges = [(int(min(bounds)), int(max(bounds)))] if bounds else []
+        compared = levels = 0
+        while ranges:
+            levels += 1
+            compared += len(ranges)
+            results = list(ranges_pool.map(lambda r: _compare_range(source, target, r[0], r[1], pool), ranges))
+            ranges = []
+            for rows, deeper in results:
+                for kind, keys in rows.items():
+                    found[kind] += keys
+                ranges += deeper
+
+    report = {
+        'source': spec['source'],
+        'target': spec['target'],
+        'max_key': max_key,
+        **{kind: sorted(keys) for kind, keys in found.items()},
+        'ranges_compared': compared,
+        'levels': levels,
+        'rows_fetched': source.rows_fetched + target.rows_fetched,
+        'hashed_on_server': server,
+        'seconds': round(time.perf_counter() - start, 2),
+    }
+    log.info(f"Diffed {spec['source']} -> {spec['target']} in {report['seconds']}s over {compared} ranges ({levels} levels, "
+             f"{report['rows_fetched']} rows fetched): {len(report['inserts'])} to insert, {len(report['updates'])} to update, "
+             f"{len(report['deletes'])} to delete, {len(report['duplicates'])} duplicated in the target")
+    return report
+
+
+def diff_task(name: str, source_db: Engine, target_db: Engine) -> dict | None:
+    """Diffs a registered task's VERIFY spec up to its CDC watermark and saves the report under .etl_state/diff."""
+    from utils.registry import get_verify_spec
+
+    spec = get_verify_spec(name)
+    if not spec:
+        log.info(f'{name} declares no VERIFY spec, skipped')
+        return None
+    report = diff_table(source_db, target_db, spec, max_key=get_watermark(target_db, spec['source']))
+    path = get_state_dir('diff') / f'{name}.json'
+    path.write_text(json.dumps(report, indent=1), encoding='utf-8')
+    log.info(f'Diff report for {name} written to {path}')
+    return report
+
+
+if __name__ == '__main__':
+    import sys
+    from utils.registry import REGISTRY
+    from utils.connections import source_db_conn, target_db_conn
+
+    source, target = source_db_conn(), target_db_conn()
+    for task in sys.argv[1:] or list(REGISTRY):
+        diff_task(task, source, target)
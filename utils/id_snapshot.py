@@ -0,0 +1,96 @@
+import os
+import json
+import uuid
+import hashlib
+import numpy as np
+from pathlib import Path
+from utils.tools import get_logger, get_state_dir
+
+log = get_logger('IdSnapshot')
+
+# Bump when the on-disk layout changes; older snapshots are then ignored and rebuilt
+FORMAT_VERSION = 1
+
+
+
+def target_tag(url) -> str:
+    """Stable tag for a target database (credentials left out)."""
+    rendered = url.render_as_string(hide_password=True) if hasattr(url, 'render_as_string') else str(url)
+    return hashlib.sha1(rendered.encode()).hexdigest()[:12]
+
+
+def _header_path(name: str) -> Path:
+    return get_state_dir('id_maps') / f'{name}.json'
+
+
+def _read_header(name: str) -> dict | None:
+    try:
+        return json.loads(_header_path(name).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load_snapshot(name: str, signature: dict) -> tuple[np.ndarray, np.ndarray, int] | None:
+    """
+    Memory-maps the latest snapshot of an ID map: (old IDs, new IDs, high-water mark), or None if
+    there is none or it was written for another format version, query or target.
+    """
+    header = _read_header(name)
+    if header is None:
+        return None
+    if header.get('version') != FORMAT_VERSION or header.get('signature') != signature:
+        log.info(f'Ignoring stale {name} snapshot')
+        return None
+    try:
+        data = np.load(get_state_dir('id_maps') / header['file'], mmap_mode='r')
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    if data.shape != (2, header['rows']):
+        return None
+    return data[0], data[1], int(header['max_new'])
+
+
+def _version(path: Path) -> int | None:
+    # {name}@{max_new}-{tag}.npy
+    try:
+        return int(path.stem.rpartition('@')[2].split('-')[0])
+    except ValueError:
+        return None
+
+
+def save_snapshot(name: str, signature: dict, old_ids: np.ndarray, new_ids: np.ndarray, max_new: int):
+    """
+    Writes a new data file tagged with the high-water mark, then swaps the header to point at it.
+    Each version gets its own file, so a snapshot that is still mapped (e.g. on Windows) is never
+    overwritten. The runner's worker processes can save the same map at once, so every temp and
+    data file name is unique to the writer, a header is never swapped back to a lower high-water
+    mark, and only data files below the current header's mark are removed.
+    """
+    directory = get_state_dir('id_maps')
+    tag = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    data_file = f'{name}@{max_new}-{tag}.npy'
+    tmp = directory / f'{data_file}.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, np.vstack([old_ids.astype(np.int64), new_ids.astype(np.int64)]))
+    os.replace(tmp, directory / data_file)
+
+    current = _read_header(name)
+    if current and int(current.get('max_new', -1)) > max_new:
+        # Another process already saved a newer version
+        (directory / data_file).unlink(missing_ok=True)
+        return
+
+    header_tmp = directory / f'{name}.json.{tag}.tmp'
+    header_tmp.write_text(json.dumps({'version': FORMAT_VERSION, 'signature': signature, 'file': data_file,
+                                      'rows': int(len(old_ids)), 'max_new': int(max_new)}))
+    os.replace(header_tmp, _header_path(name))
+
+    current = _read_header(name) or {}
+    for old in directory.glob(f'{name}@*.npy'):
+        version = _version(old)
+        if old.name != current.get('file') and version is not None and version < int(current.get('max_new', max_new)):
+            try:
+                old.unlink()
+            except OSError:
+                pass
+    log.info(f'Saved {name} ID map snapshot: {len(old_ids)} rows up to {max_new}')
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, Engine, Connection
+from utils.tools import get_logger
+
+log = get_logger('KeyLookup')
+
+# Above this many distinct keys, SQL Server lookups go through a session temp table
+TEMP_TABLE_MIN_KEYS = int(os.getenv('ETL_TEMP_TABLE_MIN_KEYS', 1000))
+# Keys per parameterized IN list; stays under SQL Server's 2100 and old SQLite's 999 parameter limits
+IN_CHUNK_SIZE = int(os.getenv('ETL_IN_CHUNK_SIZE', 900))
+
+_TEMP_TABLE = '#etl_keys'
+
+
+
+def distinct_keys(keys: Iterable) -> list:
+    """Distinct non-null keys as plain Python values, sorted so chunks follow key order."""
+    values = pd.Series(keys).dropna().drop_duplicates()
+    if pd.api.types.is_float_dtype(values) and (values == np.floor(values)).all():
+        values = values.astype('int64')
+    return sorted(values.tolist())
+
+
+def _key_type(keys: list) -> str:
+    return 'BIGINT' if all(isinstance(k, int) for k in keys) else 'NVARCHAR(450)'
+
+
+def _read_temp_table(conn: Connection, query: str, keys: list, params: dict) -> pd.DataFrame:
+    conn.execute(text(f"IF OBJECT_ID('tempdb..{_TEMP_TABLE}') IS NOT NULL DROP TABLE {_TEMP_TABLE}"))
+    conn.execute(text(f"CREATE TABLE {_TEMP_TABLE} ([Key] {_key_type(keys)} NOT NULL PRIMARY KEY)"))
+    try:
+        conn.execute(text(f"INSERT INTO {_TEMP_TABLE} ([Key]) VALUES (:key)"), [{'key': k} for k in keys])
+        return pd.read_sql(text(query.format(keys=f'(SELECT [Key] FROM {_TEMP_TABLE})')), conn, params=params)
+    finally:
+        conn.execute(text(f"DROP TABLE {_TEMP_TABLE}"))
+
+
+def _read_chunked(conn: Connection, query: str, keys: list, params: dict, chunk_size: int) -> pd.DataFrame:
+    frames = []
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        names = [f'_k{j}' for j in range(len(chunk))]
+        sql = query.format(keys='(' + ', '.join(f':{n}' for n in names) + ')')
+        frames.append(pd.read_sql(text(sql), conn, params={**params, **dict(zip(names, chunk))}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_by_keys(engine: Engine, query: str, keys: Iterable, params: dict | None = None, chunk_size: int = IN_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Runs query with its {keys} placeholder bound to the batch's distinct keys, e.g.
+    "SELECT OrderID, Tax FROM dbo.OrderCheckout WHERE OrderID IN {keys}". On SQL Server, large key sets
+    are bulk-inserted into a session temp table and the placeholder becomes a subquery over it; otherwise
+    the keys go in chunks of parameterized IN lists and the results are concatenated in chunk order.
+    Other bind parameters go in params.
+    """
+    values = distinct_keys(keys)
+    params = params or {}
+    with engine.connect() as conn:
+        if not values:
+            # Still run it once so callers get the query's columns back
+            return pd.read_sql(text(query.format(keys='(NULL)')), conn, params=params)
+        if engine.dialect.name == 'mssql' and len(values) > TEMP_TABLE_MIN_KEYS:
+            return _read_temp_table(conn, query, values, params)
+        return _read_chunked(conn, query, values, params, chunk_size)
+
+
+def read_many_by_keys(engine: Engine, queries: dict[str, str], keys: Iterable, max_workers: int | None = None) -> dict[str, pd.DataFrame]:
+    """
+    read_by_keys for several queries over the same keys, run concurrently on separate pooled
+    connections (one thread per query unless max_workers says otherwise). Returns the frames by name.
+    """
+    values = distinct_keys(keys)
+    with ThreadPoolExecutor(max_workers=max_workers or len(queries) or 1) as pool:
+        futures = {name: pool.submit(read_by_keys, engine, query, values) for name, query in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
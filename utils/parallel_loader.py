@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, Engine
+from utils.tools import get_logger
+from utils.bulk_loader import load_frame
+from utils.cdc import get_watermark, write_watermark
+from utils.connections import POOL_SIZE, MAX_OVERFLOW
+from utils.custom_err import WatermarkError
+
+log = get_logger('ParallelLoader')
+
+# Connections one batch is loaded on, overridable per table with ETL_LOAD_WORKERS_<TABLE>
+LOAD_WORKERS = int(os.getenv('ETL_LOAD_WORKERS', 4))
+# Batches are only split into partitions of at least this many rows
+MIN_PARTITION_ROWS = int(os.getenv('ETL_MIN_PARTITION_ROWS', 5000))
+
+# Per-table totals for the run, reported by log_load_stats
+_stats: dict[str, dict] = {}
+_lock = threading.Lock()
+
+
+def load_workers(table: str) -> int:
+    return max(1, int(os.getenv(f'ETL_LOAD_WORKERS_{table.upper()}', LOAD_WORKERS)))
+
+
+def _partitions(df: pd.DataFrame, key: str, workers: int) -> list[pd.DataFrame]:
+    # Contiguous key ranges, so a failed batch can be removed by range
+    count = max(1, min(workers, len(df) // MIN_PARTITION_ROWS, POOL_SIZE + MAX_OVERFLOW - 1))
+    ordered = df.sort_values(key, kind='stable')
+    return [ordered.iloc[idx] for idx in np.array_split(np.arange(len(ordered)), count) if len(idx)]
+
+
+def _load_partition(engine: Engine, part: pd.DataFrame, table: str, schema: str, dtype: dict | None) -> float:
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        load_frame(part, conn, table, schema=schema, dtype=dtype)
+    return time.perf_counter() - start
+
+
+def _remove_batch(engine: Engine, table: str, schema: str, key: str, low: int, high: int):
+    try:
+        with engine.begin() as conn:
+            deleted = conn.execute(
+                text(f"DELETE FROM {schema}.{table} WHERE {key} BETWEEN :low AND :high"), {'low': low, 'high': high}
+            ).rowcount
+    except Exception as e:
+        # Likely the same outage that failed the batch; the retry's clear_batch_range removes them
+        log.error(f'Could not remove the failed batch from {schema}.{table} ({key} {low}..{high}): {e}')
+        return
+    log.warning(f'Removed {deleted} rows of the failed batch from {schema}.{table} ({key} {low}..{high})')
+
+
+def clear_batch_range(engine: Engine, table: str, schema: str, key: str, cdc_table: str, low: int, high: int) -> int:
+    """
+    Deletes the rows of schema.table in the key range low..high that lie above cdc_table's
+    watermark: partitions of a failed attempt at this batch that committed while the watermark did
+    not move (and whose removal failed too). Rows outside the batch's range, or at or below the
+    watermark, are never touched. Without a watermark row it cannot tell leftovers from rows other
+    writers own, so it raises WatermarkError if the range is not empty. Returns the number of rows deleted.
+    """
+    mark = get_watermark(engine, cdc_table, default=None)
+    with engine.begin() as conn:
+        if mark is None:
+            found = conn.execute(
+                text(f"SELECT COUNT(*) FROM {schema}.{table} WHERE {key} BETWEEN :low AND :high"), {'low': low, 'high': high}
+            ).scalar()
+            if found:
+                raise WatermarkError(f'{schema}.{table} already has {found} rows with {key} {low}..{high} but {cdc_table} has no watermark; '
+                                     f'remove them or write the watermark before loading')
+            return 0
+        deleted = conn.execute(
+            text(f"DELETE FROM {schema}.{table} WHERE {key} BETWEEN :low AND :high"), {'low': max(low, mark + 1), 'high': high}
+        ).rowcount
+    if deleted:
+        log.warning(f'Removed {deleted} rows of an unfinished attempt from {schema}.{table} ({key} {max(low, mark + 1)}..{high})')
+    return deleted
+
+
+def load_partitioned(df: pd.DataFrame, engine: Engine, table: str, key: str, cdc_table: str, schema: str = 'app', dtype: dict | None = None, workers: int | None = None) -> int:
+    """
+    Loads one batch into schema.table split into contiguous ranges of key (the Old*ID column), each
+    inserted and committed on its own pooled connection, so the batch is not bound by one session's
+    log throughput. Partitions commit independently rather than waiting on each other, which would
+    hold their locks open across sessions. The coordinator moves the CDC watermark only after every
+    partition has committed; if any partition (or the CDC update) fails, the rows already committed
+    for this batch are deleted by key range and the error is re-raised.
+
+    This is not one transaction: readers can see a batch's partitions as they commit, and if the
+    delete fails too (e.g. the connection is gone) the rows stay above the unmoved watermark. The
+    retry is idempotent instead: before loading, each batch deletes the rows of its own key range
+    above the watermark (clear_batch_range), so rows a failed attempt left are never loaded twice.
+    Returns the number of partitions used.
+    """
+    if df.empty:
+        return 0
+    low, high = int(df[key].min()), int(df[key].max())
+    clear_batch_range(engine, table, schema, key, cdc_table, low, high)
+    workers = workers or load_workers(table)
+    parts = _partitions(df, key, workers)
+
+    start = time.perf_counter()
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix=f'load-{table}') as pool:
+        futures = [pool.submit(_load_partition, engine, part, table, schema, dtype) for part in parts]
+        seconds = []
+        for i, future in enumerate(futures):
+            try:
+                seconds.append(future.result())
+            except Exception as e:
+                errors.append(e)
+                log.error(f'Partition {i + 1}/{len(parts)} of {schema}.{table} failed: {e}')
+
+    try:
+        if errors:
+            raise errors[0]
+        with engine.begin() as conn:
+            write_watermark(conn, cdc_table, high)
+    except Exception:
+        _remove_batch(engine, table, schema, key, low, high)
+        raise
+
+    elapsed = time.perf_counter() - start
+    with _lock:
+        stats = _stats.setdefault(f'{schema}.{table}', {'batches': 0, 'rows': 0, 'seconds': 0.0, 'workers': 0, 'partitions': 0})
+        stats['batches'] += 1
+        stats['rows'] += len(df)
+        stats['seconds'] += elapsed
+        stats['workers'] = max(stats['workers'], len(parts))
+        stats['partitions'] += len(parts)
+    log.info(f'Loaded {len(df)} rows into {schema}.{table} on {len(parts)} connections in {elapsed:.2f}s '
+             f'(slowest partition {max(seconds):.2f}s), CDC for {cdc_table} updated to {high}')
+    return len(parts)
+
+
+def load_stats() -> dict[str, dict]:
+    with _lock:
+        return {table: dict(s) for table, s in _stats.items()}
+
+
+def log_load_stats():
+    for table, s in load_stats().items():
+        rate = s['rows'] / s['seconds'] if s['seconds'] else 0
+        log.info(f"Load {table}: {s['rows']} rows in {s['batches']} batches, {s['seconds']:.1f}s ({rate:,.0f} rows/s), "
+                 f"up to {s['workers']} workers, {s['partitions']} partitions")
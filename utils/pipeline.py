@@ -0,0 +1,134 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable
+import pandas as pd
+from utils.tools import get_logger
+from utils.batch_sizer import BatchSizer
+
+log = get_logger('Pipeline')
+
+_DONE = object()
+
+
+
+class _Stage(threading.Thread):
+    """Moves items from a source iterable/queue through fn into a bounded output queue, in order."""
+
+    def __init__(self, name: str, source: Iterable | queue.Queue, fn: Callable[[Any], Any] | None, out: queue.Queue, stop: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.source = source
+        self.fn = fn
+        self.out = out
+        self.stop = stop
+        self.busy = 0.0
+        self.error: BaseException | None = None
+
+    def _items(self):
+        if isinstance(self.source, queue.Queue):
+            while not self.stop.is_set():
+                try:
+                    item = self.source.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    return
+                yield item
+        else:
+            iterator = iter(self.source)
+            try:
+                while not self.stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        self.busy += time.perf_counter() - start
+                    yield item
+            finally:
+                # Release the streaming cursor if we stop early
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.out.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        try:
+            for item in self._items():
+                if self.fn is not None:
+                    start = time.perf_counter()
+                    item = self.fn(item)
+                    self.busy += time.perf_counter() - start
+                self._put(item)
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+        finally:
+            self._put(_DONE)
+
+
+def run_pipeline(batches: Iterable, transform: Callable[[Any], Any], load: Callable[[Any], None], queue_size: int = 2, sizer: BatchSizer | None = None) -> int:
+    """
+    Overlaps extract, transform and load: batch N+1 is fetched while batch N is transformed and
+    batch N-1 is loaded. Each stage runs on its own thread and hands off through bounded FIFO queues,
+    so loads (and the CDC updates inside them) happen strictly in extraction order. batches must
+    advance on its own (e.g. utils.extractor.stream_table) rather than re-read the CDC per batch.
+    Returns the number of batches loaded; the first error from any stage is re-raised.
+    With a sizer, each loaded batch reports its row count, transform/load time and memory to it.
+    """
+    def timed_transform(batch):
+        start = time.perf_counter()
+        out = transform(batch)
+        return out, len(batch), time.perf_counter() - start
+
+    stop = threading.Event()
+    extracted: queue.Queue = queue.Queue(maxsize=queue_size)
+    transformed: queue.Queue = queue.Queue(maxsize=queue_size)
+    extractor = _Stage('extract', batches, None, extracted, stop)
+    transformer = _Stage('transform', extracted, timed_transform, transformed, stop)
+    extractor.start()
+    transformer.start()
+
+    loaded, load_time = 0, 0.0
+    started = time.perf_counter()
+    try:
+        while True:
+            try:
+                item = transformed.get(timeout=0.5)
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                continue
+            if item is _DONE:
+                break
+            item, rows, transform_seconds = item
+            start = time.perf_counter()
+            load(item)
+            load_seconds = time.perf_counter() - start
+            load_time += load_seconds
+            loaded += 1
+            if sizer is not None:
+                memory = int(item.memory_usage(deep=True).sum()) if isinstance(item, pd.DataFrame) else 0
+                sizer.record(rows, transform_seconds, load_seconds, memory)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        stop.set()
+        extractor.join()
+        transformer.join()
+
+    for stage in (extractor, transformer):
+        if stage.error is not None:
+            raise stage.error
+
+    log.info(f'Pipeline loaded {loaded} batches in {time.perf_counter() - started:.1f}s '
+             f'(extract {extractor.busy:.1f}s, transform {transformer.busy:.1f}s, load {load_time:.1f}s)')
+    return loaded
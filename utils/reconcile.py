@@ -0,0 +1,155 @@
+import os
+import json
+import time
+from decimal import Decimal
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, Engine
+from utils.tools import get_logger, get_state_dir
+from utils.cdc import get_watermark
+from utils.hash_diff import diff_table, bounded_where
+
+log = get_logger('Reconcile')
+
+# Connections per side the chunk queries run on
+RECONCILE_WORKERS = int(os.getenv('ETL_RECONCILE_WORKERS', 4))
+# Old*ID range per chunk; each chunk is one aggregate query per side (a range seek when the key is indexed)
+CHUNK_KEYS = int(os.getenv('ETL_RECONCILE_CHUNK_KEYS', 250_000))
+# Keys listed per kind of difference in the report; the counts are always complete
+SAMPLE_KEYS = int(os.getenv('ETL_RECONCILE_SAMPLE_KEYS', 20))
+
+# Difference per row of a VERIFY 'totals' aggregate that still counts as equal (money rounded to cents)
+TOLERANCE = Decimal(os.getenv('ETL_RECONCILE_TOLERANCE', '0.01'))
+
+
+def _decimal(value) -> Decimal:
+    # pyodbc returns DECIMAL as Decimal; other drivers may give floats or ints
+    if value is None:
+        return Decimal(0)
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def _chunk_totals(engine: Engine, table: str, key: str, where: str | None, aggregates: list[str], low: int, high: int) -> list:
+    """[rows, each aggregate as a Decimal] of one key range."""
+    totals = ''.join(f', CAST({expr} AS DECIMAL(38, 6))' for expr in aggregates)
+    condition = f" AND ({where})" if where else ''
+    with engine.connect() as conn:
+        row = conn.execute(text(f"SELECT COUNT(*){totals} FROM {table} WHERE {key} BETWEEN :low AND :high{condition}"), {'low': low, 'high': high}).one()
+    return [int(row[0])] + [_decimal(v) for v in row[1:]]
+
+
+def _differences(totals: list[tuple[str, str, str]], source: list, target: list) -> dict[str, float]:
+    """The totals of one chunk that disagree; counts must match exactly, sums within TOLERANCE per row."""
+    # Rounding adds up over a chunk, so the tolerance scales with its row count
+    allowed = TOLERANCE * max(source[0], target[0], 1)
+    return {
+        label: float(s - t)
+        for (label, expr, _), s, t in zip(totals, source[1:], target[1:])
+        if abs(s - t) > (0 if expr.lstrip().upper().startswith('COUNT(') else allowed)
+    }
+
+
+def _bounds(engine: Engine, table: str, key: str, where: str | None) -> list[int]:
+    condition = f" AND ({where})" if where else ''
+    with engine.connect() as conn:
+        return [int(b) for b in conn.execute(text(f"SELECT MIN({key}), MAX({key}) FROM {table} WHERE {key} IS NOT NULL{condition}")).one() if b is not None]
+
+
+def reconcile_table(source_db: Engine, target_db: Engine, spec: dict, max_key: int | None = None) -> dict:
+    """
+    Reconciles one migrated table: row counts and the spec's 'totals' per Old*ID chunk (queried on a
+    pool of connections, both sides at once, so neither table is read into memory), then key
+    coverage and per-row checksums from the hash-range diff, which only descends into ranges that
+    disagree. 'totals' are (label, source aggregate, target aggregate) triples such as
+    ('Subtotal', 'SUM(AmountTotal)', 'SUM(Subtotal)'), compared as decimals: COUNTs exactly, sums
+    within TOLERANCE per row. The source side reads spec['totals_source'] (e.g. a derived table
+    joining the checkout rows) when given, else spec['source']. max_key bounds both sides at the CDC watermark, as in diff_table.
+    """
+    start = time.perf_counter()
+    source_where = bounded_where(spec.get('where'), spec['key'], max_key)
+    target_where = bounded_where(spec.get('target_where'), spec['target_key'], max_key)
+    totals = spec.get('totals', [])
+    source_relation = spec.get('totals_source', spec['source'])
+
+    bounds = _bounds(source_db, source_relation, spec['key'], source_where) + _bounds(target_db, spec['target'], spec['target_key'], target_where)
+    low, high = (min(bounds), max(bounds)) if bounds else (0, -1)
+    chunks = [(c, min(c + CHUNK_KEYS - 1, high)) for c in range(low, high + 1, CHUNK_KEYS)]
+
+    with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS * 2, thread_name_prefix='reconcile') as pool:
+        source_futures = [pool.submit(_chunk_totals, source_db, source_relation, spec['key'], source_where, [s for _, s, _ in totals], low, high) for low, high in chunks]
+        target_futures = [pool.submit(_chunk_totals, target_db, spec['target'], spec['target_key'], target_where, [t for _, _, t in totals], low, high) for low, high in chunks]
+        source_totals = [f.result() for f in source_futures]
+        target_totals = [f.result() for f in target_futures]
+
+    mismatched_chunks = []
+    for (low, high), s, t in zip(chunks, source_totals, target_totals):
+        differences = _differences(totals, s, t)
+        if s[0] != t[0] or differences:
+            mismatched_chunks.append({'low': low, 'high': high, 'source_rows': s[0], 'target_rows': t[0], 'total_differences': differences})
+    source_sum = [sum(col) for col in zip(*source_totals)] if source_totals else [0] + [Decimal(0)] * len(totals)
+    target_sum = [sum(col) for col in zip(*target_totals)] if target_totals else [0] + [Decimal(0)] * len(totals)
+
+    diff = diff_table(source_db, target_db, spec, max_key=max_key)
+    report = {
+        'source': spec['source'],
+        'target': spec['target'],
+        'max_key': max_key,
+        'source_rows': source_sum[0],
+        'target_rows': target_sum[0],
+        'totals': {
+            label: {'source': float(s), 'target': float(t), 'difference': float(s - t)}
+            for (label, _, _), s, t in zip(totals, source_sum[1:], target_sum[1:])
+        },
+        'chunks': len(chunks),
+        'mismatched_chunks': mismatched_chunks,
+    }
+    for kind, label in (('inserts', 'missing'), ('deletes', 'extra'), ('updates', 'mismatched'), ('duplicates', 'duplicated')):
+        report[f'{label}_keys'] = len(diff[kind])
+        report[f'{label}_sample'] = diff[kind][:SAMPLE_KEYS]
+    report['status'] = 'ok' if not mismatched_chunks and not any(diff[k] for k in ('inserts', 'deletes', 'updates', 'duplicates')) else 'mismatch'
+    report['diff'] = {k: diff[k] for k in ('ranges_compared', 'levels', 'rows_fetched', 'hashed_on_server', 'seconds')}
+    report['seconds'] = round(time.perf_counter() - start, 2)
+    log.info(f"Reconciled {spec['source']} -> {spec['target']}: {report['status']}, rows {report['source_rows']} / {report['target_rows']}, "
+             f"{report['missing_keys']} missing, {report['extra_keys']} extra, {report['mismatched_keys']} mismatched, "
+             f"{len(mismatched_chunks)}/{len(chunks)} chunks differ ({report['seconds']}s)")
+    return report
+
+
+def reconcile(tasks: list[str] | None = None, source_db: Engine | None = None, target_db: Engine | None = None) -> dict:
+    """
+    Reconciles every given task (default: all, plus the VERIFY_ONLY modules) that declares a VERIFY spec, up to its CDC watermark,
+    and writes the report as JSON to .etl_state/reconcile. Returns the report.
+    """
+    from utils.registry import REGISTRY, VERIFY_ONLY, get_verify_spec
+    from utils.connections import source_db_conn, target_db_conn
+
+    source_db = source_db or source_db_conn()
+    target_db = target_db or target_db_conn()
+    started = datetime.now()
+    tables = {}
+    for name in tasks or [*REGISTRY, *VERIFY_ONLY]:
+        spec = get_verify_spec(name)
+        if not spec:
+            log.info(f'{name} declares no VERIFY spec, skipped')
+            continue
+        try:
+            tables[name] = reconcile_table(source_db, target_db, spec, max_key=get_watermark(target_db, spec['source']))
+        except Exception as e:
+            log.error(f'Could not reconcile {name}: {e}')
+            tables[name] = {'source': spec['source'], 'target': spec['target'], 'status': 'error', 'error': str(e)}
+
+    report = {
+        'started': started.isoformat(timespec='seconds'),
+        'seconds': round((datetime.now() - started).total_seconds(), 2),
+        'status': 'ok' if all(t['status'] == 'ok' for t in tables.values()) else 'mismatch',
+        'tables': tables,
+    }
+    path = get_state_dir('reconcile') / f"report-{started:%Y%m%d-%H%M%S}.json"
+    path.write_text(json.dumps(report, indent=1), encoding='utf-8')
+    log.info(f"Reconciliation {report['status']} for {len(tables)} tables, report written to {path}")
+    return report
+
+
+if __name__ == '__main__':
+    import sys
+    raise SystemExit(0 if reconcile(sys.argv[1:] or None)['status'] == 'ok' else 1)
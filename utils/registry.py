@@ -0,0 +1,126 @@
+import ast
+import importlib
+import subprocess
+import sys
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Task name -> module defining its main(); modules are only imported when scheduled
+REGISTRY: dict[str, str] = {
+    'makes': 'Template_Tables.makes',
+    'models': 'Template_Tables.models',
+    'units': 'Template_Tables.sync_units',
+    'amenities': 'Template_Tables.sync_amenities',
+    'app_sources': 'Template_Tables.sync_app_sources',
+    'cities': 'Template_Tables.sync_cities',
+    'landmarks': 'Template_Tables.sync_landmarks',
+    'payment_modes': 'Template_Tables.sync_payment_modes',
+    'services': 'Template_Tables.sync_services',
+    'accounts': 'Main_Modules.Accounts.accounts',
+    'locations': 'Main_Modules.Locations.locations',
+    'bays': 'Main_Modules.Bays.bays',
+    'users': 'Main_Modules.AspNetUsers.subusers',
+    'customers': 'Main_Modules.AspNetUsers.customers',
+    'customer_locations': 'Main_Modules.AspNetUsers.customer_locations',
+    'categories': 'Main_Modules.ProductManagement.categories',
+    'items': 'Main_Modules.ProductManagement.items',
+    'location_items': 'Main_Modules.ProductManagement.location_items',
+    'packages': 'Main_Modules.Packages.packages',
+    'package_details': 'Main_Modules.Packages.package_details',
+    'location_packages': 'Main_Modules.Packages.location_packages',
+    'cars': 'Main_Modules.Cars.cars',
+    'car_locations': 'Main_Modules.Cars.car_locations',
+    'orders': 'Orders_Payments.Orders.orders',
+    'order_payments': 'Orders_Payments.Orders.order_payments',
+    'order_line_items': 'Orders_Payments.Orders.order_line_items',
+    'account_payment': 'Orders_Payments.Payments.account_payment',
+    'warehouses': 'Invertory.Warehouses.warehouses',
+    'suppliers': 'Invertory.Suppliers.suppliers',
+    'purchase_bills': 'Invertory.Purchases.purchase_bills',
+    'purchase_bill_details': 'Invertory.Purchases.purchase_bill_details',
+    'purchase_orders': 'Invertory.Purchases.purchase_orders',
+    'stock_transfers': 'Invertory.Stocks.stock_transfers',
+    'stock_transfer_details': 'Invertory.Stocks.stock_transfer_details',
+    'reconciliations': 'Invertory.Reconciliations.reconciliations',
+    'subscriptions': 'Settings.Subscriptions.subscriptions',
+    'roles': 'Settings.Roles.roles',
+}
+
+# Modules that are run by hand rather than scheduled, but still declare a VERIFY spec for utils.reconcile
+VERIFY_ONLY: dict[str, str] = {
+    'stocks': 'Invertory.Stocks.stocks',
+}
+
+
+def module_file(name: str) -> Path:
+    module = REGISTRY.get(name) or VERIFY_ONLY[name]
+    return ROOT.joinpath(*module.split('.')).with_suffix('.py')
+
+
+@lru_cache(maxsize=None)
+def _read_constant(name: str, constant: str):
+    """A module-level literal from the module's source, without importing it (None if absent)."""
+    tree = ast.parse(module_file(name).read_text(encoding='utf-8'))
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == constant for t in node.targets):
+            return ast.literal_eval(node.value)
+    return None
+
+
+def get_dependencies(name: str) -> list[str]:
+    """Reads the module's DEPENDS_ON list from its source without importing it."""
+    return list(_read_constant(name, 'DEPENDS_ON') or [])
+
+
+def get_target_columns(name: str) -> dict[str, dict[str, str]]:
+    """Reads the module's TARGET_COLUMNS ({table: {column: definition}}) the same way."""
+    return dict(_read_constant(name, 'TARGET_COLUMNS') or {})
+
+
+def get_verify_spec(name: str) -> dict:
+    """Reads the module's VERIFY spec (source/target tables, keys and comparable columns, see utils.hash_diff)."""
+    return dict(_read_constant(name, 'VERIFY') or {})
+
+
+def load_task(name: str) -> Callable[[], None]:
+    return importlib.import_module(REGISTRY[name]).main
+
+
+def run_task(name: str):
+    load_task(name)()
+
+
+# -------------------- Startup benchmark --------------------
+def _time_python(code: str, repeat: int = 5) -> float:
+    """Best wall-clock time of a fresh interpreter running the snippet from the repo root."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_startup(task: str = 'roles', repeat: int = 5) -> dict[str, float]:
+    """Compares interpreter startup for main.py, a lazy single-task start, and importing every module eagerly."""
+    results = {
+        'python': _time_python('pass', repeat),
+        'import main': _time_python('import main', repeat),
+        f'lazy start ({task})': _time_python(
+            f'from utils.runner import select; from utils.registry import load_task; '
+            f'select(["{task}"]); load_task("{task}")', repeat),
+        'eager import of all modules': _time_python(
+            'import importlib; from utils.registry import REGISTRY; '
+            '[importlib.import_module(m) for m in REGISTRY.values()]', repeat),
+    }
+    for label, seconds in results.items():
+        print(f'{label:<32} {seconds * 1000:8.1f} ms')
+    return results
+
+
+if __name__ == '__main__':
+    bench_startup(*sys.argv[1:2])
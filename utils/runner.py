@@ -0,0 +1,167 @@
+import os
+import time
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from utils.tools import get_logger
+from utils.registry import REGISTRY, get_dependencies, get_target_columns, run_task
+from utils.custom_err import DependencyGraphError
+
+log = get_logger('Runner')
+
+# Check/add the selected tasks' target columns once before any of them starts
+SCHEMA_PREFLIGHT = os.getenv('ETL_SCHEMA_PREFLIGHT', '1') == '1'
+
+
+
+def build_graph(names: list[str] | None = None) -> dict[str, list[str]]:
+    """Dependency graph of the registered tasks, read without importing any of them."""
+    graph = {name: get_dependencies(name) for name in (names or REGISTRY)}
+    for name, deps in graph.items():
+        unknown = [d for d in deps if d not in REGISTRY]
+        if unknown:
+            raise DependencyGraphError(f'{name} depends on unknown tasks: {unknown}')
+    return graph
+
+
+def select(targets: list[str] | None = None, with_upstream: bool = False) -> dict[str, list[str]]:
+    """Graph of the requested tasks (plus their upstream closure if asked); only their sources are parsed."""
+    if not targets:
+        return build_graph()
+    unknown = [t for t in targets if t not in REGISTRY]
+    if unknown:
+        raise DependencyGraphError(f'Unknown tasks: {unknown}')
+
+    selected = set(targets)
+    if with_upstream:
+        stack = list(targets)
+        while stack:
+            for dep in get_dependencies(stack.pop()):
+                if dep not in selected:
+                    selected.add(dep)
+                    stack.append(dep)
+
+    # Upstream tasks left out of the run are treated as already migrated
+    graph = build_graph([name for name in REGISTRY if name in selected])
+    return {name: [d for d in deps if d in selected] for name, deps in graph.items()}
+
+
+def topological_order(graph: dict[str, list[str]]) -> list[str]:
+    indegree = {name: len(deps) for name, deps in graph.items()}
+    order = [name for name, n in indegree.items() if n == 0]
+    for name in order:
+        for child, deps in graph.items():
+            if name in deps:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    order.append(child)
+    if len(order) != len(graph):
+        raise DependencyGraphError(f'Dependency cycle between: {sorted(set(graph) - set(order))}')
+    return order
+
+
+def critical_path(graph: dict[str, list[str]], durations: dict[str, float]) -> tuple[float, list[str]]:
+    """Longest chain of dependent tasks by measured duration."""
+    best: dict[str, tuple[float, list[str]]] = {}
+    for name in topological_order(graph):
+        upstream = max((best[d] for d in graph[name] if d in best), default=(0.0, []))
+        best[name] = (upstream[0] + durations.get(name, 0.0), upstream[1] + [name])
+    return max(best.values(), default=(0.0, []))
+
+
+def preflight_schema(names: list[str]):
+    """Ensures every TARGET_COLUMNS entry of the given tasks in one pass, reporting schema drift first."""
+    from utils.connections import target_db_conn
+    from utils.schema_guard import ensure_schema
+
+    required: dict[str, dict[str, str]] = {}
+    for name in names:
+        for table, columns in get_target_columns(name).items():
+            required.setdefault(table, {}).update(columns)
+    if required:
+        ensure_schema(target_db_conn(), required)
+        log.info(f'Target schema checked for {sum(len(c) for c in required.values())} columns in {len(required)} tables')
+
+
+def _timed(name: str) -> float:
+    from utils.connections import log_pool_stats
+    from utils.fks_mapper import save_snapshots
+    from utils.parallel_loader import log_load_stats
+    from utils.dedup_index import save_indexes
+
+    start = time.perf_counter()
+    try:
+        run_task(name)
+    finally:
+        log_pool_stats()
+        log_load_stats()
+        save_snapshots()
+        save_indexes()
+    return time.perf_counter() - start
+
+
+def run(targets: list[str] | None = None, with_upstream: bool = False, workers: int | None = None) -> dict[str, float]:
+    """
+    Runs the tasks in a process pool, starting each one as soon as its upstream tasks succeed (in
+    this process when there is one task or one worker). A failed task's downstream tasks are
+    skipped, and the failures are raised together as DependencyGraphError once the rest finished.
+    """
+    graph = select(targets, with_upstream)
+    order = topological_order(graph)  # fail fast on cycles
+    if SCHEMA_PREFLIGHT:
+        preflight_schema(order)
+
+    pending = dict(graph)
+    running: dict[Future, str] = {}
+    durations: dict[str, float] = {}
+    failed: dict[str, BaseException] = {}
+    skipped: list[str] = []
+    started = time.perf_counter()
+
+    def ready() -> list[str]:
+        """Drops tasks whose upstream failed; returns (and unqueues) the ones whose upstream all succeeded."""
+        names = []
+        for name, deps in list(pending.items()):
+            if any(d in failed or d in skipped for d in deps):
+                log.warning(f'Skipping {name}: upstream task failed')
+                skipped.append(name)
+                del pending[name]
+            elif all(d in durations for d in deps):
+                names.append(name)
+                del pending[name]
+        return names
+
+    def finished(name: str, result: Callable[[], float]):
+        try:
+            durations[name] = result()
+            log.info(f'Finished {name} in {durations[name]:.1f}s')
+        except Exception as e:
+            failed[name] = e
+            log.error(f'{name} failed: {e}')
+
+    if len(order) == 1 or workers == 1:
+        # Nothing to overlap: run in this process and skip the pool start-up
+        while pending:
+            for name in ready():
+                log.info(f'Starting {name}')
+                finished(name, lambda: _timed(name))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for name in ready():
+                    log.info(f'Starting {name}')
+                    running[pool.submit(_timed, name)] = name
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(running.pop(future), future.result)
+
+    elapsed = time.perf_counter() - started
+    path_time, path = critical_path({n: graph[n] for n in durations}, durations)
+    log.info(f'Ran {len(durations)} tasks in {elapsed:.1f}s (sum {sum(durations.values()):.1f}s, critical path {path_time:.1f}s: {" -> ".join(path)})')
+
+    if failed:
+        raise DependencyGraphError(f'Failed tasks: {list(failed)}; skipped downstream: {skipped}')
+    return durations
@@ -0,0 +1,168 @@
+import os
+import json
+import uuid
+import threading
+from typing import Iterable
+import pandas as pd
+from sqlalchemy import text, Engine
+from utils.tools import get_logger, get_state_dir
+from utils.id_snapshot import target_tag
+from utils.custom_err import TargetSchemaError
+
+log = get_logger('SchemaGuard')
+
+# Target schemas whose catalog is cached and compared between runs
+SCHEMAS = ['app']
+
+
+
+class SchemaGuard:
+    """
+    The target catalog (table -> column -> type) for the migrated schemas, read once per process and
+    re-read only after columns are added, so loads do not query sys.columns per batch. The first
+    read is compared with the snapshot the previous run left in .etl_state/schema, and differences
+    are logged as drift before any batch is loaded.
+    """
+
+    def __init__(self):
+        self._catalogs: dict[str, dict[str, dict[str, str]]] = {}
+        self._ensured: set[tuple[str, str, str]] = set()
+        self._checked: set[tuple[str, str, tuple]] = set()
+        self._lock = threading.RLock()
+
+    # -------------------- Catalog --------------------
+    def _read(self, engine: Engine) -> dict[str, dict[str, str]]:
+        schemas = ', '.join(f"'{s}'" for s in SCHEMAS)
+        columns = pd.read_sql(f"""
+            SELECT s.name + '.' + t.name AS TableName, c.name AS ColumnName,
+                   ty.name + CASE WHEN ty.name IN ('nvarchar', 'nchar') AND c.max_length > 0 THEN '(' + CAST(c.max_length / 2 AS VARCHAR) + ')'
+                                  WHEN ty.name IN ('varchar', 'char', 'varbinary') AND c.max_length > 0 THEN '(' + CAST(c.max_length AS VARCHAR) + ')'
+                                  WHEN c.max_length = -1 THEN '(max)'
+                                  WHEN ty.name IN ('decimal', 'numeric') THEN '(' + CAST(c.precision AS VARCHAR) + ',' + CAST(c.scale AS VARCHAR) + ')'
+                                  ELSE '' END
+                   + CASE WHEN c.is_nullable = 1 THEN ' NULL' ELSE ' NOT NULL' END AS TypeName
+            FROM sys.columns c
+            JOIN sys.tables t ON t.object_id = c.object_id
+            JOIN sys.schemas s ON s.schema_id = t.schema_id
+            JOIN sys.types ty ON ty.user_type_id = c.user_type_id
+            WHERE s.name IN ({schemas})
+            ORDER BY TableName, c.column_id
+        """, engine)
+        catalog: dict[str, dict[str, str]] = {}
+        for table, column, type_name in columns.itertuples(index=False):
+            catalog.setdefault(table.lower(), {})[column] = type_name
+        return catalog
+
+    def _snapshot_path(self, engine: Engine):
+        return get_state_dir('schema') / f'{target_tag(engine.url)}.json'
+
+    def _save(self, engine: Engine, catalog: dict[str, dict[str, str]]):
+        path = self._snapshot_path(engine)
+        try:
+            # Worker processes can save at once; each writes its own temp file
+            tmp = path.with_name(f'{path.name}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp')
+            tmp.write_text(json.dumps(catalog, indent=1, sort_keys=True), encoding='utf-8')
+            tmp.replace(path)
+        except OSError as e:
+            log.warning(f'Could not save the schema snapshot: {e}')
+
+    def _report_drift(self, engine: Engine, catalog: dict[str, dict[str, str]]) -> dict[str, list[str]]:
+        path = self._snapshot_path(engine)
+        if not path.exists():
+            return {}
+        try:
+            previous = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            log.warning(f'Ignoring unreadable schema snapshot {path}: {e}')
+            return {}
+
+        drift: dict[str, list[str]] = {}
+        for table in sorted(set(previous) | set(catalog)):
+            before, after = previous.get(table), catalog.get(table)
+            if before is None or after is None:
+                drift[table] = ['table added' if before is None else 'table dropped']
+                continue
+            changes = [f'+{c} {after[c]}' for c in after if c not in before]
+            changes += [f'-{c}' for c in before if c not in after]
+            changes += [f'{c} {before[c]} -> {after[c]}' for c in after if c in before and before[c] != after[c]]
+            if changes:
+                drift[table] = changes
+        for table, changes in drift.items():
+            log.warning(f'Schema drift in {table} since the last run: {", ".join(changes)}')
+        return drift
+
+    def catalog(self, engine: Engine) -> dict[str, dict[str, str]]:
+        """The cached catalog for engine's database, read (and checked for drift) on first use."""
+        key = target_tag(engine.url)
+        with self._lock:
+            if key not in self._catalogs:
+                catalog = self._read(engine)
+                self._report_drift(engine, catalog)
+                self._save(engine, catalog)
+                self._catalogs[key] = catalog
+                log.info(f'Cached the target catalog: {len(catalog)} tables in {SCHEMAS}')
+            return self._catalogs[key]
+
+    # -------------------- Guards --------------------
+    def ensure(self, engine: Engine, required: dict[str, dict[str, str]]):
+        """
+        Adds the required columns ({table: {column: definition}}) that the catalog does not have, in one
+        committed transaction of their own. Each column is checked once per process.
+        """
+        key = target_tag(engine.url)
+        with self._lock:
+            pending = [(t, c, d) for t, cols in required.items() for c, d in cols.items() if (key, t, c) not in self._ensured]
+            if not pending:
+                return
+            catalog = self.catalog(engine)
+            missing = [(t, c, d) for t, c, d in pending if c.lower() not in {k.lower() for k in catalog.get(t.lower(), {})}]
+            if missing:
+                with engine.begin() as conn:
+                    for table, column, definition in missing:
+                        conn.execute(text(f"""
+                            IF NOT EXISTS (SELECT 1 FROM sys.columns WHERE Name = '{column}' AND Object_ID = Object_ID('{table}'))
+                            BEGIN
+                                ALTER TABLE {table} ADD {column} {definition};
+                            END
+                        """))
+                for table, column, definition in missing:
+                    log.info(f'Added {column} {definition} to {table}')
+                self._catalogs[key] = self._read(engine)
+                self._save(engine, self._catalogs[key])
+            self._ensured.update((key, t, c) for t, c, _ in pending)
+
+    @staticmethod
+    def _missing(catalog: dict[str, dict[str, str]], table: str, columns: tuple) -> list[str] | None:
+        known = catalog.get(table.lower())
+        if known is None:
+            return None
+        known = {c.lower() for c in known}
+        return [c for c in columns if c.lower() not in known]
+
+    def check_columns(self, engine: Engine, table: str, columns: Iterable[str]):
+        """Raises TargetSchemaError, before anything is inserted, if table lacks any of the frame's columns."""
+        key = (target_tag(engine.url), table, tuple(columns))
+        with self._lock:
+            if key in self._checked:
+                return
+            missing = self._missing(self.catalog(engine), table, key[2])
+            if missing:
+                # Another process may have changed the table since it was cached
+                self._catalogs[key[0]] = self._read(engine)
+                missing = self._missing(self._catalogs[key[0]], table, key[2])
+            if missing is None:
+                raise TargetSchemaError(f'{table} does not exist in the target database')
+            if missing:
+                raise TargetSchemaError(f'{table} has no column(s) {missing}; the target schema changed or the transform produces extra columns')
+            self._checked.add(key)
+
+
+GUARD = SchemaGuard()
+
+
+def ensure_schema(engine: Engine, required: dict[str, dict[str, str]]):
+    GUARD.ensure(engine, required)
+
+
+def check_columns(engine: Engine, table: str, columns: Iterable[str]):
+    GUARD.check_columns(engine, table, columns)
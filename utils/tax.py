@@ -0,0 +1,120 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from sqlalchemy import Engine
+from utils.tools import get_logger
+
+log = get_logger('Tax')
+
+# How orders.transform treats the header tax V1 recorded (before reconcile_order_totals):
+#   off      keep V1's totals as they are (default)
+#   backfill where V1 recorded no tax and the totals do not add up, tax (Subtotal - Discount) at the
+#            country rate and set GrandTotal to match
+#   all      backfill, and recompute tax and GrandTotal of the other orders whose V1 totals do not add up
+ORDER_TAX_MODE = os.getenv('ETL_ORDER_TAX_MODE', 'off')
+# Rounding allowed when checking V1 totals (currency units)
+TAX_TOLERANCE = 0.01
+
+
+class TaxRates:
+    """
+    TaxPercentage per target LocationID, resolved Location -> City -> Country. Countries are read once
+    per process; the location map is read once too and re-read only when a batch has a location it
+    does not know yet (e.g. migrated after the first lookup).
+    """
+
+    def __init__(self):
+        self._countries: pd.Series | None = None      # CountryID -> TaxPercentage
+        self._locations: pd.Series | None = None      # LocationID -> CountryID
+        self._lock = threading.Lock()
+
+    def _load_locations(self, engine: Engine):
+        locations = pd.read_sql("""
+            SELECT l.LocationID, c.CountryID
+            FROM app.Locations l
+            JOIN app.Cities c ON c.CityID = l.CityID
+        """, engine)
+        self._locations = locations.drop_duplicates('LocationID').set_index('LocationID')['CountryID']
+        log.info(f'Loaded countries for {len(self._locations)} locations')
+
+    def percentages(self, engine: Engine, location_ids: pd.Series) -> np.ndarray:
+        """TaxPercentage for each location (NaN where the location or its country is unknown)."""
+        with self._lock:
+            if self._countries is None:
+                countries = pd.read_sql("SELECT CountryID, TaxPercentage FROM app.Countries", engine)
+                self._countries = countries.set_index('CountryID')['TaxPercentage'].astype(float)
+                log.info(f'Loaded tax rates for {len(self._countries)} countries')
+            if self._locations is None:
+                self._load_locations(engine)
+
+            ids = location_ids.to_numpy(dtype=float, na_value=np.nan)
+            if not pd.Index(ids[~np.isnan(ids)]).isin(self._locations.index).all():
+                self._load_locations(engine)
+
+            country_ids = self._locations.reindex(ids).to_numpy()
+            return self._countries.reindex(country_ids).to_numpy(dtype=float)
+
+
+RATES = TaxRates()
+
+
+def apply_line_tax(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Order lines (Subtotal, DiscountAmount, the header's ItemTaxTotal and OrderTaxable, the sum of
+    Subtotal - DiscountAmount over all the order's lines): the header tax is spread over the lines
+    by their share of OrderTaxable, so the lines of an order always add up to its ItemTaxTotal.
+    TaxPercent is the order's effective rate; GrandTotal includes the line's tax. In place.
+    """
+    taxable = df['Subtotal'].to_numpy(dtype=float) - df['DiscountAmount'].to_numpy(dtype=float)
+    order_tax = df['ItemTaxTotal'].to_numpy(dtype=float, na_value=0)
+    order_taxable = df['OrderTaxable'].to_numpy(dtype=float, na_value=0)
+    percent = np.divide(order_tax * 100, order_taxable, out=np.zeros(len(df)), where=order_taxable != 0)
+    df['TaxPercent'] = percent
+    df['TaxAmount'] = taxable * percent / 100
+    df['GrandTotal'] = taxable + df['TaxAmount'].to_numpy()
+    return df
+
+
+def apply_order_tax(df: pd.DataFrame, engine: Engine, mode: str = ORDER_TAX_MODE) -> pd.DataFrame:
+    """
+    Order headers (LocationID, Subtotal, OrderDiscountTotal, ItemTaxTotal, GrandTotal) as V1 has
+    them; runs before reconcile_order_totals, which then derives AmountDueTotal from the result.
+    Orders whose totals add up (tax-free ones included) are never changed, nor are orders without a
+    Subtotal or a known rate. backfill sets ItemTaxTotal = (Subtotal - OrderDiscountTotal) * rate
+    and GrandTotal to match where V1 recorded no tax. all also recomputes the other orders that do
+    not add up, except where exactly one of Subtotal/GrandTotal/ItemTaxTotal is 0: reconcile
+    derives that one from the other two. In place.
+    """
+    if mode not in ('off', 'backfill', 'all'):
+        raise ValueError(f'Unknown ETL_ORDER_TAX_MODE {mode!r}')
+    if mode == 'off':
+        return df
+
+    subtotal = df['Subtotal'].to_numpy(dtype=float)
+    tax = df['ItemTaxTotal'].to_numpy(dtype=float)
+    grand = df['GrandTotal'].to_numpy(dtype=float)
+    taxable = subtotal - df['OrderDiscountTotal'].to_numpy(dtype=float)
+    open_orders = (subtotal != 0) & (np.abs(grand - taxable - tax) > TAX_TOLERANCE)
+    backfill = open_orders & (tax == 0)
+    if mode == 'all':
+        derived = ((subtotal != 0).astype(int) + (grand != 0) + (tax != 0)) == 2
+        recompute = open_orders & ~backfill & ~derived
+    else:
+        recompute = np.zeros(len(df), dtype=bool)
+    if not (backfill | recompute).any():
+        return df
+
+    percent = RATES.percentages(engine, df['LocationID'])
+    unknown = np.isnan(percent) & (backfill | recompute)
+    if unknown.any():
+        log.warning(f'No tax rate for {int(unknown.sum())} orders (location or country unknown); kept as V1 has them')
+    backfill &= ~unknown
+    recompute &= ~unknown
+    changed = backfill | recompute
+
+    expected = taxable * np.where(np.isnan(percent), 0.0, percent) / 100
+    df['ItemTaxTotal'] = np.where(changed, expected, tax)
+    df['GrandTotal'] = np.where(changed, taxable + expected, grand)
+    log.info(f'Backfilled tax for {int(backfill.sum())} and recomputed {int(recompute.sum())} of {len(df)} orders ({mode})')
+    return df
@@ -1,4 +1,6 @@
+import os
 import logging
+from pathlib import Path
 import pandas as pd
 
 def get_logger(name: str) -> logging.Logger:
@@ -12,6 +14,13 @@ def get_logger(name: str) -> logging.Logger:
 
 
 
+def get_state_dir(*parts: str) -> Path:
+    """Local directory for state kept between runs (ETL_STATE_DIR, default .etl_state)."""
+    path = Path(os.getenv('ETL_STATE_DIR', '.etl_state')).joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
 def clean_contact(num: str) -> str | None:
     if pd.isna(num): 
         return None